@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+import jdatetime
+import num2fawords
+import redis
+from persiantools import digits
+from telegram import Message
+from telegram.error import BadRequest
+
+from outbox import delivered
+
+logger = logging.getLogger(__name__)
+
+
+class _WatchedFile:
+    """ Content hash of a file, the file is only read again when its modification time or size changed and is
+    stat'ed at most every check_interval seconds """
+
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self.digest = None
+        self._stat = None
+        self._checked_at = None
+
+    def changed(self):
+        """ Check content changed since last call, the first call is always a change """
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        stat = os.stat(self.path)
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return False
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+        with open(self.path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        # a redeploy touches files without changing them
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
+
+
+class TelegramFiles:
+    """ Static files uploaded to telegram once, file_id of each file is kept in redis with the hash of its content
+    and sent instead of the file after that, a changed file is uploaded again """
+
+    def __init__(self, db: redis.Redis, key: str = 'lms:telegram_files', check_interval: float = 60):
+        self.db = db
+        self.key = key
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # path -> watched file
+        self._files = {}
+        # path -> file_id of current content
+        self._ids = {}
+        # path -> lock held while the file is uploaded, so parallel requests upload it once
+        self._upload_locks = {}
+        self._counts = {'sent_by_id': 0, 'uploaded': 0}
+
+    def _file_id(self, path: str):
+        """ Cached file_id of path and hash of its content """
+        with self._lock:
+            watched = self._files.get(path)
+            if watched is None:
+                watched = self._files[path] = _WatchedFile(path, self.check_interval)
+            if watched.changed():
+                self._ids.pop(path, None)
+            digest = watched.digest
+            file_id = self._ids.get(path)
+        if file_id is None:
+            stored = self.db.hget(self.key, path)
+            if stored:
+                entry = json.loads(stored)
+                if entry['digest'] == digest:
+                    file_id = entry['file_id']
+                    with self._lock:
+                        self._ids[path] = file_id
+        return file_id, digest
+
+    def forget(self, path: str):
+        with self._lock:
+            self._ids.pop(path, None)
+        self.db.hdel(self.key, path)
+
+    def reply_photo(self, message: Message, path: str, **kwargs):
+        """ Reply to message with photo at path, by its file_id when it was uploaded before """
+        sent = self._reply_by_id(message, path, **kwargs)
+        if sent:
+            return sent
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(path, threading.Lock())
+        with upload_lock:
+            # another request may have uploaded it while this one waited
+            return self._reply_by_id(message, path, **kwargs) or self._upload(message, path, **kwargs)
+
+    def _reply_by_id(self, message: Message, path: str, **kwargs):
+        file_id, _ = self._file_id(path)
+        if not file_id:
+            return None
+        try:
+            sent = delivered(message.reply_photo(photo=file_id, **kwargs))
+        except BadRequest:
+            # file_id of another bot token is rejected
+            logger.exception('file_id of %s was rejected, it is uploaded again', path)
+            self.forget(path)
+            return None
+        with self._lock:
+            self._counts['sent_by_id'] += 1
+        return sent
+
+    def _upload(self, message: Message, path: str, **kwargs):
+        _, digest = self._file_id(path)
+        with open(path, 'rb') as photo:
+            # request reads the file when it is sent, it is waited for before the file is closed
+            sent = delivered(message.reply_photo(photo=photo, **kwargs))
+        # largest size of the photo, the one shown when it is opened
+        file_id = sent.photo[-1].file_id
+        self.db.hset(self.key, path, json.dumps({'digest': digest, 'file_id': file_id}))
+        with self._lock:
+            self._ids[path] = file_id
+            self._counts['uploaded'] += 1
+        return sent
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._ids), **self._counts}
+
+
+class SemesterCalendar:
+    """ Week number message of each day of the semester, computed when the config file is loaded and again when it
+    changes """
+
+    def __init__(self, path: str, check_interval: float = 60):
+        self._file = _WatchedFile(path, check_interval)
+        self._lock = threading.Lock()
+        # day -> message
+        self._messages = {}
+        self._reload()
+
+    def _reload(self):
+        with self._lock:
+            try:
+                if not self._file.changed():
+                    return
+                with open(self._file.path, 'r') as f:
+                    config_file = json.load(f)
+                start = jdatetime.datetime.strptime(config_file['start_date_edu_calender'], '%Y-%m-%d').date()
+                end = jdatetime.datetime.strptime(config_file['end_date_edu_calender'], '%Y-%m-%d').date()
+            except Exception:
+                # a file being edited is read again when it changes, the last calendar is kept until then
+                logger.exception('semester calendar %s could not be loaded', self._file.path)
+                return
+            messages = {}
+            day = start
+            while day <= end:
+                messages[day] = week_message(day, start)
+                day += timedelta(days=1)
+            self._messages = messages
+
+    def message(self, today: jdatetime.date = None):
+        """ Week number and odd or even week of today """
+        self._reload()
+        return self._messages.get(today or jdatetime.date.today(), 'ترم تمام شده است.')
+
+
+def week_message(day: jdatetime.date, start: jdatetime.date):
+    week_num = (day - start).days // 7 + 1
+    week_odd_even = 'فرد' if week_num % 2 else 'زوج'
+    return f'امروز {jdatetime.date.j_weekdays_fa[day.weekday()]} {num2fawords.ordinal_words(day.day)} ' \
+           f'{jdatetime.date.j_months_fa[day.month - 1]} {digits.en_to_fa(str(day.year))}' \
+           f' هفته {num2fawords.ordinal_words(week_num)} آموزشی و {week_odd_even} است.'
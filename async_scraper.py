@@ -0,0 +1,373 @@
+import asyncio
+import atexit
+import itertools
+import logging
+import random
+import threading
+import time
+import weakref
+from http.cookies import SimpleCookie
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+import requests
+from decouple import config
+
+from circuit import (CircuitBreaker, RetryBudget)
+from metrics import REGISTRY
+from ratelimit import TokenBucket
+from parsers import (BASE_URL, parse_login_token, parse_student_courses, parse_course_activities, parse_events,
+                     course_page_hash)
+
+logger = logging.getLogger(__name__)
+
+# Max concurrent requests to lms for whole bot and for each user session
+GLOBAL_CONCURRENCY = int(config('LMS_GLOBAL_CONCURRENCY', default=16))
+USER_CONCURRENCY = int(config('LMS_USER_CONCURRENCY', default=4))
+# Requests per second budget toward lms shared by all users, jobs and downloads
+MAX_RPS = float(config('LMS_MAX_RPS', default=10))
+# Seconds a request may take including its retries, and seconds to open a connection
+TIMEOUT = float(config('LMS_TIMEOUT', default=10))
+CONNECT_TIMEOUT = float(config('LMS_CONNECT_TIMEOUT', default=3))
+# Seconds a file download may wait for the next data from lms
+DOWNLOAD_READ_TIMEOUT = float(config('LMS_DOWNLOAD_READ_TIMEOUT', default=60))
+# Seconds an idle connection to lms is kept open for the next request
+KEEPALIVE_TIMEOUT = float(config('LMS_KEEPALIVE_TIMEOUT', default=30))
+# Retries of a GET after a timeout, connection error or server error, first backoff in seconds, doubled each retry
+RETRIES = int(config('LMS_RETRIES', default=2))
+RETRY_BACKOFF = float(config('LMS_RETRY_BACKOFF', default=0.5))
+# Failures in a row that open the circuit, and seconds it stays open before a trial request
+BREAKER_FAILURES = int(config('LMS_BREAKER_FAILURES', default=5))
+BREAKER_RESET = float(config('LMS_BREAKER_RESET', default=15))
+MAX_REDIRECTS = 10
+RETRY_STATUSES = (500, 502, 503, 504)
+UNAVAILABLE_MSG = 'سامانه در دسترس نیست. لطفا بعدا تلاش کنید!'
+
+REQUEST_SECONDS = REGISTRY.histogram('request_seconds', 'Time of lms http requests without rate limit waits',
+                                     ('page',))
+REQUESTS = REGISTRY.counter('requests_total', 'Lms http responses', ('page', 'status'))
+
+
+class SessionExpiredError(Exception):
+    """ Lms answered with login page, user session is not valid anymore """
+
+
+class LMSUnavailableError(Exception):
+    """ Lms timed out or failed after retries, or it failed so often that requests are not sent for a while """
+
+
+class EndpointStats:
+    """ Requests, errors, retries and latency of each lms page """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # page -> counts and seconds
+        self._pages = {}
+
+    def _page(self, page: str):
+        entry = self._pages.get(page)
+        if entry is None:
+            entry = self._pages[page] = {'requests': 0, 'errors': 0, 'errors_in_row': 0, 'retries': 0,
+                                         'rejected': 0, 'seconds': 0, 'last_error': ''}
+        return entry
+
+    def request(self, page: str, seconds: float, error: str = None):
+        with self._lock:
+            entry = self._page(page)
+            entry['requests'] += 1
+            entry['seconds'] += seconds
+            if error:
+                entry['errors'] += 1
+                entry['errors_in_row'] += 1
+                entry['last_error'] = error
+            else:
+                entry['errors_in_row'] = 0
+
+    def retry(self, page: str):
+        with self._lock:
+            self._page(page)['retries'] += 1
+
+    def reject(self, page: str):
+        with self._lock:
+            self._page(page)['rejected'] += 1
+
+    def stats(self):
+        """ Counts of each page and its average latency in milliseconds """
+        with self._lock:
+            values = {}
+            for page, entry in self._pages.items():
+                page = page.strip('/') or 'root'
+                for key, value in entry.items():
+                    if key != 'seconds':
+                        values[f'{page} {key}'] = value
+                values[f'{page} avg_ms'] = entry['seconds'] / entry['requests'] * 1000 if entry['requests'] else 0
+            return values
+
+
+class LMSSession(requests.Session):
+    """ Cookie session of a user, also keeps moodle web service token when it is available """
+    __attrs__ = requests.Session.__attrs__ + ['ws_token', 'ws_userid']
+
+    def __init__(self):
+        super().__init__()
+        self.ws_token = None
+        self.ws_userid = None
+        # monotonic time of last response that proved session is connected
+        self.verified_at = 0
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.verified_at = 0
+
+
+class AsyncEngine:
+    """ Event loop running in a background thread with a shared connection pool to lms """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._http = None
+        self._global_limit = None
+        self._user_limits = weakref.WeakKeyDictionary()
+        self.endpoints = EndpointStats()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async_scraper', daemon=True).start()
+            return self._loop
+
+    def run(self, coro):
+        """ Run a coroutine on engine loop and wait for the result, used by sync wrappers """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        """ Close shared connection pool """
+        if self._http is not None:
+            self.run(self._http.close())
+            self._http = None
+
+    @property
+    def http(self):
+        # Cookies belong to each user requests.Session, so the shared client keeps none
+        if self._http is None:
+            # one pool of keep-alive connections as large as the number of concurrent requests
+            connector = aiohttp.TCPConnector(limit=GLOBAL_CONCURRENCY, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                                             ttl_dns_cache=5 * 60)
+            self._http = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+                                               timeout=aiohttp.ClientTimeout(total=TIMEOUT,
+                                                                             sock_connect=CONNECT_TIMEOUT))
+            self._global_limit = asyncio.Semaphore(GLOBAL_CONCURRENCY)
+        return self._http
+
+    def user_limit(self, session: requests.Session):
+        if session not in self._user_limits:
+            self._user_limits[session] = asyncio.Semaphore(USER_CONCURRENCY)
+        return self._user_limits[session]
+
+    async def fetch(self, session: requests.Session, method: str, url: str, data: dict = None):
+        """ Send request with cookies of user session and store cookies of response back into it,
+        raise LMSUnavailableError right away while the circuit is open """
+        if lms_breaker.retry_after():
+            self.endpoints.reject(urlparse(url).path)
+            raise LMSUnavailableError('circuit open')
+        http = self.http
+        async with self.user_limit(session), self._global_limit:
+            for _ in range(MAX_REDIRECTS):
+                status, headers, content = await self._request(http, session, method, url, data)
+                if status in (301, 302, 303, 307, 308) and 'Location' in headers:
+                    url = urljoin(url, headers['Location'])
+                    if status != 307 and status != 308:
+                        method, data = 'GET', None
+                    continue
+                return url, content
+        raise aiohttp.TooManyRedirects(None, ())
+
+    async def _request(self, http: aiohttp.ClientSession, session: requests.Session, method: str, url: str,
+                       data: dict = None):
+        """ One request, a GET is retried after a timeout, connection error or server error with exponential
+        backoff and jitter while TIMEOUT and the retry budget allow, returns (status, headers, content) """
+        page = urlparse(url).path
+        deadline = time.monotonic() + TIMEOUT
+        lms_retry_budget.deposit()
+        for attempt in itertools.count():
+            if not lms_breaker.allow():
+                self.endpoints.reject(page)
+                raise LMSUnavailableError(f'{page}: circuit open')
+            await lms_limiter.async_wait()
+            started = time.monotonic()
+            timeout = aiohttp.ClientTimeout(total=max(deadline - started, 0.1), sock_connect=CONNECT_TIMEOUT)
+            try:
+                with REQUEST_SECONDS.time(page=page):
+                    async with http.request(method, url, data=data, cookies=session.cookies.get_dict(),
+                                            allow_redirects=False, timeout=timeout) as response:
+                        REQUESTS.inc(page=page, status=response.status)
+                        update_cookies(session, url, response.headers.getall('Set-Cookie', []))
+                        status, headers, content = response.status, response.headers, await response.read()
+                error = f'http {status}' if status in RETRY_STATUSES else None
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                error = f'{type(e).__name__} {e}'.strip()
+            self.endpoints.request(page, time.monotonic() - started, error)
+            if error is None:
+                lms_breaker.success()
+                return status, headers, content
+            lms_breaker.failure()
+            # full jitter, retries of many requests that failed together are spread out
+            backoff = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            if (method != 'GET' or attempt >= RETRIES or time.monotonic() + backoff >= deadline
+                    or not lms_retry_budget.withdraw()):
+                raise LMSUnavailableError(f'{page}: {error}')
+            self.endpoints.retry(page)
+            await asyncio.sleep(backoff)
+
+    def stats(self):
+        """ Circuit state, retry budget and health of each lms page """
+        return {**lms_breaker.stats(), **lms_retry_budget.stats(), **self.endpoints.stats()}
+
+
+engine = AsyncEngine()
+lms_limiter = TokenBucket(MAX_RPS, max(1.0, MAX_RPS))
+# Requests fail fast while lms is down, background polling waits for it to close
+lms_breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+lms_retry_budget = RetryBudget()
+atexit.register(engine.close)
+
+
+def update_cookies(session: requests.Session, url: str, set_cookie_headers: list):
+    """ Merge Set-Cookie headers of a response into requests session """
+    domain = urlparse(url).hostname
+    for header in set_cookie_headers:
+        cookie = SimpleCookie()
+        cookie.load(header)
+        for name, morsel in cookie.items():
+            if morsel.value == 'deleted' or morsel['max-age'] == '0':
+                session.cookies.set(name, None, domain=domain, path=morsel['path'] or '/')
+            else:
+                session.cookies.set(name, morsel.value, domain=domain, path=morsel['path'] or '/')
+
+
+def is_login_page(url: str, content: bytes):
+    """ Check lms redirected to login page or rendered login form instead of requested page """
+    return 'login/index.php' in url or b'name="logintoken"' in content
+
+
+async def fetch_page(session: requests.Session, url: str):
+    """ Get a page that needs login, raise SessionExpiredError if session is expired """
+    final_url, content = await engine.fetch(session, 'GET', url)
+    if is_login_page(final_url, content):
+        raise SessionExpiredError(url)
+    session.verified_at = time.monotonic()
+    return content
+
+
+async def async_sign_in(username: str, password: str):
+    """ Sign in to lms """
+    payload = {
+        'logintoken': '',
+        'username': username,
+        'password': password
+    }
+    try:
+        session = LMSSession()
+        _, content = await engine.fetch(session, 'GET', f'{BASE_URL}login/index.php')
+        payload['logintoken'] = parse_login_token(content)
+        url, content = await engine.fetch(session, 'POST', f'{BASE_URL}login/index.php', data=payload)
+        if 'نامعتبر' in content.decode(errors='ignore') or is_login_page(url, content):
+            return None, 'نام کاربری یا رمز ورود نامعتبر است.'
+        return session, 'با موفقیت وارد شدید.'
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('sign in failed')
+        return None, UNAVAILABLE_MSG
+
+
+async def async_session_is_connected(session: requests.Session):
+    """ Check user session is connected, raise LMSUnavailableError when lms did not answer, a session is not
+    dropped because of an outage """
+    try:
+        await fetch_page(session, f'{BASE_URL}my/')
+        return True
+    except LMSUnavailableError:
+        raise
+    except (asyncio.TimeoutError, Exception):
+        return False
+
+
+async def async_get_student_courses(session: requests.Session):
+    """ Find all student courses """
+    try:
+        content = await fetch_page(session, f'{BASE_URL}my/')
+        return parse_student_courses(content), ''
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('courses could not be read')
+        return None, 'لطفا دوباره تلاش کنید!'
+
+
+async def async_get_course_activities(session: requests.Session, course_id: str):
+    """ Find all activities of a course """
+    try:
+        content = await fetch_page(session, f'{BASE_URL}course/view.php?id={course_id}')
+        return parse_course_activities(content), ''
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('activities of course %s could not be read', course_id)
+        return None, 'لطفا دوباره تلاش کنید!'
+
+
+async def async_get_changed_activities(session: requests.Session, course_id: str, page_hash: str = None):
+    """ Find activities of a course if its page is not the same as page_hash,
+    returns ((hash of the page, activities or None when the page did not change), msg) """
+    try:
+        content = await fetch_page(session, f'{BASE_URL}course/view.php?id={course_id}')
+        new_page_hash = course_page_hash(content)
+        if new_page_hash == page_hash:
+            return (new_page_hash, None), ''
+        return (new_page_hash, parse_course_activities(content)), ''
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('activities of course %s could not be read', course_id)
+        return None, 'لطفا دوباره تلاش کنید!'
+
+
+async def gather_activities(get_course_activities, requests_list: list, return_exceptions: bool):
+    """ Fetch activities of many (session, course_id) pairs concurrently, returns {course_id: (activities, msg)},
+    expired sessions raise SessionExpiredError unless return_exceptions is set """
+    results = await asyncio.gather(*[get_course_activities(session, course_id)
+                                     for session, course_id in requests_list], return_exceptions=return_exceptions)
+    results = [(None, 'لطفا دوباره وارد شوید.') if isinstance(result, Exception) else result for result in results]
+    return {course_id: result for (_, course_id), result in zip(requests_list, results)}
+
+
+async def async_get_many_activities(requests_list: list, return_exceptions: bool = False):
+    """ Fetch activities of many (session, course_id) pairs concurrently """
+    return await gather_activities(async_get_course_activities, requests_list, return_exceptions)
+
+
+async def async_get_events(session: requests.Session):
+    """ Find upcoming events """
+    if session:
+        try:
+            content = await fetch_page(session, f'{BASE_URL}calendar/view.php?view=upcoming')
+            return parse_events(content), ''
+        except SessionExpiredError:
+            raise
+        except LMSUnavailableError:
+            return None, UNAVAILABLE_MSG
+        except Exception:
+            logger.exception('events could not be read')
+            return None, 'لطفا دوباره تلاش کنید!'
+    else:
+        return None, UNAVAILABLE_MSG
@@ -0,0 +1,90 @@
+""" Check html and web service backends return the same structures against the fake lms, for students with
+different completed activities and submitted events, after a new activity and a replaced file, and when web
+services are disabled and the web service backend falls back to html
+
+Usage: python bench/backend_compare.py
+"""
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def split_revisions(many_activities: dict):
+    """ Activities of each course without their file revisions, and the sources of the revisions, each backend
+    shows revisions in its own format """
+    activities, sources = {}, set()
+    for course_id, (course_activities, msg) in many_activities.items():
+        activities[course_id] = ([{key: value for key, value in activity.items() if key != 'revision'}
+                                  for activity in course_activities or []], msg)
+        sources.update(activity['revision'].partition(':')[0] for activity in course_activities or []
+                       if activity.get('revision'))
+    return activities, sources
+
+
+def fetch(backend, moodle, username: str):
+    """ Courses, activities without revisions and events of a user, sources of revisions, time and requests """
+    from async_scraper import engine
+
+    start = time.perf_counter()
+    requests_before = moodle.requests_count
+    session, msg = engine.run(backend.async_sign_in(username, moodle.password))
+    courses, _ = engine.run(backend.async_get_student_courses(session))
+    activities, sources = split_revisions(
+        engine.run(backend.async_get_many_activities([(session, course['id']) for course in courses])))
+    events, _ = engine.run(backend.async_get_events(session))
+    print(f'  {backend.__name__:<14} {(time.perf_counter() - start) * 1000:8.1f} ms '
+          f'{moodle.requests_count - requests_before:4} requests  token={bool(getattr(session, "ws_token", None))}')
+    return (courses, activities, events), sources
+
+
+def compare(name: str, moodle, username: str, ws_sources: set):
+    """ Check both backends return the same results, revisions of each backend have the expected source """
+    import async_scraper
+    import moodle_ws
+
+    print(name)
+    html, html_sources = fetch(async_scraper, moodle, username)
+    ws, sources = fetch(moodle_ws, moodle, username)
+    for part, left, right in zip(('courses', 'activities', 'events'), html, ws):
+        print(f'  {part:<14} equal={left == right}')
+    print(f'  {"revisions":<14} html={sorted(html_sources)} ws={sorted(sources)}')
+    return html == ws and html_sources == {'html'} and sources == ws_sources
+
+
+def main():
+    # lms url is read from environment when scraper modules are imported
+    port = free_port()
+    os.environ['LMS_BASE_URL'] = f'http://127.0.0.1:{port}/'
+    from werkzeug.serving import make_server
+    from fakes.moodle import (FakeMoodle, create_app)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    moodle = FakeMoodle()
+    server = make_server('127.0.0.1', port, create_app(moodle), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # completed activities and submitted events differ between users
+    equal = all([compare(f'user {username}', moodle, username, {'ws'}) for username in ('student', 'student2')])
+    course_id = moodle.courses[0]['id']
+    moodle.add_activity(course_id, 'فعالیت جدید')
+    moodle.replace_file(course_id, moodle.activities[course_id][0]['id'])
+    equal = compare('new activity and replaced file', moodle, 'student', {'ws'}) and equal
+    moodle.ws_enabled = False
+    equal = compare('web services disabled', moodle, 'student', {'html'}) and equal
+    server.shutdown()
+    sys.exit(0 if equal else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+""" End to end load test of the bot handlers against local fakes of lms, telegram, google drive and redis
+
+Usage: python bench/load_test.py [--users 50] [--concurrency 20] [--lms-latency 0.1] [--max-p99 5]
+Each user logs in, shows events, opens a course, downloads an activity file, shows week number and calender and
+enables alerts, then an alert cycle checks all watched courses and deadlines like the periodic jobs do. Reports
+throughput, p50 and p99 latency of each step, length of alert cycles and peak RSS, exits with 1 if a step failed or
+a p99 is over --max-p99 seconds.
+Redis is redislite from requirements, or fakeredis in this process when redislite is not installed.
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WAITING_MSG = 'لطفا چند لحظه منتظر بمانید...'
+# messages sent while a step is still running, e.g. download progress
+TRANSIENT = ('در حال ایجاد', 'در حال دریافت', 'در حال بارگذاری', 'در صف دانلود', 'در حال آماده سازی')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_redis(kind: str):
+    """ Redis servers for db and upload db, returns their ports, the objects keeping them alive and the backend
+    that was used, fakeredis when redislite is not installed """
+    ports = free_port(), free_port()
+    if kind == 'redislite':
+        try:
+            import redislite
+        except ImportError:
+            print('redislite is not installed, using fakeredis')
+        else:
+            return ports, [redislite.Redis(serverconfig={'port': str(port)}) for port in ports], 'redislite'
+    import fakeredis
+    import redis
+    servers = {}
+
+    class SharedFakeRedis(fakeredis.FakeRedis):
+        """ Clients of the same host and port share data like clients of a server """
+
+        def __init__(self, host: str = 'localhost', port: int = 6379, **kwargs):
+            super().__init__(server=servers.setdefault((host, int(port)), fakeredis.FakeServer()))
+
+    redis.Redis = SharedFakeRedis
+    return ports, servers, 'fakeredis'
+
+
+def serve(app, port: int):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Recorder:
+    """ Latencies and failures of each step of all users """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.order = []
+
+    def record(self, step: str, seconds: float = None):
+        with self._lock:
+            if step not in self.order:
+                self.order.append(step)
+            if seconds is None:
+                self.errors[step] += 1
+            else:
+                self.latencies[step].append(seconds)
+
+
+def is_done(text: str):
+    return text != WAITING_MSG and not any(marker in text for marker in TRANSIENT)
+
+
+def wait_delivered(outbox, chat_id: int, timeout: float):
+    """ Wait until outbox has no message left for chat, e.g. later parts of a reply split over the length limit,
+    so they are not taken as the reply of the next step """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        with outbox._cond:
+            if chat_id not in outbox._chats:
+                return
+        time.sleep(0.01)
+
+
+def run_user(telegram, outbox, moodle, chat_id: int, recorder: Recorder, timeout: float, rng: random.Random):
+    """ Go through the menus like a student, stop at the first failed step """
+    course = rng.choice(moodle.courses)
+    activity = rng.choice(moodle.activities[course['id']])
+    # name of step, text of user, text expected in the reply that ends the step
+    steps = (
+        ('start', '/start', ''),
+        ('login_menu', 'ورود به سامانه', 'نام کاربری'),
+        ('username', f'student{chat_id}', 'رمز ورود'),
+        ('login', moodle.password, 'با موفقیت'),
+        ('events', 'نمایش رویدادهای نزدیک', ''),
+        ('courses', 'درس ها', 'درس'),
+        ('course', course['name'], 'فعالیت های درس'),
+        ('download', f'/download_{activity["id"]}', '\U0001F4E5'),
+        ('back', 'برگشت', 'انجام شد'),
+        ('week', 'هفته زوج یا فرد؟', ''),
+        ('calender', 'تقویم آموزشی', ''),
+        ('alert', 'فعال کردن اطلاع رسانی فعالیت جدید', 'فعال'),
+    )
+    for step, text, expected in steps:
+        wait_delivered(outbox, chat_id, timeout)
+        with telegram._cond:
+            start = len(telegram.messages[chat_id])
+        started = time.perf_counter()
+        telegram.user_message(chat_id, text)
+        message = telegram.wait_message(chat_id, start, is_done, timeout)
+        if message is None or expected not in (message.get('text') or ''):
+            recorder.record(step)
+            return False
+        recorder.record(step, time.perf_counter() - started)
+    return True
+
+
+def run_cycle(scheduler):
+    """ Run work of all keys of a scheduler at once with its workers, like a whole interval that fell due,
+    returns number of keys and seconds """
+    keys = scheduler.keys()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(scheduler.workers) as executor:
+        list(executor.map(scheduler.callback, keys))
+    return len(keys), time.perf_counter() - started
+
+
+def wait_idle(stats, timeout: float):
+    """ Wait until stats() shows no queued or running work, returns seconds waited """
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        values = stats()
+        if not values.get('queued', 0) and not values.get('running', 0) and not values.get('depth', 0):
+            break
+        time.sleep(0.05)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end load test of the bot')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=20, help='users going through the menus at once')
+    parser.add_argument('--lms-latency', type=float, default=0.05, help='seconds of each lms response')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='seconds of each bot api response')
+    parser.add_argument('--drive-latency', type=float, default=0.1, help='seconds of each drive api call')
+    parser.add_argument('--drive-bandwidth', type=float, default=20, help='upload megabytes per second, 0 unlimited')
+    parser.add_argument('--courses', type=int, default=8)
+    parser.add_argument('--activities', type=int, default=40, help='activities of each course')
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='size of activity files in bytes')
+    parser.add_argument('--new-activities', type=int, default=4, help='courses getting a new activity and a replaced '
+                                                                       'file before the alert cycle')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a step may take before it fails')
+    parser.add_argument('--max-p99', type=float, default=0, help='fail if p99 of a step is over these seconds')
+    parser.add_argument('--redis', choices=('redislite', 'fakeredis'), default='redislite')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    # downloaded files of the bot go to ./files of a temporary directory
+    os.chdir(tempfile.mkdtemp(prefix='lms_load_'))
+    lms_port, telegram_port, bot_port = free_port(), free_port(), free_port()
+    (db_port, upload_port), redis_servers, redis_backend = start_redis(args.redis)
+    # settings are read from environment when lms_bot is imported
+    os.environ.update({
+        'TOKEN': '123:load', 'ADMIN_CHAT_ID': '1', 'HOST_FOLDER_NAME': 'lms',
+        'DB_HOST': '127.0.0.1', 'DB_PORT': str(db_port), 'DB_PASSWORD': '',
+        'DB_UPLOAD_HOST': '127.0.0.1', 'DB_UPLOAD_PORT': str(upload_port), 'DB_UPLOAD_PASSWORD': '',
+        'LMS_BASE_URL': f'http://127.0.0.1:{lms_port}/',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{telegram_port}/bot',
+        'BOT_MODE': 'webhook', 'WEBHOOK_URL': f'http://127.0.0.1:{bot_port}', 'WEBHOOK_SECRET': 'load',
+        'PORT': str(bot_port), 'METRICS_PORT': '0',
+        'SEMESTER_CONFIG': os.path.join(ROOT, 'resource', 'config.json'),
+        'CALENDER_IMAGE': os.path.join(ROOT, 'resource', '1400-1401-calender.jpg'),
+    })
+    from fakes.drive import FakeGDrive
+    from fakes.moodle import (FakeMoodle, create_app as create_moodle_app)
+    from fakes.telegram import (FakeTelegram, create_app as create_telegram_app)
+
+    moodle = FakeMoodle(args.courses, args.activities, args.events, args.file_size, args.lms_latency)
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    drive = FakeGDrive(args.drive_latency, args.drive_bandwidth * 1024 ** 2)
+    serve(create_moodle_app(moodle), lms_port)
+    serve(create_telegram_app(telegram), telegram_port)
+    import gdrive
+    gdrive.GDrive = lambda: drive
+
+    rss_before_bot = peak_rss_mb()
+    import lms_bot
+    import requests
+    threading.Thread(target=lms_bot.main, name='bot', daemon=True).start()
+    started = time.perf_counter()
+    while True:
+        try:
+            if telegram.webhook_url and requests.get(f'http://127.0.0.1:{bot_port}/health', timeout=1).ok:
+                break
+        except requests.RequestException:
+            pass
+        if time.perf_counter() - started > 30:
+            print('bot did not start')
+            sys.exit(1)
+        time.sleep(0.05)
+    print(f'bot started in {time.perf_counter() - started:.2f} s, redis: {redis_backend}')
+    # downloads are answered once drive is connected in background
+    while not lms_bot.startup.ready('drive') and time.perf_counter() - started < args.timeout:
+        time.sleep(0.05)
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    chat_ids = [100000 + idx for idx in range(args.users)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        finished = sum(executor.map(lambda chat_id: run_user(telegram, lms_bot.outbox, moodle, chat_id, recorder,
+                                                             args.timeout, random.Random(rng.random())), chat_ids))
+    wall = time.perf_counter() - started
+    steps = sum(len(latencies) for latencies in recorder.latencies.values())
+
+    for idx, course in enumerate(moodle.courses[:args.new_activities]):
+        moodle.add_activity(course['id'], f'فعالیت جدید {idx + 1}')
+        moodle.replace_file(course['id'], moodle.activities[course['id']][0]['id'])
+    with telegram._cond:
+        before = {chat_id: len(telegram.messages[chat_id]) for chat_id in chat_ids}
+    watched, watcher_seconds = run_cycle(lms_bot.course_watcher.scheduler)
+    chats, deadline_seconds = run_cycle(lms_bot.deadline_scheduler)
+    prefetch_seconds = wait_idle(lms_bot.download_queue.stats, args.timeout * 10)
+    wait_idle(lms_bot.outbox.stats, args.timeout)
+    with telegram._cond:
+        notified = sum(1 for chat_id in chat_ids for message in telegram.messages[chat_id][before[chat_id]:]
+                       if 'فعالیت های جدیدی' in (message.get('text') or ''))
+        modified = sum(1 for chat_id in chat_ids for message in telegram.messages[chat_id][before[chat_id]:]
+                       if 'تغییر کرد' in (message.get('text') or ''))
+
+    print(f'\nusers {args.users}  finished {finished}  concurrency {args.concurrency}  wall {wall:.2f} s  '
+          f'throughput {steps / wall:.1f} steps/s')
+    print(f'{"step":<12} {"count":>6} {"errors":>6} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    failed = False
+    for step in recorder.order:
+        latencies = recorder.latencies[step]
+        p99 = percentile(latencies, 0.99)
+        print(f'{step:<12} {len(latencies):>6} {recorder.errors[step]:>6} {percentile(latencies, 0.5) * 1000:>9.1f} '
+              f'{p99 * 1000:>9.1f} {max(latencies, default=0) * 1000:>9.1f}')
+        failed = failed or recorder.errors[step] > 0 or (args.max_p99 and p99 > args.max_p99)
+    interval = lms_bot.course_watcher.scheduler.interval
+    print(f'\ncourse watcher cycle  {watched} courses in {watcher_seconds:.2f} s, '
+          f'{watcher_seconds / interval * 100:.2f}% of its {interval:.0f} s interval')
+    interval = lms_bot.deadline_scheduler.interval
+    print(f'deadline cycle        {chats} chats in {deadline_seconds:.2f} s, '
+          f'{deadline_seconds / interval * 100:.2f}% of its {interval:.0f} s interval')
+    print(f'prefetch of new files {prefetch_seconds:.2f} s, {notified} new activity notifications, '
+          f'{modified} with replaced files')
+    print(f'lms requests {moodle.requests_count}, telegram requests {sum(telegram.requests_count.values())} '
+          f'with {telegram.uploads} uploads, '
+          f'drive {drive.stats()}')
+    print(f'startup {lms_bot.startup.stats()}')
+    print(f'peak rss {peak_rss_mb():.0f} MB, {peak_rss_mb() - rss_before_bot:.0f} MB after the bot was imported '
+          f'(fakes run in the same process)')
+    # bot threads do not stop by themselves
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+""" Compare BeautifulSoup and lxml parsers on hand-built pages shaped like the moodle pages the bot reads
+
+Usage: python bench/parsers_bench.py [repeat]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsers  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# fixture file -> parser name without soup_/lxml_ prefix
+CASES = [
+    ('login.html', 'parse_login_token'),
+    ('dashboard.html', 'parse_student_courses'),
+    ('course.html', 'parse_course_activities'),
+    ('events.html', 'parse_events'),
+    ('video.html', 'parse_video_source'),
+]
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def bench(func, content: bytes, repeat: int):
+    """ Best time of a parse in seconds """
+    return min(timeit.repeat(lambda: func(content), number=1, repeat=repeat))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    failed = False
+    print(f'{"page":<16}{"parser":<26}{"KB":>8}{"soup ms":>10}{"lxml ms":>10}{"soup MB/s":>11}{"lxml MB/s":>11}'
+          f'{"speedup":>9}  equal')
+    for fixture, name in CASES:
+        content = load_fixture(fixture)
+        soup_parse = getattr(parsers, f'soup_{name}')
+        lxml_parse = getattr(parsers, f'lxml_{name}')
+        equal = soup_parse(content) == lxml_parse(content)
+        failed = failed or not equal
+        soup_time = bench(soup_parse, content, repeat)
+        lxml_time = bench(lxml_parse, content, repeat)
+        size = len(content) / 1024
+        print(f'{fixture:<16}{name:<26}{size:>8.1f}{soup_time * 1000:>10.2f}{lxml_time * 1000:>10.2f}'
+              f'{size / 1024 / soup_time:>11.1f}{size / 1024 / lxml_time:>11.1f}{soup_time / lxml_time:>8.1f}x  {equal}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from telegram.error import (RetryAfter, Unauthorized, BadRequest, ChatMigrated, NetworkError)
+
+from outbox import delivered
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """ Send a message to all chats in background, chat ids are streamed from redis with SCAN and sent concurrently
+    under a global rate limit, state is saved after each batch so an interrupted broadcast resumes after a restart """
+
+    def __init__(self, db: redis.Redis, prefix: str = 'lms:broadcast', rate: float = 25, workers: int = 8,
+                 batch_size: int = 500, max_retries: int = 3, progress_interval: float = 10):
+        self.db = db
+        self.prefix = prefix
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        # seconds a crashed process keeps the broadcast locked
+        self.lock_ttl = 60
+        self.bot = None
+        # telegram allows about 30 messages per second to different chats, each chat gets one message
+        # so the per chat limit of one message per second is never reached
+        self.limiter = TokenBucket(rate)
+        self._lock = threading.Lock()
+        self._thread = None
+        # value of the lock, only the process that took it extends or releases it
+        self._owner = uuid.uuid4().hex
+        # flood wait asked by telegram applies to all sends
+        self._paused_until = 0
+
+    def _key(self, name: str):
+        return f'{self.prefix}:{name}'
+
+    def start(self, bot):
+        """ Set bot and resume a broadcast interrupted by a restart """
+        self.bot = bot
+        if self.db.hget(self._key('state'), 'status') == b'running':
+            self._run_in_background()
+
+    def is_running(self):
+        """ Check a broadcast is being sent by this or another process """
+        if self._thread is not None and self._thread.is_alive():
+            return True
+        return bool(self.db.exists(self._key('lock')))
+
+    def submit(self, text: str, admin_chat_id: int):
+        """ Start broadcasting text, returns False if another broadcast is running """
+        with self._lock:
+            if self.is_running():
+                return False
+            message = self.bot.send_message(admin_chat_id, 'ارسال پیام شروع شد.')
+            pipeline = self.db.pipeline()
+            pipeline.delete(self._key('state'), self._key('delivered'))
+            pipeline.hset(self._key('state'), mapping={
+                'text': text, 'admin_chat_id': admin_chat_id, 'message_id': message.message_id, 'cursor': 0,
+                'sent': 0, 'blocked': 0, 'failed': 0, 'retried': 0, 'status': 'running', 'started_at': time.time(),
+            })
+            pipeline.execute()
+            self._run_in_background()
+            return True
+
+    def cancel(self):
+        """ Stop running broadcast after the current batch """
+        if self.db.hget(self._key('state'), 'status') == b'running':
+            self.db.hset(self._key('state'), 'status', 'cancelled')
+            return True
+        return False
+
+    def state(self):
+        state = {key.decode(): value.decode() for key, value in self.db.hgetall(self._key('state')).items()}
+        for name in ('sent', 'blocked', 'failed', 'retried'):
+            state[name] = int(state.get(name, 0))
+        return state
+
+    def _run_in_background(self):
+        self._thread = threading.Thread(target=self._run, name='broadcast', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """ Send the broadcast when its lock is free, a lock left by a crashed process expires after lock_ttl and
+        a lock of a live process is released when its broadcast ends """
+        lock_key = self._key('lock')
+        while self.db.hget(self._key('state'), 'status') == b'running':
+            if not self.db.set(lock_key, self._owner, nx=True, ex=self.lock_ttl):
+                time.sleep(min(self.lock_ttl, 5))
+                continue
+            try:
+                self._send_all()
+            finally:
+                self._release_lock()
+            return
+
+    def _owns_lock(self, action):
+        """ Run action(pipeline) in a transaction if this process holds the lock, returns False if it does not """
+        lock_key = self._key('lock')
+        with self.db.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(lock_key)
+                    if pipeline.get(lock_key) != self._owner.encode():
+                        return False
+                    pipeline.multi()
+                    action(pipeline)
+                    pipeline.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    def _release_lock(self):
+        self._owns_lock(lambda pipeline: pipeline.delete(self._key('lock')))
+
+    def _send_all(self):
+        state = self.state()
+        text = state['text']
+        cursor = int(state['cursor'])
+        last_progress = 0
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='broadcast_sender') as executor:
+            while True:
+                if self.db.hget(self._key('state'), 'status') != b'running':
+                    break
+                if not self._owns_lock(lambda pipeline: pipeline.expire(self._key('lock'), self.lock_ttl)):
+                    # the lock expired and another process continues the broadcast
+                    return
+                cursor, keys = self.db.scan(cursor, count=self.batch_size)
+                # only chat ids are plain digits, other keys belong to other features
+                chat_ids = [int(key) for key in keys if key.decode().lstrip('-').isdigit()]
+                if chat_ids:
+                    # scan may return a key twice and a resumed batch is scanned again, skip delivered chats
+                    pipeline = self.db.pipeline(transaction=False)
+                    for chat_id in chat_ids:
+                        pipeline.sismember(self._key('delivered'), chat_id)
+                    chat_ids = [chat_id for chat_id, done in zip(chat_ids, pipeline.execute()) if not done]
+                results = list(executor.map(lambda chat_id: self._send(chat_id, text), chat_ids))
+                pipeline = self.db.pipeline()
+                for name in ('sent', 'blocked', 'failed', 'retried'):
+                    count = sum(result[name] for result in results)
+                    if count:
+                        pipeline.hincrby(self._key('state'), name, count)
+                pipeline.hset(self._key('state'), 'cursor', cursor)
+                pipeline.execute()
+                if cursor == 0:
+                    self.db.hset(self._key('state'), 'status', 'done')
+                    break
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    self._report()
+        self._report()
+
+    def _send(self, chat_id: int, text: str):
+        """ Send text to chat, retry flood waits and network errors, returns counts of the result """
+        result = {'sent': 0, 'blocked': 0, 'failed': 0, 'retried': 0}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                result['retried'] += 1
+            self._wait_flood()
+            self.limiter.wait()
+            try:
+                delivered(self.bot.send_message(chat_id, text))
+                result['sent'] = 1
+                self.db.sadd(self._key('delivered'), chat_id)
+                return result
+            except RetryAfter as e:
+                # telegram asks the whole bot to slow down, not only this chat
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            except Unauthorized:
+                # user blocked the bot or deleted the account
+                result['blocked'] = 1
+                return result
+            except ChatMigrated as e:
+                chat_id = e.new_chat_id
+            except BadRequest:
+                logger.exception('broadcast to chat %s was rejected', chat_id)
+                break
+            except NetworkError:
+                logger.exception('broadcast to chat %s failed, attempt %s', chat_id, attempt + 1)
+                time.sleep(2 ** attempt)
+        result['failed'] = 1
+        return result
+
+    def _wait_flood(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def progress_text(self, state: dict):
+        status = {'running': 'در حال ارسال', 'done': 'پایان ارسال', 'cancelled': 'ارسال لغو شد'}.get(state['status'])
+        elapsed = int(time.time() - float(state['started_at']))
+        return f'{status}\n' \
+               f'ارسال شده: {state["sent"]}\n' \
+               f'مسدود کرده: {state["blocked"]}\n' \
+               f'ناموفق: {state["failed"]}\n' \
+               f'تلاش دوباره: {state["retried"]}\n' \
+               f'زمان: {elapsed} ثانیه'
+
+    def _report(self):
+        """ Edit progress message of admin """
+        state = self.state()
+        try:
+            self.bot.edit_message_text(self.progress_text(state), state['admin_chat_id'], int(state['message_id']))
+        except Exception:
+            # progress is best effort, e.g. telegram rejects an unchanged text
+            logger.exception('broadcast progress could not be updated')
+
+    def stats(self):
+        state = self.state()
+        if not state.get('status'):
+            return {}
+        return {name: state[name] for name in ('status', 'sent', 'blocked', 'failed', 'retried')}
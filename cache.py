@@ -0,0 +1,123 @@
+import logging
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+from cachetools import (LRUCache, TTLCache)
+
+logger = logging.getLogger(__name__)
+
+
+class TwoTierCache:
+    """ Read through cache with an in process lru in front of redis, entries keep the time they were loaded and the
+    versions of their tags, invalidating a tag makes all entries loaded before it misses in every process, in this
+    process at once and in others within version_ttl seconds since tag versions are kept locally for that long """
+
+    def __init__(self, db: redis.Redis, prefix: str = 'lms:cache', maxsize: int = 2048, workers: int = 2,
+                 version_ttl: float = 2):
+        self.db = db
+        self.prefix = prefix
+        self._local = LRUCache(maxsize)
+        # tag -> version, so a local hit does not read redis
+        self._tag_versions = TTLCache(maxsize * 2, version_ttl)
+        self._lock = threading.Lock()
+        # keys being reloaded in background
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='cache_refresh')
+        self._counts = {'local': 0, 'redis': 0, 'stale': 0, 'miss': 0}
+
+    def _key(self, name: str):
+        return f'{self.prefix}:{name}'
+
+    def _versions(self, tags: tuple):
+        if not tags:
+            return ()
+        with self._lock:
+            versions = [self._tag_versions.get(str(tag)) for tag in tags]
+        missing = [str(tag) for tag, version in zip(tags, versions) if version is None]
+        if missing:
+            read = {tag: int(version or 0) for tag, version in
+                    zip(missing, self.db.mget([self._key(f'tag:{tag}') for tag in missing]))}
+            with self._lock:
+                self._tag_versions.update(read)
+            versions = [read[str(tag)] if version is None else version for tag, version in zip(tags, versions)]
+        return tuple(versions)
+
+    def _lookup(self, key: str):
+        with self._lock:
+            entry = self._local.get(key)
+        if entry is not None:
+            return entry, 'local'
+        blob = self.db.get(self._key(key))
+        if blob is None:
+            return None, 'miss'
+        entry = pickle.loads(blob)
+        with self._lock:
+            self._local[key] = entry
+        return entry, 'redis'
+
+    def get(self, key: str, loader, ttl: float, stale_ttl: float, tags: tuple = ()):
+        """ Value of key, loader() returns (value, msg) like scraper functions and is called on a miss,
+        a value older than ttl is still returned and reloaded in background until it is older than stale_ttl """
+        versions = self._versions(tags)
+        entry, tier = self._lookup(key)
+        if entry is not None:
+            loaded_at, entry_versions, value = entry
+            age = time.time() - loaded_at
+            if entry_versions == versions and age < stale_ttl:
+                if age >= ttl:
+                    tier = 'stale'
+                    self._refresh(key, loader, stale_ttl, tags)
+                self._count(tier)
+                return value, ''
+        self._count('miss')
+        return self._load(key, loader, stale_ttl, versions)
+
+    def set(self, key: str, value, stale_ttl: float, tags: tuple = ()):
+        self._store(key, value, stale_ttl, self._versions(tags))
+
+    def invalidate(self, tag):
+        """ Make entries of tag miss, e.g. a course that got new activities """
+        version = self.db.incr(self._key(f'tag:{tag}'))
+        with self._lock:
+            self._tag_versions[str(tag)] = version
+
+    def _store(self, key: str, value, stale_ttl: float, versions: tuple):
+        entry = (time.time(), versions, value)
+        with self._lock:
+            self._local[key] = entry
+        self.db.set(self._key(key), pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL), ex=int(stale_ttl))
+
+    def _load(self, key: str, loader, stale_ttl: float, versions: tuple):
+        # versions are read before loading, a value loaded while its tag is invalidated is a miss next time
+        value, msg = loader()
+        if value is not None:
+            self._store(key, value, stale_ttl, versions)
+        return value, msg
+
+    def _refresh(self, key: str, loader, stale_ttl: float, tags: tuple):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self._executor.submit(self._background_load, key, loader, stale_ttl, tags)
+
+    def _background_load(self, key: str, loader, stale_ttl: float, tags: tuple):
+        try:
+            self._load(key, loader, stale_ttl, self._versions(tags))
+        except Exception:
+            logger.exception('%s could not be loaded in background', key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _count(self, tier: str):
+        with self._lock:
+            self._counts[tier] += 1
+
+    def stats(self):
+        """ Hits of each tier, stale hits reloaded in background and misses loaded from lms """
+        with self._lock:
+            return {'size': len(self._local), **self._counts}
@@ -0,0 +1,117 @@
+import threading
+import time
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitBreaker:
+    """ Closed while calls succeed, opens after failure_threshold failures in a row and rejects calls for
+    reset_timeout seconds, then lets one trial call through, success closes it and failure opens it again
+    for twice as long up to max_reset_timeout """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 15, max_reset_timeout: float = 120):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._opened_at = 0
+        self._trial_at = 0
+        self._opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() >= self._opened_at + self._timeout:
+                return HALF_OPEN
+            return self._state
+
+    def retry_after(self):
+        """ Seconds until a trial call is let through, 0 if calls are allowed """
+        with self._lock:
+            if self._state == CLOSED:
+                return 0
+            return max(0.0, self._opened_at + self._timeout - time.monotonic())
+
+    def allow(self):
+        """ Check a call may be made, an allowed call must be followed by success() or failure() """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self._state == OPEN and now >= self._opened_at + self._timeout:
+                self._state = HALF_OPEN
+                self._trial_at = now
+                return True
+            # a trial call that never reported back does not keep the circuit half open forever
+            if self._state == HALF_OPEN and now - self._trial_at > self._timeout:
+                self._trial_at = now
+                return True
+            self._rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._timeout = self.reset_timeout
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self._state == CLOSED and self._failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._opened += 1
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            return {'state': state, 'open': int(state != CLOSED), 'failures_in_row': self._failures,
+                    'opened': self._opened, 'rejected': self._rejected}
+
+
+class RetryBudget:
+    """ Retries limited to a ratio of requests, so retries do not multiply load on a server that is already
+    overloaded, min_retries per second are always allowed for a quiet bot """
+
+    def __init__(self, ratio: float = 0.2, min_retries: float = 1, capacity: float = 20):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self.retried = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        """ Count a first attempt of a request """
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """ Take a retry from budget, returns False when budget is spent """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.min_retries)
+            self._updated = now
+            if self._tokens < 1:
+                self.exhausted += 1
+                return False
+            self._tokens -= 1
+            self.retried += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'tokens': self._tokens, 'retried': self.retried, 'exhausted': self.exhausted}
@@ -0,0 +1,120 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import redis
+from cryptography.fernet import (Fernet, InvalidToken)
+
+from async_scraper import LMSSession
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(session: LMSSession):
+    cookies = sorted(session.cookies.get_dict().items())
+    return hashlib.md5(json.dumps([cookies, session.ws_token]).encode()).digest()
+
+
+class CookieStore:
+    """ Lms cookies and web service token of each chat encrypted in redis, so a session is restored after a restart
+    without a new login, a record is kept for twice the longest time a session was seen to stay valid without use """
+
+    def __init__(self, db: redis.Redis, secret: str, prefix: str = 'lms:cookies', lifetime: float = 6 * 60 * 60,
+                 max_lifetime: float = 7 * 24 * 60 * 60, refresh_interval: float = 10 * 60):
+        self.db = db
+        # any secret works, fernet needs 32 url safe base64 encoded bytes
+        self.fernet = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest()))
+        self.prefix = prefix
+        self.default_lifetime = lifetime
+        self.max_lifetime = max_lifetime
+        # a record is written again when cookies changed or after this many seconds, to extend its expiry
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._lifetime = None
+        # chat_id -> (digest of cookies, monotonic time saved, monotonic time last seen valid)
+        self._seen = {}
+        self._counts = {'saved': 0, 'restored': 0, 'missing': 0, 'expired': 0}
+
+    def _key(self, chat_id: int):
+        return f'{self.prefix}:{chat_id}'
+
+    @property
+    def lifetime(self):
+        """ Longest seconds a session was seen to stay valid without use, loaded from redis on first use """
+        if self._lifetime is None:
+            stored = self.db.get(f'{self.prefix}:lifetime')
+            self._lifetime = float(stored) if stored else self.default_lifetime
+        return self._lifetime
+
+    def _observe_idle(self, idle: float):
+        if idle > self.lifetime:
+            self._lifetime = min(idle, self.max_lifetime)
+            self.db.set(f'{self.prefix}:lifetime', self._lifetime)
+
+    def save(self, chat_id: int, session: LMSSession):
+        cookies = [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path,
+                    'expires': cookie.expires, 'secure': cookie.secure} for cookie in session.cookies]
+        record = {'cookies': cookies, 'ws_token': session.ws_token, 'ws_userid': session.ws_userid,
+                  'seen_at': time.time()}
+        ttl = self.lifetime * 2
+        # moodle session cookie has no expiry, a record is not kept past the expiry of all cookies that have one
+        expiries = [cookie['expires'] for cookie in cookies if cookie['expires']]
+        if expiries and len(expiries) == len(cookies):
+            ttl = min(ttl, max(expiries) - time.time())
+        self.db.set(self._key(chat_id), self.fernet.encrypt(json.dumps(record).encode()), ex=max(60, int(ttl)))
+        now = time.monotonic()
+        with self._lock:
+            self._seen[chat_id] = (_digest(session), now, now)
+            self._counts['saved'] += 1
+
+    def load(self, chat_id: int):
+        """ Saved session of chat, None if there is none or it is older than sessions live """
+        blob = self.db.get(self._key(chat_id))
+        if blob is None:
+            with self._lock:
+                self._counts['missing'] += 1
+            return None
+        try:
+            record = json.loads(self.fernet.decrypt(blob))
+        except InvalidToken:
+            # secret was changed
+            logger.exception('cookies of chat %s could not be decrypted', chat_id)
+            self.db.delete(self._key(chat_id))
+            return None
+        session = LMSSession()
+        for cookie in record['cookies']:
+            session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'],
+                                expires=cookie['expires'], secure=cookie['secure'])
+        session.ws_token = record['ws_token']
+        session.ws_userid = record['ws_userid']
+        seen_at = time.monotonic() - (time.time() - record['seen_at'])
+        with self._lock:
+            self._seen[chat_id] = (_digest(session), seen_at, seen_at)
+            self._counts['restored'] += 1
+        return session
+
+    def seen(self, chat_id: int, session: LMSSession):
+        """ Session of chat just answered a request, the record is updated if cookies changed or it is old """
+        now = time.monotonic()
+        with self._lock:
+            digest, saved_at, seen_at = self._seen.get(chat_id, (None, 0, now))
+            self._seen[chat_id] = (digest, saved_at, now)
+        self._observe_idle(now - seen_at)
+        if digest != _digest(session) or now - saved_at > self.refresh_interval:
+            self.save(chat_id, session)
+
+    def forget(self, chat_id: int, expired: bool = False):
+        """ Remove saved session, after lms rejected it or the user logged out """
+        with self._lock:
+            self._seen.pop(chat_id, None)
+            if expired:
+                self._counts['expired'] += 1
+        self.db.delete(self._key(chat_id))
+
+    def stats(self):
+        """ Saved, restored, missing and expired sessions and learned lifetime in hours """
+        with self._lock:
+            return {'lifetime_hours': (self._lifetime or self.default_lifetime) / 60 / 60, **self._counts}
@@ -0,0 +1,144 @@
+import json
+import logging
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineIndex:
+    """ Reminders of event deadlines in a redis sorted set scored by the time to send them, each pending event gets
+    one reminder for each offset before its deadline, e.g. 24 and 2 hours, an event is kept until its last reminder
+    is sent """
+
+    def __init__(self, db: redis.Redis, offsets: tuple = (24 * 60 * 60, 2 * 60 * 60), prefix: str = 'lms:deadlines',
+                 max_wait: float = 60):
+        self.db = db
+        self.offsets = sorted(offsets, reverse=True)
+        self.prefix = prefix
+        self.max_wait = max_wait
+        self.callback = None
+        # chats of other processes are skipped when users are sharded, set to a function of chat_id
+        self.owns = None
+        self._wake = threading.Event()
+        self._sent = 0
+
+    def _key(self, name: str):
+        return f'{self.prefix}:{name}'
+
+    def update(self, chat_id: int, events: list):
+        """ Index deadlines of pending events of chat, reminders of events that are done or gone are removed """
+        now = time.time()
+        reminders = {}
+        indexed = set()
+        pipeline = self.db.pipeline(transaction=False)
+        for event in events:
+            event_key = f'{chat_id}:{event["id"]}'
+            if event.get('timestamp') and 'نشده' in event['status']:
+                for offset in self.offsets:
+                    if event['timestamp'] - offset > now:
+                        reminders[f'{event_key}:{offset}'] = event['timestamp'] - offset
+                        indexed.add(event_key)
+            if event_key in indexed:
+                pipeline.hset(self._key('events'), event_key, json.dumps(event))
+            else:
+                # also an event saved before only events with reminders were kept
+                pipeline.hdel(self._key('events'), event_key)
+        chat_key = self._key(f'chat:{chat_id}')
+        events_key = self._key(f'chat_events:{chat_id}')
+        old_reminders = {member.decode() for member in self.db.smembers(chat_key)}
+        gone = old_reminders - set(reminders)
+        if gone:
+            pipeline.zrem(self._key('reminders'), *gone)
+            pipeline.srem(chat_key, *gone)
+        gone_events = {event_key.decode() for event_key in self.db.smembers(events_key)} - indexed
+        if gone_events:
+            pipeline.hdel(self._key('events'), *gone_events)
+            pipeline.srem(events_key, *gone_events)
+        if indexed:
+            pipeline.sadd(events_key, *indexed)
+        if reminders:
+            # existing reminders are added again too, a moved deadline moves them
+            pipeline.zadd(self._key('reminders'), reminders, ch=True)
+            pipeline.sadd(chat_key, *reminders)
+        results = pipeline.execute()
+        if reminders and results[-2]:
+            # a new or moved reminder may be due before the loop wakes up
+            self._wake.set()
+
+    def remove(self, chat_id: int):
+        """ Remove all reminders and events of chat """
+        chat_key = self._key(f'chat:{chat_id}')
+        events_key = self._key(f'chat_events:{chat_id}')
+        members = self.db.smembers(chat_key)
+        event_keys = {event_key.decode() for event_key in self.db.smembers(events_key)}
+        if members:
+            self.db.zrem(self._key('reminders'), *members)
+            # events indexed before events of each chat were kept in a set
+            event_keys.update(member.decode().rsplit(':', 1)[0] for member in members)
+        if event_keys:
+            self.db.hdel(self._key('events'), *event_keys)
+        self.db.delete(chat_key, events_key)
+
+    def start(self, callback):
+        """ Send due reminders with callback(chat_id, [(event, offset), ...]) in a background thread """
+        self.callback = callback
+        threading.Thread(target=self._run, name='deadline_reminders', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._send_due()
+                head = self.db.zrange(self._key('reminders'), 0, 0, withscores=True)
+                wait = self.max_wait if not head else min(self.max_wait, head[0][1] - time.time())
+            except redis.RedisError:
+                logger.exception('deadline reminders could not be read')
+                wait = self.max_wait
+            self._wake.wait(max(wait, 0))
+            self._wake.clear()
+
+    def _send_due(self):
+        now = time.time()
+        due = self.db.zrangebyscore(self._key('reminders'), '-inf', now)
+        by_chat = {}
+        for member in due:
+            member = member.decode()
+            chat_id, event_id, offset = member.rsplit(':', 2)
+            chat_id = int(chat_id)
+            if self.owns and not self.owns(chat_id):
+                continue
+            # zrem claims the reminder, only one process sends it
+            if not self.db.zrem(self._key('reminders'), member):
+                continue
+            self.db.srem(self._key(f'chat:{chat_id}'), member)
+            event_key = f'{chat_id}:{event_id}'
+            event = self.db.hget(self._key('events'), event_key)
+            if event is None:
+                continue
+            pipeline = self.db.pipeline(transaction=False)
+            for other_offset in self.offsets:
+                pipeline.zscore(self._key('reminders'), f'{event_key}:{other_offset}')
+            if all(score is None for score in pipeline.execute()):
+                # last reminder of the event
+                pipeline.hdel(self._key('events'), event_key)
+                pipeline.srem(self._key(f'chat_events:{chat_id}'), event_key)
+                pipeline.execute()
+            event = json.loads(event)
+            # reminders missed while the bot was down are sent only if the deadline has not passed
+            if event['timestamp'] > now:
+                # after a long downtime only the nearest reminder of an event is sent
+                reminders = by_chat.setdefault(chat_id, {})
+                reminders[event_id] = min(reminders.get(event_id, (event, int(offset))), (event, int(offset)),
+                                          key=lambda reminder: reminder[1])
+        for chat_id, reminders in by_chat.items():
+            reminders = list(reminders.values())
+            try:
+                self.callback(chat_id, reminders)
+                self._sent += len(reminders)
+            except Exception:
+                logger.exception('deadline reminders of chat %s could not be sent', chat_id)
+
+    def stats(self):
+        return {'reminders': self.db.zcard(self._key('reminders')), 'sent': self._sent}
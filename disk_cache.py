@@ -0,0 +1,132 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class DiskCache:
+    """ Downloaded files on disk under a byte budget, least recently used files are removed first except the files
+    pinned by a running job, a file is written to a temporary name and renamed when it is complete """
+
+    def __init__(self, root: str = './files', max_bytes: int = 2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (path, size), least recently used first
+        self._entries = OrderedDict()
+        # key -> number of jobs using it
+        self._pins = {}
+        self._size = 0
+        self._counts = {'hits': 0, 'misses': 0, 'evicted': 0}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """ Index files left by last run, temporary files of interrupted downloads and files of the old layout are
+        removed """
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                _remove(path)
+                continue
+            files = os.listdir(path)
+            if len(files) != 1:
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            file_path = os.path.join(path, files[0])
+            stat = os.stat(file_path)
+            entries.append((stat.st_atime, name, file_path, stat.st_size))
+        for _, key, path, size in sorted(entries):
+            self._entries[key] = (path, size)
+            self._size += size
+        self._evict()
+
+    def get(self, key: str, max_age: float = None):
+        """ Path of cached file of key, None if it is not cached or older than max_age seconds """
+        with self._lock:
+            entry = self._entries.get(key)
+            # an old file is replaced by the next write of key
+            if entry and max_age is not None and time.time() - os.path.getmtime(entry[0]) > max_age:
+                entry = None
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts['hits'] += 1
+            return entry[0]
+
+    def path(self, key: str):
+        """ Path of cached file of key without marking it used, e.g. right after writing it """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    @contextmanager
+    def pin(self, key: str):
+        """ Keep file of key while a job uses it, including a file written inside the block """
+        with self._lock:
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+                # a pinned file may have kept the cache over its budget
+                self._evict()
+
+    @contextmanager
+    def write(self, key: str, filename: str):
+        """ Yield a temporary path to write the file of key, it is added to cache as filename when the block
+        finishes and removed if the block fails """
+        temp_path = os.path.join(self.root, f'.tmp-{uuid.uuid4().hex}')
+        try:
+            yield temp_path
+        except BaseException:
+            _remove(temp_path)
+            raise
+        directory = os.path.join(self.root, key)
+        path = os.path.join(directory, filename)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            os.makedirs(directory, exist_ok=True)
+            # rename is atomic, a reader never sees a partial file
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+            self._entries[key] = (path, size)
+            self._size += size
+            self._evict()
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            if key not in self._pins:
+                self._drop(key)
+                self._counts['evicted'] += 1
+
+    def _drop(self, key: str):
+        path, size = self._entries.pop(key)
+        self._size -= size
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'size_mb': self._size / 1024 ** 2, 'pinned': len(self._pins),
+                    **self._counts}
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
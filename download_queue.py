@@ -0,0 +1,83 @@
+import itertools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    def __init__(self, key, func):
+        self.key = key
+        self.func = func
+        self.callbacks = []
+
+
+class DownloadQueue:
+    """ Fixed size pool of download workers, requests with the same key share one job,
+    jobs with lower priority number run first, e.g. a user request before a prefetch """
+
+    def __init__(self, workers: int):
+        self._workers = workers
+        self._queue = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._order = itertools.count()
+        # key -> job, for queued and running jobs
+        self._jobs = {}
+        # key -> (priority, order) of queued jobs, used for queue position
+        self._waiting = {}
+        for idx in range(workers):
+            threading.Thread(target=self._work, name=f'download_worker_{idx}', daemon=True).start()
+
+    def submit(self, key, func, callback, priority: int = 0):
+        """ Run func once for key and call callback(result, error) when it finishes,
+        returns (position in queue, True if joined an existing job), position 0 means running """
+        with self._lock:
+            job = self._jobs.get(key)
+            joined = job is not None
+            if not joined:
+                job = _Job(key, func)
+                self._jobs[key] = job
+            if not joined or (key in self._waiting and priority < self._waiting[key][0]):
+                # a queued job joined with a lower priority number is queued again, the old entry is skipped
+                self._waiting[key] = (priority, next(self._order))
+                self._queue.put((*self._waiting[key], job))
+            job.callbacks.append(callback)
+            return self._position(key), joined
+
+    def _position(self, key):
+        if key not in self._waiting:
+            return 0
+        # queued jobs up to the number of idle workers start right away
+        idle_workers = self._workers - (len(self._jobs) - len(self._waiting))
+        ahead = sum(1 for entry in self._waiting.values() if entry <= self._waiting[key])
+        return max(0, ahead - idle_workers)
+
+    def stats(self):
+        """ Number of queued and running jobs """
+        with self._lock:
+            return {'queued': len(self._waiting), 'running': len(self._jobs) - len(self._waiting)}
+
+    def _work(self):
+        while True:
+            priority, order, job = self._queue.get()
+            with self._lock:
+                if self._waiting.get(job.key) != (priority, order) or self._jobs.get(job.key) is not job:
+                    self._queue.task_done()
+                    continue
+                del self._waiting[job.key]
+            result, error = None, None
+            try:
+                result = job.func()
+            except Exception as e:
+                error = e
+            with self._lock:
+                # later requests for the same key start a new job
+                del self._jobs[job.key]
+                callbacks = list(job.callbacks)
+            for callback in callbacks:
+                try:
+                    callback(result, error)
+                except Exception:
+                    logger.exception('callback of download %s failed', job.key)
+            self._queue.task_done()
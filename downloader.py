@@ -0,0 +1,54 @@
+import time
+
+import requests
+
+# Size of each chunk moved from lms to disk and from disk to google drive
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class ProgressReporter:
+    """ Edit a chat message with the progress of a download or upload, throttled to avoid flooding telegram """
+
+    def __init__(self, message, title: str, min_interval: float = 3, min_step: int = 10):
+        self.message = message
+        self.title = title
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self._last_time = 0
+        self._last_percent = -min_step
+
+    def __call__(self, done: int, total: int = None):
+        now = time.monotonic()
+        if total:
+            percent = min(100, done * 100 // total)
+            if percent < 100 and (percent - self._last_percent < self.min_step or now - self._last_time < self.min_interval):
+                return
+            self._last_percent = percent
+            text = f'{self.title}   {percent}%'
+        else:
+            if now - self._last_time < self.min_interval:
+                return
+            text = f'{self.title}   {done // (1024 * 1024)} MB'
+        self._last_time = now
+        try:
+            self.message.edit_text(text)
+        except Exception:
+            # progress is best effort, e.g. telegram rejects an unchanged text
+            pass
+
+
+def stream_to_file(response: requests.Response, filename: str, progress=None, digest=None):
+    """ Write a streamed response to disk chunk by chunk, memory use does not depend on file size,
+    digest is updated with the content if it is given, e.g. a hashlib object """
+    total = int(response.headers.get('Content-Length', 0)) or None
+    done = 0
+    with open(filename, 'wb') as file:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            file.write(chunk)
+            if digest:
+                digest.update(chunk)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+    return done
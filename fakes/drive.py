@@ -0,0 +1,82 @@
+""" In process fake of the google drive client of the bot, for running downloads offline
+
+Usage: replace gdrive.GDrive before lms_bot is imported, e.g. gdrive.GDrive = lambda: FakeGDrive(latency=0.2)
+Uploads are read from disk like the real client and slowed down to bandwidth bytes per second.
+"""
+import itertools
+import os
+import threading
+import time
+
+# Size of each chunk of a resumable upload, the real client reports progress after each chunk
+CHUNK_SIZE = 1024 * 1024
+
+
+class FakeAuth:
+    access_token_expired = False
+
+
+class FakeFile(dict):
+    def __init__(self, drive, **fields):
+        super().__init__(**fields)
+        self._drive = drive
+
+    def InsertPermission(self, permission: dict):
+        self._drive.delay()
+        self['permissions'] = [permission]
+
+
+class FakeGDrive:
+    """ Drive files kept in memory without their content, each api call waits latency seconds """
+
+    def __init__(self, latency: float = 0, bandwidth: float = 0):
+        self.latency = latency
+        # upload bytes per second, 0 is unlimited
+        self.bandwidth = bandwidth
+        self.auth = FakeAuth()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # file id -> title
+        self.files = {}
+        self.uploaded_bytes = 0
+        self.calls = 0
+
+    def delay(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def login(self):
+        self.delay()
+
+    def get_folder(self, folder_name):
+        self.delay()
+        return {'id': f'folder-{folder_name}', 'title': folder_name}
+
+    def file_exists(self, file_id):
+        self.delay()
+        with self._lock:
+            return file_id in self.files
+
+    def upload_new_file_resumable(self, file, folder, chunk_size, progress=None):
+        self.delay()
+        total = os.path.getsize(file)
+        done = 0
+        with open(file, 'rb') as content:
+            for chunk in iter(lambda: content.read(chunk_size or CHUNK_SIZE), b''):
+                done += len(chunk)
+                if self.bandwidth:
+                    time.sleep(len(chunk) / self.bandwidth)
+                if progress:
+                    progress(done, total)
+        with self._lock:
+            file_id = f'fake{next(self._ids)}'
+            self.files[file_id] = os.path.basename(file)
+            self.uploaded_bytes += done
+        return FakeFile(self, id=file_id, title=os.path.basename(file), parents=[{'id': folder['id']}],
+                        webContentLink=f'https://drive.google.com/uc?id={file_id}&export=download')
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'files': len(self.files), 'uploaded_mb': self.uploaded_bytes / 1024 ** 2}
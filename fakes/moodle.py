@@ -0,0 +1,280 @@
+""" Local fake of vlms.ub.ac.ir serving the html pages and web service functions the bot uses
+
+Usage: python -m fakes.moodle [--port 8000] [--latency 0.2] [--courses 8] [--activities 40] [--events 20]
+Then run the bot with LMS_BASE_URL=http://127.0.0.1:8000/ and any username with password "password".
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import secrets
+import threading
+import time
+from html import escape
+
+from flask import Flask, Response, request, redirect
+
+from parsers import (format_deadline, TIMEZONE)
+
+LESSONS = ['ساختمان داده', 'طراحی الگوریتم', 'سیستم عامل', 'پایگاه داده', 'شبکه های کامپیوتری', 'هوش مصنوعی',
+           'معماری کامپیوتر', 'زبان تخصصی', 'ریاضی گسسته', 'مدار منطقی']
+
+
+def _flag(*parts):
+    """ Stable pseudo random bit for a user and an item """
+    return hashlib.md5('/'.join(map(str, parts)).encode()).digest()[0] % 2 == 1
+
+
+class FakeMoodle:
+    """ In memory moodle with courses, activities and events shared by all users """
+
+    def __init__(self, courses: int = 8, activities: int = 40, events: int = 20, file_size: int = 1024 * 1024,
+                 latency: float = 0, password: str = 'password', ws_enabled: bool = True):
+        self.latency = latency
+        self.password = password
+        self.ws_enabled = ws_enabled
+        self.file_size = file_size
+        self._lock = threading.Lock()
+        # session cookie or token -> username
+        self.sessions = {}
+        self.tokens = {}
+        self.requests_count = 0
+        self.courses = [{'id': 1200 + idx * 7, 'name': f'{LESSONS[idx % len(LESSONS)]} (گروه {idx // len(LESSONS) + 1})'}
+                        for idx in range(courses)]
+        self.activities = {}
+        for course in self.courses:
+            self.activities[course['id']] = [
+                {'id': course['id'] * 100 + idx, 'name': f'جلسه {idx + 1} - {course["name"]}', 'modified': 0}
+                for idx in range(activities)]
+        # deadlines are set to the minute like on lms
+        now = int(time.time()) // 60 * 60
+        self.events = []
+        for idx in range(events):
+            course = self.courses[idx % len(self.courses)]
+            kind = ['assign', 'quiz'][idx % 2]
+            name = f'تمرین شماره {idx + 1}' if kind == 'assign' else f'آزمون {idx + 1} closes'
+            self.events.append({'id': 9000 + idx, 'name': name, 'course': course, 'kind': kind,
+                                'time': now + (idx + 1) * 3 * 60 * 60})
+
+    def add_activity(self, course_id: int, name: str):
+        """ Publish a new activity, used to trigger new activity alerts """
+        with self._lock:
+            activities = self.activities[course_id]
+            activity = {'id': course_id * 100 + len(activities), 'name': name, 'modified': 0}
+            activities.append(activity)
+            return activity
+
+    def replace_file(self, course_id: int, activity_id: int):
+        """ Upload a new file for an activity, used to trigger modified activity alerts """
+        with self._lock:
+            for activity in self.activities[course_id]:
+                if activity['id'] == activity_id:
+                    activity['modified'] += 1
+                    return activity
+
+    def login(self, username: str, password: str):
+        if password != self.password:
+            return None
+        with self._lock:
+            cookie = secrets.token_hex(16)
+            self.sessions[cookie] = username
+            return cookie
+
+    def create_token(self, username: str, password: str):
+        if password != self.password:
+            return None
+        with self._lock:
+            token = secrets.token_hex(16)
+            self.tokens[token] = username
+            return token
+
+    def viewed(self, username: str, activity_id: int):
+        return _flag(username, activity_id)
+
+    def submitted(self, username: str, event_id: int):
+        return _flag(username, 'event', event_id)
+
+
+def _page(title: str, body: str):
+    return f'<!DOCTYPE html><html dir="rtl" lang="fa"><head><meta charset="utf-8"><title>{title}</title></head>' \
+           f'<body><div id="page">{body}</div></body></html>'
+
+
+def create_app(moodle: FakeMoodle):
+    app = Flask(__name__)
+
+    def base_url():
+        return request.host_url
+
+    def current_user():
+        return moodle.sessions.get(request.cookies.get('MoodleSession'))
+
+    def login_page():
+        response = Response(_page('ورود به سامانه', '<form action="login/index.php" method="post">'
+                                  f'<input type="hidden" name="logintoken" value="{secrets.token_hex(8)}">'
+                                  '<button id="loginbtn">ورود به سامانه</button></form>'))
+        if 'MoodleSession' not in request.cookies:
+            response.set_cookie('MoodleSession', 'guest', path='/')
+        return response
+
+    @app.before_request
+    def delay():
+        with moodle._lock:
+            moodle.requests_count += 1
+        if moodle.latency:
+            time.sleep(moodle.latency)
+
+    @app.route('/login/index.php', methods=['GET', 'POST'])
+    def login():
+        if request.method == 'GET':
+            return login_page()
+        cookie = moodle.login(request.form.get('username'), request.form.get('password'))
+        if not cookie:
+            return Response(_page('ورود به سامانه', '<div class="alert">نام کاربری یا رمز ورود نامعتبر است.</div>'))
+        response = redirect(f'{base_url()}my/', code=303)
+        response.set_cookie('MoodleSession', cookie, path='/')
+        return response
+
+    @app.route('/my/')
+    def dashboard():
+        if not current_user():
+            return login_page()
+        items = ''.join(f'<a class="dropdown-item" role="menuitem" href="{base_url()}course/view.php?id={course["id"]}">'
+                        f'{escape(course["name"])}</a>' for course in moodle.courses)
+        return _page('داشبورد', f'<div class="dropdown-menu">{items}</div>')
+
+    @app.route('/course/view.php')
+    def course():
+        username = current_user()
+        if not username:
+            return login_page()
+        body = ''
+        for activity in moodle.activities.get(int(request.args.get('id', 0)), []):
+            state = '0' if moodle.viewed(username, activity['id']) else '1'
+            body += f'<li class="activity resource" id="module-{activity["id"]}">' \
+                    f'<span class="resourcelinkdetails">{moodle.file_size // 1024}KB PDF document ' \
+                    f'Uploaded {activity["modified"]}</span><form class="togglecompletion" method="post">' \
+                    f'<input type="hidden" name="id" value="{activity["id"]}" />' \
+                    f'<input type="hidden" name="modulename" value="{escape(activity["name"])}" />' \
+                    f'<input type="hidden" name="completionstate" value="{state}" /></form></li>'
+        return _page('درس', f'<ul class="section">{body}</ul>')
+
+    @app.route('/calendar/view.php')
+    def calendar():
+        username = current_user()
+        if not username:
+            return login_page()
+        body = ''
+        for event in moodle.events:
+            footer = ''
+            if event['kind'] == 'assign':
+                link = 'رفتن به فعالیت' if moodle.submitted(username, event['id']) else 'افزودن تحویلی'
+                footer = f'<div class="card-footer"><a class="card-link" href="#">{link}</a></div>'
+            # day is a link to the day view of calendar like on lms, the clock follows it
+            day, clock = format_deadline(event['time']).rsplit(', ', 1)
+            midnight = datetime.datetime.fromtimestamp(event['time'], TIMEZONE).replace(hour=0, minute=0, second=0)
+            day_link = f'<a href="{base_url()}calendar/view.php?view=day&amp;time={int(midnight.timestamp())}">' \
+                       f'{day}</a>, {clock}'
+            body += f'<div class="event" data-event-id="{event["id"]}"><div class="card">' \
+                    f'<div class="card-header"><h3 class="name">{escape(event["name"])}</h3></div>' \
+                    f'<div class="description card-body"><div class="row">{day_link}</div>' \
+                    f'<div class="row">{escape(event["course"]["name"])}</div></div>{footer}</div></div>'
+        return _page('رویدادهای پیش رو', f'<div class="eventlist">{body}</div>')
+
+    @app.route('/mod/resource/view.php')
+    def resource():
+        if not current_user():
+            return login_page()
+        activity_id = int(request.args.get('id', 0))
+        if activity_id % 2:
+            return _page('ویدیو', f'<video><source src="{base_url()}pluginfile.php/{activity_id}/video.mp4" '
+                                  f'type="video/mp4" /></video>')
+        return file_response(f'file-{activity_id}.pdf')
+
+    @app.route('/pluginfile.php/<int:activity_id>/<name>')
+    def pluginfile(activity_id, name):
+        if not current_user():
+            return login_page()
+        return file_response(name)
+
+    def file_response(name: str):
+        chunk = b'\0' * 64 * 1024
+
+        def generate():
+            # each file starts with its name so files of different activities have different content
+            first = name.encode()[:moodle.file_size]
+            yield first
+            left = moodle.file_size - len(first)
+            while left > 0:
+                yield chunk[:min(left, len(chunk))]
+                left -= len(chunk)
+
+        return Response(generate(), headers={'Content-Disposition': f'attachment; filename="{name}"',
+                                             'Content-Length': str(moodle.file_size)})
+
+    @app.route('/login/token.php', methods=['POST'])
+    def token():
+        if not moodle.ws_enabled:
+            return {'error': 'Web services must be enabled', 'errorcode': 'enablewsdescription'}
+        token = moodle.create_token(request.form.get('username'), request.form.get('password'))
+        if not token:
+            return {'error': 'Invalid login', 'errorcode': 'invalidlogin'}
+        return {'token': token}
+
+    @app.route('/webservice/rest/server.php', methods=['GET', 'POST'])
+    def webservice():
+        params = request.values
+        username = moodle.tokens.get(params.get('wstoken'))
+        if not moodle.ws_enabled or not username:
+            result = {'exception': 'moodle_exception', 'errorcode': 'invalidtoken', 'message': 'Invalid token'}
+        else:
+            result = call(username, params.get('wsfunction'), params)
+        return Response(json.dumps(result), mimetype='application/json')
+
+    def call(username: str, function: str, params):
+        if function == 'core_webservice_get_site_info':
+            return {'userid': int(hashlib.md5(username.encode()).hexdigest()[:6], 16), 'username': username}
+        if function == 'core_enrol_get_users_courses':
+            return [{'id': course['id'], 'fullname': course['name'], 'shortname': str(course['id'])}
+                    for course in moodle.courses]
+        if function == 'core_course_get_contents':
+            modules = [{'id': activity['id'], 'name': activity['name'], 'modname': 'resource', 'completion': 1,
+                        'completiondata': {'state': 1 if moodle.viewed(username, activity['id']) else 0},
+                        'contents': [{'type': 'file', 'filesize': moodle.file_size,
+                                      'timemodified': 1600000000 + activity['modified']}]}
+                       for activity in moodle.activities.get(int(params.get('courseid', 0)), [])]
+            return [{'id': 1, 'name': 'عمومی', 'modules': modules}]
+        if function == 'core_calendar_get_action_events_by_timesort':
+            events = []
+            for event in moodle.events:
+                if event['time'] < int(params.get('timesortfrom', 0)):
+                    continue
+                action = {'name': 'افزودن تحویلی', 'actionable': not moodle.submitted(username, event['id'])} \
+                    if event['kind'] == 'assign' else None
+                events.append({'id': event['id'], 'name': event['name'], 'timesort': event['time'],
+                               'course': {'id': event['course']['id'], 'fullname': event['course']['name']},
+                               'action': action})
+            return {'events': events}
+        return {'exception': 'dml_missing_record_exception', 'errorcode': 'invalidrecord'}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake vlms.ub.ac.ir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response')
+    parser.add_argument('--courses', type=int, default=8)
+    parser.add_argument('--activities', type=int, default=40, help='activities of each course')
+    parser.add_argument('--events', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='size of activity files in bytes')
+    parser.add_argument('--no-ws', action='store_true', help='disable web services')
+    args = parser.parse_args()
+    moodle = FakeMoodle(args.courses, args.activities, args.events, args.file_size, args.latency,
+                        ws_enabled=not args.no_ws)
+    create_app(moodle).run(args.host, args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+""" Local fake of the Telegram Bot API with simulated users, for running the bot and its update path offline
+
+Usage: python -m fakes.telegram [--port 8081] [--flood-limit 30]
+Then run the bot with TELEGRAM_API_URL=http://127.0.0.1:8081/bot and any token like 123:fake.
+Users write to the bot with POST /fake/send {"chat_id": 1, "text": "/start"}
+and messages of the bot to a chat are listed by GET /fake/messages/<chat_id>.
+"""
+import argparse
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from flask import Flask, request, jsonify
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTelegram:
+    """ In memory bot api, updates are delivered to the webhook if it is set, otherwise kept for getUpdates """
+
+    def __init__(self, flood_limit: int = 0, latency: float = 0):
+        # requests per second allowed before answering 429, 0 disables flood control
+        self.flood_limit = flood_limit
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.updates = []
+        self.webhook_url = ''
+        # chat_id -> messages sent by the bot
+        self.messages = defaultdict(list)
+        self.requests_count = defaultdict(int)
+        self.flood_errors = 0
+        # files uploaded with sendPhoto or sendDocument, not sent by file_id
+        self.uploads = 0
+        # webhook deliveries, seconds until the bot acknowledged each update
+        self.ack_times = []
+        self._window = (0, 0)
+        self._session = requests.Session()
+
+    def is_flooded(self):
+        if not self.flood_limit:
+            return False
+        with self._cond:
+            second, count = self._window
+            now = int(time.monotonic())
+            count = count + 1 if second == now else 1
+            self._window = (now, count)
+            if count > self.flood_limit:
+                self.flood_errors += 1
+                return True
+        return False
+
+    def user_message(self, chat_id: int, text: str, first_name: str = 'کاربر'):
+        """ Simulate a user writing text to the bot """
+        user = {'id': chat_id, 'is_bot': False, 'first_name': first_name, 'username': f'user{chat_id}'}
+        update = {
+            'update_id': next(self._update_ids),
+            'message': {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                        'chat': {'id': chat_id, 'type': 'private', 'first_name': first_name}, 'from': user},
+        }
+        if text.startswith('/'):
+            update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        if self.webhook_url:
+            self._deliver(update)
+        else:
+            with self._cond:
+                self.updates.append(update)
+                self._cond.notify_all()
+        return update
+
+    def _deliver(self, update: dict):
+        started_at = time.monotonic()
+        try:
+            self._session.post(self.webhook_url, json=update, timeout=10)
+        except requests.RequestException:
+            logger.exception('update could not be delivered to %s', self.webhook_url)
+            return
+        self.ack_times.append(time.monotonic() - started_at)
+
+    def get_updates(self, offset: int = 0, timeout: float = 0):
+        with self._cond:
+            # confirmed updates are removed like on the real api
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            if not self.updates and timeout:
+                self._cond.wait(timeout)
+            return list(self.updates)
+
+    def bot_message(self, chat_id: int, text: str = None, **fields):
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': {'id': 1, 'is_bot': True, 'first_name': 'LMS', 'username': 'fake_lms_bot'}}
+        if text is not None:
+            message['text'] = text
+        message.update(fields)
+        with self._cond:
+            self.messages[chat_id].append(message)
+            self._cond.notify_all()
+        return message
+
+    def wait_message(self, chat_id: int, start: int, predicate, timeout: float = 30):
+        """ Wait for a message of the bot to chat after the first start messages that matches predicate(text),
+        returns the message or None on timeout """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for message in self.messages[chat_id][start:]:
+                    if predicate(message.get('text') or message.get('caption') or ''):
+                        return message
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+
+
+def create_app(telegram: FakeTelegram):
+    app = Flask(__name__)
+
+    def params():
+        data = request.get_json(force=True, silent=True) or {}
+        data.update(request.form.to_dict())
+        data.update(request.args.to_dict())
+        return data
+
+    def ok(result):
+        return jsonify({'ok': True, 'result': result})
+
+    def error(code: int, description: str, parameters: dict = None):
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return jsonify(body), code
+
+    @app.route('/bot<token>/<method>', methods=['GET', 'POST'])
+    def bot_api(token: str, method: str):
+        method = method.lower()
+        telegram.requests_count[method] += 1
+        if telegram.latency:
+            time.sleep(telegram.latency)
+        data = params()
+        if method == 'getme':
+            return ok({'id': 1, 'is_bot': True, 'first_name': 'LMS', 'username': 'fake_lms_bot'})
+        if method == 'getupdates':
+            if telegram.webhook_url:
+                return error(409, "Conflict: can't use getUpdates method while webhook is active")
+            return ok(telegram.get_updates(int(data.get('offset') or 0), float(data.get('timeout') or 0)))
+        if method == 'setwebhook':
+            telegram.webhook_url = data.get('url', '')
+            return ok(True)
+        if method == 'deletewebhook':
+            telegram.webhook_url = ''
+            return ok(True)
+        if method == 'sendchataction':
+            return ok(True)
+        if telegram.is_flooded():
+            return error(429, 'Too Many Requests: retry after 1', {'retry_after': 1})
+        chat_id = int(data.get('chat_id', 0))
+        if method == 'sendmessage':
+            return ok(telegram.bot_message(chat_id, data.get('text', '')))
+        if method == 'editmessagetext':
+            with telegram._cond:
+                for message in telegram.messages[chat_id]:
+                    if message['message_id'] == int(data.get('message_id', 0)):
+                        message['text'] = data.get('text', '')
+                        return ok(message)
+            return error(400, 'Bad Request: message to edit not found')
+        if method in ('sendphoto', 'senddocument'):
+            kind = method[len('send'):]
+            if kind in request.files:
+                with telegram._cond:
+                    telegram.uploads += 1
+                file_id = f'{kind}_{telegram.uploads}'
+            else:
+                # a file sent again by its file_id
+                file_id = data.get(kind, f'{kind}_{chat_id}')
+            file = {'file_id': file_id, 'file_unique_id': file_id}
+            if kind == 'photo':
+                # sizes of a photo, largest last
+                file = [dict(file, width=1280, height=960)]
+            return ok(telegram.bot_message(chat_id, caption=data.get('caption', ''), **{kind: file}))
+        return error(404, 'Not Found: method not found')
+
+    @app.route('/fake/send', methods=['POST'])
+    def fake_send():
+        data = request.get_json(force=True)
+        return jsonify(telegram.user_message(int(data['chat_id']), data['text']))
+
+    @app.route('/fake/messages/<int:chat_id>')
+    def fake_messages(chat_id: int):
+        with telegram._cond:
+            return jsonify(telegram.messages[chat_id])
+
+    @app.route('/fake/stats')
+    def fake_stats():
+        ack_times = sorted(telegram.ack_times)
+        return jsonify({
+            'requests': telegram.requests_count,
+            'flood_errors': telegram.flood_errors,
+            'uploads': telegram.uploads,
+            'deliveries': len(ack_times),
+            'ack_p50': ack_times[len(ack_times) // 2] if ack_times else 0,
+            'ack_max': ack_times[-1] if ack_times else 0,
+        })
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response')
+    parser.add_argument('--flood-limit', type=int, default=0, help='requests per second before answering 429')
+    args = parser.parse_args()
+    telegram = FakeTelegram(args.flood_limit, args.latency)
+    create_app(telegram).run(args.host, args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
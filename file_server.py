@@ -0,0 +1,96 @@
+import mimetypes
+import os
+import re
+import threading
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (parse_qs, quote, unquote, urlsplit)
+
+from storage import LocalStorage
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: str, size: int):
+    """ (start, end) of a single byte range header, end is inclusive, None if header is not a valid range """
+    match = _RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if not start:
+        # suffix range, last bytes of file
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    storage: LocalStorage = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body: bool):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        ref = unquote(url.path[len('/files/'):]) if url.path.startswith('/files/') else ''
+        if '/' in ref or not ref or not self.storage.verify(ref, query.get('name', ''), query.get('expires', ''),
+                                                            query.get('signature', '')):
+            return self._error(403)
+        try:
+            file = open(self.storage.path(ref), 'rb')
+        except OSError:
+            return self._error(404)
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+            if self.headers.get('Range') and size:
+                byte_range = parse_range(self.headers['Range'], size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                (start, end), status = byte_range, 206
+            self.send_response(status)
+            self.send_header('Content-Type', mimetypes.guess_type(ref)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Disposition', f"attachment; filename*=UTF-8''{quote(query['name'])}")
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if body and size:
+                self.wfile.flush()
+                # file pages go from page cache to the socket in the kernel, without copies through python
+                self.connection.sendfile(file, start, end - start + 1)
+
+    def _error(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FileServer:
+    """ Serve files of local storage over http with signed links, range requests resume interrupted downloads
+    and seek in videos """
+
+    def __init__(self, storage: LocalStorage, host: str = '0.0.0.0', port: int = 8080):
+        handler = type('FileHandler', (_FileHandler,), {'storage': storage})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        """ Serve in a background thread """
+        threading.Thread(target=self.server.serve_forever, name='file_server', daemon=True).start()
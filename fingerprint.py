@@ -0,0 +1,60 @@
+import hashlib
+
+
+def _hash(text: str):
+    return hashlib.md5(text.encode()).hexdigest()[:16]
+
+
+def _parse(fingerprint: str):
+    """ Name hash and source -> revision hash of a fingerprint """
+    name, _, revisions = fingerprint.partition(':')
+    return name, dict(part.split('=', 1) for part in revisions.split(',') if '=' in part)
+
+
+def _format(name: str, revisions: dict):
+    return f'{name}:{",".join(f"{source}={revision}" for source, revision in sorted(revisions.items()))}'
+
+
+def activity_fingerprint(activity: dict):
+    """ Short hash of the parts of an activity a student notices changing, its name and url, and hash of its file
+    revision after a colon, e.g. 'ws=...', each backend shows a revision in its own format so a revision is only
+    compared with one of the same source, the revision is empty when the source does not show it """
+    name = _hash(f'{activity["name"]}\n{activity["url"]}')
+    source, _, revision = (activity.get('revision') or '').partition(':')
+    return _format(name, {source: _hash(revision)} if revision else {})
+
+
+def course_fingerprint(activities: list):
+    """ Activity id -> fingerprint of all activities of a course """
+    return {activity['id']: activity_fingerprint(activity) for activity in activities}
+
+
+def keep_revisions(old: dict, new: dict):
+    """ New fingerprint with the old revisions of sources that did not fetch the course now, e.g. when a user
+    without web service token fetched the course page, so a revision is compared with the last one of its source """
+    kept = dict(new)
+    for activity_id, fingerprint in new.items():
+        name, revisions = _parse(fingerprint)
+        old_name, old_revisions = _parse(old.get(activity_id) or '')
+        if name == old_name and old_revisions:
+            kept[activity_id] = _format(name, {**old_revisions, **revisions})
+    return kept
+
+
+def is_modified(old: str, new: str):
+    """ Check name or url changed, or the file was replaced when a revision of the same source is known in both,
+    fingerprints kept before revisions were added have no revisions """
+    old_name, old_revisions = _parse(old)
+    name, revisions = _parse(new)
+    return old_name != name or any(source in old_revisions and old_revisions[source] != revision
+                                   for source, revision in revisions.items())
+
+
+def diff_fingerprints(old: dict, new: dict):
+    """ Ids of added, removed and modified activities in linear time, an empty old fingerprint means
+    the activity was known before fingerprints were kept and is not reported as modified """
+    added = [activity_id for activity_id in new if activity_id not in old]
+    removed = [activity_id for activity_id in old if activity_id not in new]
+    modified = [activity_id for activity_id, fingerprint in new.items()
+                if old.get(activity_id) and is_modified(old[activity_id], fingerprint)]
+    return added, removed, modified
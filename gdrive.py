@@ -1,5 +1,13 @@
+import os
+
+from googleapiclient.http import MediaFileUpload
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
+from pydrive.files import ApiRequestError
+
+from metrics import (REGISTRY, timed)
+
+DRIVE_SECONDS = REGISTRY.histogram('drive_seconds', 'Time of google drive operations', ('operation',))
 
 
 class GDrive:
@@ -7,6 +15,7 @@ class GDrive:
         self.auth, self.drive = None, None
         self._credentials_file_name = 'credentials.txt'
 
+    @timed(DRIVE_SECONDS, operation='login')
     def login(self):
         self.auth = GoogleAuth()
         self.auth.LoadCredentialsFile(self._credentials_file_name)
@@ -14,18 +23,21 @@ class GDrive:
             self.auth.LocalWebserverAuth()
         elif self.auth.access_token_expired:
             self.auth.Refresh()
+            # refresh does not build the service that upload_new_file_resumable uses
+            self.auth.Authorize()
         else:
             self.auth.Authorize()
         self.auth.SaveCredentialsFile(self._credentials_file_name)
-        self.auth.LocalWebserverAuth()
         self.drive = GoogleDrive(self.auth)
 
+    @timed(DRIVE_SECONDS, operation='get_folder')
     def get_folder(self, folder_name):
         folders = self.drive.ListFile({
             'q': f"title='{folder_name}' and mimeType contains 'application/vnd.google-apps.folder' and trashed=false"
         }).GetList()
         return folders[0]
 
+    @timed(DRIVE_SECONDS, operation='get_files')
     def get_files(self, folder_id):
         files = self.drive.ListFile(
             {'q': f"\'{folder_id}\'" + " in parents and trashed=false"}
@@ -33,6 +45,20 @@ class GDrive:
         ).GetList()
         return files
 
+    @timed(DRIVE_SECONDS, operation='file_exists')
+    def file_exists(self, file_id):
+        """ Check file is still on drive and not trashed """
+        file = self.drive.CreateFile({'id': file_id})
+        try:
+            file.FetchMetadata(fields='trashed')
+        except ApiRequestError as e:
+            response = getattr(e.args[0], 'resp', None) if e.args else None
+            if response is not None and response.status == 404:
+                return False
+            raise
+        return not file['trashed']
+
+    @timed(DRIVE_SECONDS, operation='create_new_folder')
     def create_new_folder(self, new_folder_name, parent_folder=None):
         new_folder = self.drive.CreateFile(
             {'title': f'{new_folder_name}',
@@ -42,6 +68,7 @@ class GDrive:
         new_folder.Upload()
         return new_folder
 
+    @timed(DRIVE_SECONDS, operation='upload_new_file')
     def upload_new_file(self, file, folder):
         new_file = self.drive.CreateFile({
             'title': file,
@@ -50,3 +77,24 @@ class GDrive:
         new_file.SetContentFile(file)
         new_file.Upload()
         return new_file
+
+    @timed(DRIVE_SECONDS, operation='upload_new_file_resumable')
+    def upload_new_file_resumable(self, file, folder, chunk_size, progress=None):
+        """ Upload file in chunks with a resumable session, progress is called with (uploaded bytes, total bytes) """
+        media = MediaFileUpload(file, chunksize=chunk_size, resumable=True)
+        if self.auth.service is None:
+            self.auth.Authorize()
+        # httplib2 is not thread safe, each upload has its own http object like pydrive calls
+        http = self.auth.Get_Http_Object()
+        request = self.auth.service.files().insert(body={
+            'title': os.path.basename(file),
+            'parents': [{u'id': folder['id']}]
+        }, media_body=media)
+        response = None
+        while response is None:
+            status, response = request.next_chunk(http=http, num_retries=3)
+            if status and progress:
+                progress(status.resumable_progress, status.total_size)
+        new_file = self.drive.CreateFile(response)
+        new_file.uploaded = True
+        return new_file
@@ -1,20 +1,40 @@
 # -*- coding: utf-8 -*-
 import logging
-import os
-import threading
+from functools import partial
 
-import num2fawords
 import requests
 import redis
 import traceback
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackContext)
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackContext,
+                          TypeHandler)
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove, ChatAction, Update, ForceReply)
+from telegram.utils.request import Request
 from decouple import config
-from scraper import (get_events, sign_in, get_student_courses, get_course_activities, session_is_connected, BASE_URL)
-from bs4 import BeautifulSoup
+from scraper import (get_events, sign_in, get_student_courses, get_course_activities, get_many_activities, BASE_URL)
+import session_manager
+from session_manager import (call_with_session, connected_session, set_session, user_session, forget_session)
 from gdrive import GDrive
-import jdatetime
-import json
+from download_queue import DownloadQueue
+from mirror import FileMirror
+from disk_cache import DiskCache
+from storage import (DriveStorage, LocalStorage)
+from file_server import FileServer
+from downloader import UPLOAD_CHUNK_SIZE
+from watcher import CourseWatcher
+from persistence import RedisPersistence
+from scheduler import SpreadScheduler
+from async_scraper import (engine, lms_limiter, lms_breaker)
+from broadcast import Broadcaster
+from cache import TwoTierCache
+from deadlines import DeadlineIndex
+from parsers import format_deadline
+from outbox import (Outbox, QueuedBot)
+from webhook import (UpdateWorkers, run_webhook)
+from sharding import (ShardMembers, ShardRouter, ShardWorker)
+from metrics import (REGISTRY, MetricsServer, instrument_handlers, observe_job_lag)
+from startup import Startup
+from assets import (SemesterCalendar, TelegramFiles)
+from cookie_store import CookieStore
 from persiantools import digits
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.ERROR)
@@ -27,15 +47,102 @@ DB_UPLOAD_HOST = config('DB_UPLOAD_HOST')
 DB_UPLOAD_PORT = int(config('DB_UPLOAD_PORT'))
 DB_UPLOAD_PASSWORD = config('DB_UPLOAD_PASSWORD')
 ADMIN_CHAT_ID = int(config('ADMIN_CHAT_ID'))
-
-# Google drive to upload files
-google_drive = GDrive()
-google_drive.login()
-host_folder = google_drive.get_folder(config('HOST_FOLDER_NAME'))
+DOWNLOAD_WORKERS = int(config('DOWNLOAD_WORKERS', default=3))
+# Number of saved subscriptions loaded in each step after a restart and seconds between steps
+RESTORE_BATCH_SIZE = int(config('RESTORE_BATCH_SIZE', default=200))
+RESTORE_INTERVAL = int(config('RESTORE_INTERVAL', default=10))
+# Seconds between polls of upcoming events of a chat, reminders are sent at their own time from the index
+DEADLINE_POLL_INTERVAL = int(config('DEADLINE_POLL_INTERVAL', default=24 * 60 * 60))
+# Reminders are sent these hours before each deadline
+DEADLINE_REMINDER_HOURS = [float(hours) for hours in config('DEADLINE_REMINDER_HOURS', default='24,2').split(',')]
+# Megabytes of downloaded files kept on disk, least recently used files are removed first
+FILES_CACHE_MB = int(config('FILES_CACHE_MB', default=2048))
+# Files of new activities are mirrored to google drive when the watcher finds them, before anyone asks
+MIRROR_PREFETCH = config('MIRROR_PREFETCH', default=True, cast=bool)
+WATCHER_WORKERS = int(config('WATCHER_WORKERS', default=4))
+BROADCAST_RATE = float(config('BROADCAST_RATE', default=25))
+BROADCAST_WORKERS = int(config('BROADCAST_WORKERS', default=8))
+OUTBOX_RATE = float(config('OUTBOX_RATE', default=30))
+OUTBOX_WORKERS = int(config('OUTBOX_WORKERS', default=8))
+# Seconds cached lms pages are fresh, and until when a stale copy is shown while it is reloaded
+ACTIVITIES_CACHE_TTL = int(config('ACTIVITIES_CACHE_TTL', default=5 * 60))
+ACTIVITIES_CACHE_STALE_TTL = int(config('ACTIVITIES_CACHE_STALE_TTL', default=60 * 60))
+EVENTS_CACHE_TTL = int(config('EVENTS_CACHE_TTL', default=60))
+EVENTS_CACHE_STALE_TTL = int(config('EVENTS_CACHE_STALE_TTL', default=10 * 60))
+# polling gets updates with getUpdates, webhook receives them over http on PORT
+BOT_MODE = config('BOT_MODE', default='polling')
+WEBHOOK_URL = config('WEBHOOK_URL', default='')
+WEBHOOK_SECRET = config('WEBHOOK_SECRET', default=TOKEN.replace(':', '_'))
+WEBHOOK_WORKERS = int(config('WEBHOOK_WORKERS', default=8))
+PORT = int(config('PORT', default=8443))
+# empty runs everything in one process, front receives updates and routes them to worker processes by chat_id
+SHARD_ROLE = config('SHARD_ROLE', default='')
+SHARD_ID = config('SHARD_ID', default='worker-0')
+# Port of prometheus /metrics, 0 (default) disables it, each process on a host needs its own port, e.g. front and
+# workers, with profiler /debug/profile?seconds=N samples stacks of all threads
+METRICS_PORT = int(config('METRICS_PORT', default=0))
+PROFILER = config('PROFILER', default=False, cast=bool)
+# Bot api address, e.g. http://127.0.0.1:8081/bot for the local fake telegram
+TELEGRAM_API_URL = config('TELEGRAM_API_URL', default=None)
+
+# Semester start and end dates, and image of the educational calender
+SEMESTER_CONFIG = config('SEMESTER_CONFIG', default='./resource/config.json')
+CALENDER_IMAGE = config('CALENDER_IMAGE', default='resource/1400-1401-calender.jpg')
+
+# Secret that encrypts saved lms cookies, and hours a saved session is first assumed to live without use
+COOKIE_SECRET = config('COOKIE_SECRET', default=TOKEN)
+LMS_SESSION_LIFETIME = float(config('LMS_SESSION_LIFETIME', default=6))
+
+# drive uploads files to google drive, local keeps them on disk and serves them on FILE_SERVER_PORT
+STORAGE_BACKEND = config('STORAGE_BACKEND', default='drive')
+STORAGE_ROOT = config('STORAGE_ROOT', default='./storage')
+# Public address of file server and seconds its links are valid
+FILE_SERVER_URL = config('FILE_SERVER_URL', default='')
+FILE_SERVER_PORT = int(config('FILE_SERVER_PORT', default=8080))
+FILE_LINK_TTL = int(config('FILE_LINK_TTL', default=24 * 60 * 60))
+FILE_LINK_SECRET = config('FILE_LINK_SECRET', default=TOKEN)
+
+# Readiness of external clients, they are connected in background when the bot starts
+startup = Startup()
+if STORAGE_BACKEND == 'local':
+    if not FILE_SERVER_URL.startswith(('http://', 'https://')):
+        # links without the address of the file server do not open from telegram
+        raise ValueError(f'FILE_SERVER_URL must be the public address of the file server, e.g. '
+                         f'https://files.example.com, when STORAGE_BACKEND is local, got {FILE_SERVER_URL!r}')
+    file_storage = LocalStorage(STORAGE_ROOT, FILE_SERVER_URL, FILE_LINK_SECRET, FILE_LINK_TTL)
+else:
+    # Google drive to upload files, logged into on first use
+    file_storage = DriveStorage(GDrive(), config('HOST_FOLDER_NAME'), UPLOAD_CHUNK_SIZE)
 # Redis db to save chat_id
 db = redis.Redis(host=DB_HOST, port=DB_PORT, password=DB_PASSWORD)
 # Redis db to save files download link
 db_upload = redis.Redis(host=DB_UPLOAD_HOST, port=DB_UPLOAD_PORT, password=DB_UPLOAD_PASSWORD)
+# Activity files in storage, deduplicated by content, each storage has its own files
+file_mirror = FileMirror(db_upload, file_storage, DiskCache('./files', FILES_CACHE_MB * 1024 ** 2),
+                         'lms:mirror' if file_storage.name == 'drive' else 'lms:mirror:local')
+# Lms sessions of users survive restarts without a new login
+session_manager.cookie_store = CookieStore(db, COOKIE_SECRET, lifetime=LMS_SESSION_LIFETIME * 60 * 60)
+# Static files are uploaded to telegram once and sent by file_id after that
+telegram_files = TelegramFiles(db)
+# Week number of each day of the semester, computed once and when the config file changes
+semester_calendar = SemesterCalendar(SEMESTER_CONFIG)
+# Shared watcher to check each course once for all subscribers
+course_watcher = CourseWatcher(db, workers=WATCHER_WORKERS)
+# Deadline notification of all chats, spread over the interval, callback is set in main
+deadline_scheduler = SpreadScheduler('alert_deadline', DEADLINE_POLL_INTERVAL, None, workers=2)
+# Reminder times of pending events of all chats
+deadline_index = DeadlineIndex(db, tuple(int(hours * 60 * 60) for hours in DEADLINE_REMINDER_HOURS))
+# Bounded pool of download workers, one job per activity
+download_queue = DownloadQueue(DOWNLOAD_WORKERS)
+# All outgoing messages are queued here, limited globally and per chat
+outbox = Outbox(rate=OUTBOX_RATE, workers=OUTBOX_WORKERS)
+# Activities and events of users, repeated taps are answered without an lms request
+lms_cache = TwoTierCache(db)
+# Background broadcast to all chats, bot is set in main
+broadcaster = Broadcaster(db, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS)
+# Update workers of webhook mode and shard worker of worker processes, set in main
+webhook_workers = None
+shard_worker = None
 logger = logging.getLogger(__name__)
 
 # Conversation handler states
@@ -91,30 +198,13 @@ def start(update: Update, context: CallbackContext):
 
 def week_number(update: Update, context: CallbackContext):
     """ Show the week is odd or even """
-    chat_id = update.message.chat_id
-    context.bot.sendChatAction(chat_id=chat_id, action=ChatAction.TYPING)
-    with open('./resource/config.json', 'r') as f:
-        config_file = json.load(f)
-        start_date_edu_calender = jdatetime.datetime.strptime(config_file['start_date_edu_calender'], '%Y-%m-%d').date()
-        end_date_edu_calender = jdatetime.datetime.strptime(config_file['end_date_edu_calender'], '%Y-%m-%d').date()
-    today = jdatetime.date.today()
-    if start_date_edu_calender <= today <= end_date_edu_calender:
-        diff = today - start_date_edu_calender
-        week_num = diff.days // 7 + 1
-        week_odd_even = 'فرد' if week_num % 2 else 'زوج'
-        reply_msg = f'امروز {jdatetime.date.j_weekdays_fa[today.weekday()]} {num2fawords.ordinal_words(today.day)} {jdatetime.date.j_months_fa[today.month]} {digits.en_to_fa(str(today.year))}' \
-                    f' هفته {num2fawords.ordinal_words((diff.days // 7 + 1))} آموزشی و {week_odd_even} است.'
-    else:
-        reply_msg = 'ترم تمام شده است.'
-    update.message.reply_text(reply_msg)
+    update.message.reply_text(semester_calendar.message())
     return MENU if context.user_data['is_login'] else START_MENU
 
 
 def calender(update: Update, context: CallbackContext):
     """ Show educational calender """
-    chat_id = update.message.chat_id
-    context.bot.sendChatAction(chat_id=chat_id, action=ChatAction.TYPING)
-    update.message.reply_photo(photo=open('resource/1400-1401-calender.jpg', 'rb'))
+    telegram_files.reply_photo(update.message, CALENDER_IMAGE)
     return MENU if context.user_data['is_login'] else START_MENU
 
 
@@ -145,17 +235,19 @@ def login(update: Update, context: CallbackContext):
         courses, msg = get_student_courses(session)
         if courses:
             chat_id = update.message.chat_id
-            if job_if_exists(str(chat_id), context):
+            if course_watcher.is_subscribed(chat_id):
                 reply_keyboard = reply_keyboard_menu_second
             else:
                 reply_keyboard = reply_keyboard_menu_first
             context.user_data['is_login'] = True
-            context.user_data['session'] = session
             context.user_data['courses'] = courses
             context.user_data['chat_id'] = chat_id
-            if not job_if_exists('alert_deadline' + str(chat_id), context):
-                context.job_queue.run_repeating(callback=alert_deadline, name='alert_deadline' + str(chat_id),
-                                                context=context, interval=(8 * 60 * 60))
+            set_session(context.user_data, session)
+            # cached pages may belong to another account that used this chat
+            lms_cache.invalidate(f'chat:{chat_id}')
+            if chat_id not in deadline_scheduler:
+                # deadlines of a new login are indexed right away, not at the spread position of the chat
+                schedule_alert_deadline(chat_id, first=1)
         else:
             reply_msg = msg
             reply_keyboard = reply_keyboard_menu_login
@@ -178,82 +270,85 @@ def events(update: Update, context: CallbackContext):
         reply_msg = restart_msg
         update.message.reply_text(reply_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    if not session_is_connected(context.user_data['session']):
-        session, msg = sign_in(context.user_data['username'], context.user_data["password"])
-        if not session:
-            update.message.reply_text(msg)
-            return MENU
-        context.user_data['session'] = session
-    events_list, reply_msg = get_events(context.user_data['session'])
+    events_list, reply_msg = cached_events(context.user_data, chat_id)
+    if events_list is not None and chat_id in deadline_scheduler:
+        deadline_index.update(chat_id, events_list)
     if events_list:
         if len(events_list) == 0:
             reply_msg = 'برو حال کن هیچ رویداد نزدیکی نداری.'
         else:
             for event in events_list:
-                reply_msg += f'نام درس:   {event["lesson"]}\nعنوان فعالیت:   {event["name"]}\nمهلت تا:   {event["deadline"]}\nوضعیت:   {event["status"]}\n\n'
+                # a cached deadline like 'فردا' is formatted again from its time
+                deadline = format_deadline(event['timestamp']) if event.get('timestamp') else event['deadline']
+                reply_msg += f'نام درس:   {event["lesson"]}\nعنوان فعالیت:   {event["name"]}\nمهلت تا:   {deadline}\nوضعیت:   {event["status"]}\n\n'
     update.message.reply_text(reply_msg)
     return MENU
 
 
+def cached_events(user_data: dict, chat_id: int):
+    """ Upcoming events of user from cache, loaded from lms when missing """
+    return lms_cache.get(f'events:{chat_id}', lambda: call_with_session(user_data, get_events),
+                         EVENTS_CACHE_TTL, EVENTS_CACHE_STALE_TTL, tags=(f'chat:{chat_id}',))
+
+
+def cached_course_activities(user_data: dict, chat_id: int, course_id: str):
+    """ Activities of a course with completion status of user from cache, loaded from lms when missing """
+    return lms_cache.get(f'activities:{course_id}:{chat_id}',
+                         lambda: call_with_session(user_data, get_course_activities, course_id),
+                         ACTIVITIES_CACHE_TTL, ACTIVITIES_CACHE_STALE_TTL, tags=(course_id, f'chat:{chat_id}'))
+
+
+def course_changed(course_id: str, fetcher_chat_id: int, activities: list, changed: list):
+    """ Watcher listener, cached activities of the course are dropped and the fetched list is kept for its user """
+    lms_cache.invalidate(course_id)
+    lms_cache.set(f'activities:{course_id}:{fetcher_chat_id}', activities, ACTIVITIES_CACHE_STALE_TTL,
+                  tags=(course_id, f'chat:{fetcher_chat_id}'))
+
+
 def session_exists(context: CallbackContext):
-    """ Check user is login """
-    if 'session' in context.user_data:
+    """ Check user is login, a session saved before a restart is restored """
+    if user_session(context.user_data) is not None:
         return True
     return False
 
 
-def job_if_exists(name: str, context: CallbackContext, remove=False):
-    """ Check job is exists in bot job_queue """
-    current_jobs = context.job_queue.get_jobs_by_name(name)
-    if not current_jobs:
-        return False
-    if remove:
-        for job in current_jobs:
-            job.schedule_removal()
-    return True
-
-
-def alert_deadline(context: CallbackContext):
-    """ Send notification before deadline of an activity """
-    job = context.job
-    if not session_is_connected(job.context.user_data['session']):
-        session, msg = sign_in(job.context.user_data['username'], job.context.user_data["password"])
-        job.context.user_data['session'] = session
-    events_list, msg = get_events(job.context.user_data['session'])
-    if events_list:
-        reply_msg = '\n\U0001F514  پایان مهلت فعالیت های زیر نزدیک است \U0001F514\n\n'
-        len_0 = len(reply_msg)
-        for event in events_list:
-            if 'نشده' in event['status'] and ('فردا' in event['deadline'] or 'امروز' in event['deadline']):
-                reply_msg += f'نام درس:   {event["lesson"]}\nعنوان فعالیت:   {event["name"]}\nمهلت تا:   {event["deadline"]}\nوضعیت:   {event["status"]}\n\n'
-        if len(reply_msg) != len_0:
-            context.bot.send_message(job.context.user_data['chat_id'], reply_msg)
-
-
-def alert(context: CallbackContext):
-    """ Send notification if new activity added """
-    job = context.job
-    if not session_is_connected(job.context.user_data['session']):
-        session, msg = sign_in(job.context.user_data['username'], job.context.user_data["password"])
-        job.context.user_data['session'] = session
-    courses = job.context.user_data['courses']
-    for course in courses:
-        activities, msg = get_course_activities(job.context.user_data['session'], course['id'])
-        if activities:
-            last_activities_id = job.context.user_data[course['id']]
-            if len(activities) > len(last_activities_id):
-                new_activities_id = []
-                reply_msg = '\n\U0001F514  فعالیت های جدیدی اضافه شد \U0001F514\n\n'
-                for activity in activities:
-                    if activity['id'] not in last_activities_id:
-                        reply_msg += f'نام درس:  {course["name"]}\nفعالیت های جدید:   '
-                        status = "مشاهده شده است. \U00002705" if activity[
-                                                                     "status"] == "0" else "مشاهده نشده است. \U0000274C"
-                        reply_msg += f'\n        عنوان فعالیت:   {activity["name"]}\n        وضعیت:   {status}\n\n'
-                        new_activities_id.append(activity['id'])
-                last_activities_id.extend(new_activities_id)
-                job.context.user_data[course['id']] = last_activities_id
-                context.bot.send_message(job.context.user_data['chat_id'], reply_msg)
+def schedule_alert_deadline(chat_id: int, first: float = None):
+    """ Add deadline notification of a chat and save it to restore after restart """
+    deadline_scheduler.add(chat_id, first)
+    db.sadd('lms:deadline_chats', chat_id)
+
+
+def unschedule_alert_deadline(chat_id: int):
+    """ Remove deadline notification of a chat """
+    deadline_scheduler.remove(chat_id)
+    deadline_index.remove(chat_id)
+    db.srem('lms:deadline_chats', chat_id)
+
+
+def index_deadlines(dispatcher, chat_id: int):
+    """ Scheduler callback, poll upcoming events of a chat and index their deadlines """
+    if shard_worker and not shard_worker.owns(chat_id):
+        return
+    events_list, msg = call_with_session(dispatcher.user_data[chat_id], get_events)
+    if events_list is not None:
+        deadline_index.update(chat_id, events_list)
+        lms_cache.set(f'events:{chat_id}', events_list, EVENTS_CACHE_STALE_TTL, tags=(f'chat:{chat_id}',))
+
+
+def alert_deadline(dispatcher, chat_id: int, reminders: list):
+    """ Send notification before deadline of an activity, events done since they were indexed are skipped """
+    events_list, msg = cached_events(dispatcher.user_data[chat_id], chat_id)
+    if events_list is not None:
+        deadline_index.update(chat_id, events_list)
+        pending = {event.get('id') for event in events_list if 'نشده' in event['status']}
+        reminders = [(event, offset) for event, offset in reminders if event['id'] in pending]
+    if not reminders:
+        return
+    reply_msg = '\n\U0001F514  پایان مهلت فعالیت های زیر نزدیک است \U0001F514\n\n'
+    for event, offset in reminders:
+        reply_msg += f'نام درس:   {event["lesson"]}\nعنوان فعالیت:   {event["name"]}\n' \
+                     f'مهلت تا:   {format_deadline(event["timestamp"])}\nوضعیت:   {event["status"]}\n\n'
+    dispatcher.bot.send_message(chat_id, reply_msg)
 
 
 def set_alert(update: Update, context: CallbackContext):
@@ -266,29 +361,23 @@ def set_alert(update: Update, context: CallbackContext):
     if not session_exists(context):
         update.message.reply_text(reply_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    if not job_if_exists(str(chat_id), context):
-        if not session_is_connected(context.user_data['session']):
-            session, msg = sign_in(context.user_data['username'], context.user_data["password"])
-            if not session:
-                update.message.reply_text(msg)
-                return MENU
-            context.user_data['session'] = session
+    if not course_watcher.is_subscribed(chat_id):
         courses = context.user_data['courses']
-        done = True
-        for course in courses:
-            activities, reply_msg = get_course_activities(context.user_data['session'], course['id'])
-            if activities is not None:
-                context.user_data[course['id']] = [activity['id'] for activity in activities]
-            else:
-                done = False
-                break
-        if done:
+        # courses already watched for other students need no baseline fetch
+        results, msg = call_with_session(context.user_data, lambda session: (get_many_activities(
+            [(session, course['id']) for course in courses if not course_watcher.is_watched(course['id'])]), ''))
+        if results is None:
+            update.message.reply_text(msg)
+            return MENU
+        baselines = {course_id: activities for course_id, (activities, _) in results.items()}
+        if all(activities is not None for activities in baselines.values()):
+            context.user_data['chat_id'] = chat_id
+            for course in courses:
+                course_watcher.subscribe(chat_id, context.user_data, course, baselines.get(course['id']))
             reply_msg = 'اطلاع رسانی فعالیت جدید فعال شد.'
             reply_keyboard = reply_keyboard_menu_second
             markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
             context.user_data['alert'] = True
-            context.user_data['chat_id'] = chat_id
-            context.job_queue.run_repeating(alert, context=context, name=str(chat_id), interval=1 * 60 * 60)
         else:
             reply_msg = 'در حال حاضر این سرویس دچار مشکل شده است. لطفا دوباره تلاش کنید.'
     else:
@@ -309,7 +398,8 @@ def unset_alert(update: Update, context: CallbackContext):
         reply_msg = restart_msg
         update.message.reply_text(reply_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    if job_if_exists(str(chat_id), context, remove=True):
+    if course_watcher.is_subscribed(chat_id):
+        course_watcher.unsubscribe(chat_id)
         reply_keyboard = reply_keyboard_menu_first
         markup = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
         reply_msg = 'اطلاع رسانی فعالیت جدید غیر فعال شد.'
@@ -329,12 +419,6 @@ def show_courses(update: Update, context: CallbackContext):
         reply_msg = restart_msg
         update.message.reply_text(reply_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    if not session_is_connected(context.user_data['session']):
-        session, msg = sign_in(context.user_data['username'], context.user_data["password"])
-        if not session:
-            update.message.reply_text(msg)
-            return COURSES
-        context.user_data['session'] = session
     reply_keyboard_courses = []
     courses = context.user_data['courses']
     for course in courses:
@@ -358,7 +442,7 @@ def show_course_activities(update: Update, context: CallbackContext):
     courses = context.user_data['courses']
     for course in courses:
         if update.message.text == course['name']:
-            activities, msg = get_course_activities(context.user_data['session'], course['id'])
+            activities, msg = cached_course_activities(context.user_data, update.message.chat_id, course['id'])
             if activities:
                 context.user_data['selected_course'] = {'name': course['name'], 'activities': activities}
                 reply_msg = f'فعالیت های درس {course["name"]}\n'
@@ -389,14 +473,14 @@ def upload(update: Update, context: CallbackContext):
         reply_msg = restart_msg
         update.message.reply_text(reply_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    if not session_is_connected(context.user_data['session']):
-        session, msg = sign_in(context.user_data['username'], context.user_data["password"])
-        if not session:
-            update.message.reply_text(msg)
-            return COURSES
-        context.user_data['session'] = session
-    session = context.user_data['session']
-    threading.Thread(target=generate_download_link, args=(update, context, session)).start()
+    session, msg = connected_session(context.user_data)
+    if not session:
+        update.message.reply_text(msg)
+        return COURSES
+    if not (startup.ready('drive') and startup.ready('db_upload')):
+        update.message.reply_text('سرویس دانلود در حال راه اندازی است، لطفا چند لحظه دیگر دوباره تلاش کنید.')
+        return COURSES
+    generate_download_link(update, context, session)
     return COURSES
 
 
@@ -404,65 +488,79 @@ def generate_download_link(update: Update, context: CallbackContext, session: re
     selected_activity_id = update.message.text.split('_')[-1]
     selected_course = context.user_data['selected_course']
     activities = selected_course['activities']
-    activity_found = False
     for activity in activities:
         if selected_activity_id == activity['id']:
-            activity_found = True
-            if db_upload.exists(activity['id']):
-                download_link = db_upload.get(activity['id']).decode()
-                reply_msg = f'\n<b>نام درس:   {selected_course["name"]}</b>\n\nعنوان فعالیت:   {activity["name"]}\n\n'
-                reply_msg += f'<b><a href="{download_link}">📥  دانلود</a></b>\n'
-                reply_msg += f'\n\n@ub_lms_bot\n'
-                update.message.reply_text(reply_msg, parse_mode='HTML')
-                break
-            else:
-                activity_url = activity['url']
-                try:
-                    response = session.get(activity_url)
-                    if response.status_code == 200:
-                        if not response.headers.get(
-                                "Content-Disposition"):  # check activity is video or attachment file
-                            video_page = BeautifulSoup(response.content, 'html.parser')
-                            activity_download_url = video_page.find('source')['src']
-                            response = session.get(activity_download_url)
-                            filename = get_filename(activity['name'], response.headers.get("Content-Disposition"))
-                        else:
-                            filename = get_filename(activity['name'], response.headers.get("Content-Disposition"))
-                        update.message.reply_text('در حال ایجاد لینک دانلود...')
-                        with open(filename, 'wb') as file:
-                            file.write(response.content)
-                        if google_drive.auth.access_token_expired:
-                            google_drive.login()
-                        file = google_drive.upload_new_file(filename, host_folder)
-                        file.InsertPermission({
-                            'type': 'anyone',
-                            'value': 'anyone',
-                            'role': 'reader'})
-                        reply_msg = f'\n<b>نام درس:   {selected_course["name"]}</b>\n\nعنوان فعالیت:   {activity["name"]}\n\n'
-                        reply_msg += f'<b><a href="{file["webContentLink"]}">📥  دانلود</a></b>\n'
-                        reply_msg += f'\n\n@ub_lms_bot\n'
-                        db_upload.set(activity['id'], file["webContentLink"], ex=7 * 24 * 60 * 60)
-                        update.message.reply_text(reply_msg, parse_mode='HTML')
-                    else:
-                        update.message.reply_text('این فعالیت فایلی برای دانلود ندارد!')
-                    break
-                except Exception as e:
-                    print(e)
-                    update.message.reply_text('متاسفانه در حال حاظر امکان دانلود وجود ندارد!\n لطفا بعدا تلاش کنید...')
-    if not activity_found:
-        update.message.reply_text(f'این فعالیت در درس {selected_course["name"]} وجود ندارد!')
-
-
-def get_filename(activity_name: str, content_description: str):
-    extension = content_description.split('.')[-1][:-1]
-    return f'./files/{activity_name}.{extension}'
+            download_link = file_mirror.link(activity)
+            if download_link:
+                send_download_link(update, selected_course['name'], activity, download_link, None)
+                return
+            position, joined = download_queue.submit(
+                activity['id'], partial(create_download_link, update, session, activity),
+                partial(send_download_link, update, selected_course['name'], activity))
+            if joined:
+                update.message.reply_text('این فایل در حال آماده سازی است، لینک دانلود برای شما هم ارسال می شود.')
+            elif position > 0:
+                update.message.reply_text(f'درخواست شما در صف دانلود قرار گرفت. نوبت شما: {digits.en_to_fa(str(position))}')
+            return
+    update.message.reply_text(f'این فعالیت در درس {selected_course["name"]} وجود ندارد!')
+
+
+def create_download_link(update: Update, session: requests.Session, activity: dict):
+    """ Download activity file and upload it to google drive, runs once for all requests of an activity """
+    download_link = file_mirror.link(activity)
+    if download_link:
+        return download_link
+    progress_message = update.message.reply_text('در حال ایجاد لینک دانلود...')
+    return file_mirror.mirror(session, activity, progress_message)
+
+
+def prefetch_files(dispatcher, course_id: str, fetcher_chat_id: int, activities: list, changed: list):
+    """ Watcher listener, files of added and modified activities are mirrored before anyone asks for them,
+    they wait behind download requests of users, other files of the course are left until they are asked for """
+    user_data = dispatcher.user_data.get(fetcher_chat_id)
+    if not user_data:
+        return
+    for activity in file_mirror.missing(changed):
+        if file_mirror.claim(activity['id']):
+            download_queue.submit(activity['id'], partial(prefetch_file, user_data, activity),
+                                  partial(prefetched, activity['id']), priority=1)
+
+
+def prefetch_file(user_data: dict, activity: dict):
+    session, _ = connected_session(user_data)
+    if not session:
+        return None
+    return file_mirror.mirror(session, activity)
+
+
+def prefetched(activity_id: str, download_link: str, error: Exception):
+    """ Download queue callback of a prefetch, also when it joined a download a user asked for """
+    file_mirror.release(activity_id)
+    if error:
+        logger.error('file of activity %s could not be prefetched', activity_id, exc_info=error)
+
+
+def send_download_link(update: Update, course_name: str, activity: dict, download_link: str, error: Exception):
+    """ Reply download link or failure of a download job """
+    if error:
+        logger.error('file of activity %s could not be downloaded', activity['id'], exc_info=error)
+        update.message.reply_text('متاسفانه در حال حاظر امکان دانلود وجود ندارد!\n لطفا بعدا تلاش کنید...')
+    elif not download_link:
+        update.message.reply_text('این فعالیت فایلی برای دانلود ندارد!')
+    else:
+        reply_msg = f'\n<b>نام درس:   {course_name}</b>\n\nعنوان فعالیت:   {activity["name"]}\n\n'
+        reply_msg += f'<b><a href="{download_link}">📥  دانلود</a></b>\n'
+        reply_msg += f'\n\n@ub_lms_bot\n'
+        update.message.reply_text(reply_msg, parse_mode='HTML')
 
 
 def confirm_exit(update: Update, context: CallbackContext):
     """ Confirm exit if user sets alert """
     if update.message.text == 'آره':
         chat_id = update.message.chat_id
-        job_if_exists(str(chat_id), context, remove=True)
+        course_watcher.unsubscribe(chat_id)
+        unschedule_alert_deadline(chat_id)
+        forget_session(chat_id)
         context.user_data.clear()
         update.message.reply_text(goodbye_msg, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
@@ -480,6 +578,8 @@ def exit(update: Update, context: CallbackContext):
         reply_msg = 'اطلاع رسانی فعال است که با خارج شدن شما غیر فعال می شود. آیا می خواهید خارج شوید؟'
         update.message.reply_text(reply_msg, reply_markup=markup)
         return CONFIRM_EXIT
+    unschedule_alert_deadline(update.message.chat_id)
+    forget_session(update.message.chat_id)
     context.user_data.clear()
     update.message.reply_text(goodbye_msg, reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
@@ -503,7 +603,11 @@ def admin(update: Update, _: CallbackContext):
     """ Handel admin command """
     chat_id = update.message.chat_id
     if chat_id == ADMIN_CHAT_ID:
-        update.message.reply_text('حالت ادمین فعال شد.\n لطفا پیام خود را برای ارسال به کاربران بنویسید')
+        if broadcaster.is_running():
+            update.message.reply_text(broadcaster.progress_text(broadcaster.state()) +
+                                      '\nبرای توقف ارسال cancel را بفرستید.')
+        else:
+            update.message.reply_text('حالت ادمین فعال شد.\n لطفا پیام خود را برای ارسال به کاربران بنویسید')
         return BROADCAST
     return ConversationHandler.END
 
@@ -512,30 +616,118 @@ def broadcast(update: Update, context: CallbackContext):
     """ Broadcast admin message to users """
     chat_id = update.message.chat_id
     if chat_id == ADMIN_CHAT_ID:
-        if update.message.text != 'cancel':
-            for key in db.keys():
-                try:
-                    context.bot.sendMessage(key.decode(), update.message.text)
-                except:
-                    pass
-            reply_msg = 'پیام به کاربران ارسال شد.'
-        else:
-            reply_msg = 'ارسال پیام لغو شد.'
-        update.message.reply_text(reply_msg)
+        if update.message.text == 'cancel':
+            broadcaster.cancel()
+            update.message.reply_text('ارسال پیام لغو شد.')
+        elif not broadcaster.submit(update.message.text, chat_id):
+            update.message.reply_text('ارسال پیام قبلی هنوز تمام نشده است.')
     return ConversationHandler.END
 
 
-def remove_files(context: CallbackContext):
-    """ Remove downloaded files """
-    for file in os.listdir('./files'):
-        try:
-            os.remove(f'./files/{file}')
-        except:
-            continue
+def schedule_restore(job_queue):
+    """ Restore saved subscriptions and deadline jobs from the start, a restore in progress is replaced """
+    for job in job_queue.get_jobs_by_name('restore_state'):
+        job.schedule_removal()
+    job_queue.run_repeating(callback=restore_state, name='restore_state', interval=RESTORE_INTERVAL, first=1,
+                            context={'watcher': 0, 'deadline': 0})
+
+
+def load_user_data(dispatcher, chat_id: int):
+    """ User data of a chat, a worker reloads it from redis since the chat may have moved from another worker """
+    user_data = dispatcher.user_data[chat_id]
+    if shard_worker and dispatcher.persistence:
+        dispatcher.persistence.refresh_user_data(chat_id, user_data)
+    return user_data
+
+
+def restore_state(context: CallbackContext):
+    """ Load saved subscriptions and deadline jobs in batches after a restart """
+    cursors = context.job.context
+    user_data_of = partial(load_user_data, context.dispatcher)
+    if cursors['watcher'] is not None:
+        cursors['watcher'] = course_watcher.restore_batch(user_data_of, cursors['watcher'], RESTORE_BATCH_SIZE) or None
+    if cursors['deadline'] is not None:
+        cursor, chat_ids = db.sscan('lms:deadline_chats', cursors['deadline'], count=RESTORE_BATCH_SIZE)
+        for chat_id in chat_ids:
+            if shard_worker and not shard_worker.owns(int(chat_id)):
+                continue
+            user_data_of(int(chat_id))
+            # restored chats run at their own spread position in the interval, not all at once
+            deadline_scheduler.add(int(chat_id))
+        cursors['deadline'] = cursor or None
+    if cursors['watcher'] is None and cursors['deadline'] is None:
+        context.job.schedule_removal()
+
+
+def persist_user(dispatcher, user_data: dict):
+    """ Save user data changed outside of handlers, e.g. a session renewed by a scheduled check """
+    chat_id = user_data.get('chat_id')
+    if chat_id and dispatcher.persistence:
+        dispatcher.persistence.update_user_data(chat_id, user_data)
+
+
+def subsystem_stats():
+    """ Stats functions of each part of the bot, shown to admin and exported as metrics """
+    return (('startup', startup.stats),
+            ('course_watcher', course_watcher.scheduler.stats),
+            ('alert_deadline', deadline_scheduler.stats),
+            ('deadline_index', deadline_index.stats),
+            ('lms_rate_limit', lms_limiter.stats),
+            ('lms_http', engine.stats),
+            ('lms_sessions', session_manager.cookie_store.stats),
+            ('download_queue', download_queue.stats),
+            ('file_mirror', file_mirror.stats),
+            ('files_cache', file_mirror.files.stats),
+            ('broadcast', broadcaster.stats),
+            ('outbox', outbox.stats),
+            ('lms_cache', lms_cache.stats),
+            ('telegram_files', telegram_files.stats),
+            ('webhook', lambda: webhook_workers.stats() if webhook_workers else {}),
+            ('shard', lambda: shard_worker.stats() if shard_worker else {}))
+
+
+def stats(update: Update, _: CallbackContext):
+    """ Show scheduler backlog and lag, lms rate limit and download queue to admin """
+    if update.message.chat_id != ADMIN_CHAT_ID:
+        return
+    reply_msg = ''
+    for name, stats_of in subsystem_stats():
+        values = stats_of()
+        reply_msg += f'{name}\n' + ''.join(
+            f'    {key}: {round(value, 1) if isinstance(value, float) else value}\n' for key, value in values.items())
+    update.message.reply_text(reply_msg)
+
+
+def run_front(updater: Updater):
+    """ Receive updates and route them to worker processes, the front keeps no user state """
+    members = ShardMembers(db)
+    router = ShardRouter(members)
+    members.run()
+    if BOT_MODE == 'webhook':
+        run_webhook(updater, router, WEBHOOK_URL, WEBHOOK_SECRET, port=PORT)
+    else:
+        updater.dispatcher.add_handler(TypeHandler(Update, lambda update, _: router.submit(update)))
+        updater.start_polling()
+        updater.idle()
 
 
 def main():
-    updater = Updater(TOKEN, use_context=True)
+    global webhook_workers, shard_worker
+    # login, events and week number do not need drive or the upload db, they are connected while updates are served
+    if file_storage.name == 'drive':
+        startup.connect('drive', file_storage.connect)
+    startup.connect('db_upload', db_upload.ping)
+    outbox.sent_listeners.append(startup.responded)
+    if METRICS_PORT:
+        MetricsServer(port=METRICS_PORT, profiler=PROFILER).start()
+    # connections for updates, dispatcher workers and outbox workers
+    bot = QueuedBot(TOKEN, base_url=TELEGRAM_API_URL, request=Request(con_pool_size=8 + OUTBOX_WORKERS + WEBHOOK_WORKERS),
+                    outbox=outbox)
+    if SHARD_ROLE == 'front':
+        run_front(Updater(bot=bot, use_context=True))
+        return
+    persistence = RedisPersistence(db)
+    updater = Updater(bot=bot, use_context=True, persistence=persistence)
 
     dispatcher = updater.dispatcher
 
@@ -563,6 +755,8 @@ def main():
         },
         fallbacks=[CommandHandler('exit', exit), MessageHandler(Filters.regex('^خروج$'), exit),
                    CommandHandler('start', start)],
+        name='main',
+        persistent=True,
     )
     admin_handler = ConversationHandler(
         entry_points=[CommandHandler('admin', admin)],
@@ -573,15 +767,50 @@ def main():
     )
     dispatcher.add_handler(conv_handler)
     dispatcher.add_handler(admin_handler)
+    dispatcher.add_handler(CommandHandler('stats', stats))
     dispatcher.add_handler(MessageHandler(Filters.command | Filters.text, unknown_handler))
+    for handlers in dispatcher.handlers.values():
+        instrument_handlers(handlers)
 
     job_queue = dispatcher.job_queue
-    job_queue.run_repeating(callback=remove_files, name='remove_files', interval=(24 * 60 * 60))
+    observe_job_lag(job_queue.scheduler)
+    for name, stats_of in subsystem_stats():
+        REGISTRY.register_stats(name, stats_of)
+    if SHARD_ROLE == 'worker':
+        # state of a chat is loaded from redis before each update, another worker may have owned the chat
+        shard_worker = ShardWorker(ShardMembers(db), SHARD_ID, dispatcher, WEBHOOK_WORKERS,
+                                   partial(persistence.refresh_update, dispatcher))
+        course_watcher.owns = shard_worker.owns
+        deadline_index.owns = shard_worker.owns
+        # alerts of owned chats are restored when the worker joins and when chats move to it
+        shard_worker.members.listeners.append(lambda old_ring, new_ring: schedule_restore(job_queue))
+    session_manager.renew_listeners.append(partial(persist_user, dispatcher))
+    course_watcher.change_listeners.append(course_changed)
+    if MIRROR_PREFETCH:
+        course_watcher.change_listeners.append(partial(prefetch_files, dispatcher))
+    # polling waits while the lms circuit is open, requests of users are answered right away that lms is down
+    course_watcher.scheduler.paused = lms_breaker.retry_after
+    deadline_scheduler.paused = lms_breaker.retry_after
+    course_watcher.start(updater.bot)
+    deadline_scheduler.callback = partial(index_deadlines, dispatcher)
+    deadline_scheduler.start()
+    deadline_index.start(partial(alert_deadline, dispatcher))
+    broadcaster.start(updater.bot)
+    if file_storage.name == 'local':
+        FileServer(file_storage, port=FILE_SERVER_PORT).start()
+    if not shard_worker:
+        schedule_restore(job_queue)
 
     dispatcher.add_error_handler(error)
-    updater.start_polling()
-
-    updater.idle()
+    if shard_worker:
+        job_queue.start()
+        shard_worker.run()
+    elif BOT_MODE == 'webhook':
+        webhook_workers = UpdateWorkers(dispatcher, WEBHOOK_WORKERS)
+        run_webhook(updater, webhook_workers, WEBHOOK_URL, WEBHOOK_SECRET, port=PORT)
+    else:
+        updater.start_polling()
+        updater.idle()
 
 
 if __name__ == '__main__':
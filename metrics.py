@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import re
+import sys
+import threading
+import time
+from collections import Counter as _Counter
+from contextlib import contextmanager
+from functools import wraps
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (parse_qs, urlsplit)
+
+from apscheduler.events import (EVENT_JOB_ADDED, EVENT_JOB_SUBMITTED)
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a redis call to a large file upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = ''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """ Count of events for each combination of label values """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f'{self.name}{_labels_text(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """ Distribution of durations in cumulative buckets for each combination of label values """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [count of each bucket, sum, count]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0, 0])
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe duration of the block, also when it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _labels_text(self.labels, key, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _labels_text(self.labels, key, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{_labels_text(self.labels, key)} {total}')
+                lines.append(f'{self.name}_count{_labels_text(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+    """ All metrics of the process, stats() of subsystems are exported as gauges when metrics are read """
+
+    def __init__(self, namespace: str = 'lms'):
+        self.namespace = namespace
+        self._metrics = []
+        self._stats = []
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()):
+        metric = Counter(f'{self.namespace}_{name}', documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        metric = Histogram(f'{self.namespace}_{name}', documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, name: str, stats):
+        """ Export numeric values of stats(), e.g. backlog and lag of a scheduler """
+        self._stats.append((name, stats))
+
+    def render(self):
+        """ Metrics in prometheus text format """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, stats in self._stats:
+            try:
+                values = stats()
+            except Exception:
+                logger.exception('stats of %s could not be read', name)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'{self.namespace}_{name}_{re.sub(r"[^a-zA-Z0-9_]", "_", key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.histogram('handler_seconds', 'Time of telegram update handlers', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('handler_errors_total', 'Telegram update handlers that raised', ('handler',))
+JOB_LAG_SECONDS = REGISTRY.histogram('job_lag_seconds', 'Delay of job queue jobs after their scheduled time',
+                                     ('job',))
+
+
+def timed(histogram: Histogram, **labels):
+    """ Decorator observing the duration of each call of a function or coroutine function """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_handlers(handlers: list):
+    """ Time callbacks of handlers and count their errors, conversation handlers are instrumented recursively """
+    for handler in handlers:
+        if hasattr(handler, 'states'):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            instrument_handlers(nested)
+        elif hasattr(handler, 'callback') and not hasattr(handler.callback, '__wrapped__'):
+            handler.callback = _instrumented(handler.callback)
+
+
+def _instrumented(callback):
+    name = getattr(callback, '__name__', None) or getattr(getattr(callback, 'func', None), '__name__', 'unknown')
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        with HANDLER_SECONDS.time(handler=name):
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+
+    return wrapper
+
+
+def observe_job_lag(scheduler):
+    """ Observe how late jobs of an apscheduler scheduler start, e.g. the job queue of telegram """
+    # a job that runs once is removed from the scheduler before it starts, its name is kept from when it was added
+    names = {}
+
+    def listener(event):
+        if event.code == EVENT_JOB_ADDED:
+            job = scheduler.get_job(event.job_id)
+            if job and len(names) < 10000:
+                names[event.job_id] = job.name
+            return
+        name = names.get(event.job_id, 'unknown')
+        if scheduler.get_job(event.job_id) is None:
+            names.pop(event.job_id, None)
+        now = time.time()
+        for run_time in event.scheduled_run_times:
+            JOB_LAG_SECONDS.observe(max(0.0, now - run_time.timestamp()), job=name)
+
+    scheduler.add_listener(listener, EVENT_JOB_ADDED | EVENT_JOB_SUBMITTED)
+
+
+def sample_stacks(seconds: float, interval: float = 0.01):
+    """ Sampling profiler, stacks of all threads are sampled every interval for seconds,
+    returns them in folded format, one 'frame;frame;frame count' line per stack, for flame graph tools """
+    own = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = _Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(f'{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit("/", 1)[-1]}'
+                              f':{frame.f_code.co_firstlineno})')
+                frame = frame.f_back
+            stacks[';'.join([names.get(ident, str(ident))] + frames[::-1])] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = None
+    profiler = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            body = self.registry.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif url.path == '/debug/profile' and self.profiler:
+            query = parse_qs(url.query)
+            seconds = min(float(query.get('seconds', ['10'])[0]), 120)
+            body = sample_stacks(seconds).encode()
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """ Serve /metrics for prometheus, and /debug/profile?seconds=N with stacks sampled for N seconds if profiler
+    is enabled """
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '0.0.0.0', port: int = 9464,
+                 profiler: bool = False):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry, 'profiler': profiler})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        """ Serve in a background thread """
+        threading.Thread(target=self.server.serve_forever, name='metrics_server', daemon=True).start()
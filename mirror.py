@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+import redis
+import requests
+
+from async_scraper import (lms_limiter, CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+from disk_cache import DiskCache
+from downloader import (ProgressReporter, stream_to_file)
+from fingerprint import (activity_fingerprint, is_modified)
+from parsers import parse_video_source
+
+logger = logging.getLogger(__name__)
+
+
+class FileMirror:
+    """ Mirror of activity files in a storage, e.g. google drive, a file is stored once for its content hash and
+    shared by all activities with the same content, old files are checked in storage instead of storing them again """
+
+    def __init__(self, db: redis.Redis, storage, files: DiskCache, prefix: str = 'lms:mirror',
+                 activity_ttl: float = 7 * 24 * 60 * 60, revalidate_interval: float = 24 * 60 * 60,
+                 lock_ttl: float = 30 * 60):
+        self.db = db
+        # DriveStorage or LocalStorage
+        self.storage = storage
+        # downloaded files, a file still on disk is not downloaded from lms again
+        self.files = files
+        self.prefix = prefix
+        # seconds an activity is trusted to have the same file, after it the file is downloaded again
+        # but uploaded only if its content changed
+        self.activity_ttl = activity_ttl
+        # seconds a stored file is used without checking it is still there
+        self.revalidate_interval = revalidate_interval
+        # seconds a prefetch of another process keeps an activity claimed
+        self.lock_ttl = lock_ttl
+        # value of claims of this process
+        self._owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._counts = {'downloaded': 0, 'uploaded': 0, 'deduplicated': 0, 'revalidated': 0, 'gone': 0}
+
+    def _key(self, name: str):
+        return f'{self.prefix}:{name}'
+
+    def link(self, activity: dict):
+        """ Download link of a mirrored activity, None if it is not mirrored, changed or its file is gone """
+        entry = self.db.hgetall(self._key(f'activity:{activity["id"]}'))
+        if not entry:
+            # links saved before the mirror, they expire by themselves
+            legacy_link = self.db.get(activity['id'])
+            return legacy_link.decode() if legacy_link else None
+        if is_modified(entry[b'fingerprint'].decode(), activity_fingerprint(activity)):
+            return None
+        return self._blob_link(entry[b'sha256'].decode(), activity)
+
+    def _blob_link(self, digest: str, activity: dict):
+        blob_key = self._key(f'blob:{digest}')
+        blob = self.db.hgetall(blob_key)
+        if not blob:
+            return None
+        # files mirrored before storages were pluggable keep their drive id in file_id
+        ref = (blob.get(b'ref') or blob[b'file_id']).decode()
+        link = self.storage.url(ref, activity['name'] + os.path.splitext(ref)[1])
+        if time.time() - float(blob[b'checked_at']) > self.revalidate_interval:
+            try:
+                exists = self.storage.exists(ref)
+            except Exception:
+                # storage is not available, the file is probably still there
+                logger.exception('file %s could not be checked in storage', ref)
+                return link
+            if not exists:
+                self.db.delete(blob_key)
+                self._count('gone')
+                return None
+            self.db.hset(blob_key, 'checked_at', time.time())
+            self._count('revalidated')
+        return link
+
+    def missing(self, activities: list):
+        """ Activities that are not mirrored or changed since they were mirrored """
+        pipeline = self.db.pipeline(transaction=False)
+        for activity in activities:
+            pipeline.hget(self._key(f'activity:{activity["id"]}'), 'fingerprint')
+            pipeline.exists(activity['id'])
+        results = pipeline.execute()
+        return [activity for activity, fingerprint, legacy in zip(activities, results[::2], results[1::2])
+                if not legacy and (fingerprint is None or
+                                   is_modified(fingerprint.decode(), activity_fingerprint(activity)))]
+
+    def claim(self, activity_id: str):
+        """ Claim prefetch of an activity, returns False if another process is prefetching it """
+        return bool(self.db.set(self._key(f'lock:{activity_id}'), self._owner, nx=True, ex=int(self.lock_ttl)))
+
+    def release(self, activity_id: str):
+        """ Release claim of an activity when its prefetch ended, so a failed one can be retried, a claim that
+        expired and was taken by another process is kept """
+        key = self._key(f'lock:{activity_id}')
+        with self.db.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                if pipeline.get(key) == self._owner.encode():
+                    pipeline.multi()
+                    pipeline.delete(key)
+                    pipeline.execute()
+            except redis.WatchError:
+                pass
+
+    def mirror(self, session: requests.Session, activity: dict, progress_message=None):
+        """ Download activity file and put it in storage unless a file with the same content is there,
+        returns download link, None if activity has no file, progress is shown on progress_message if it is given """
+        link = self.link(activity)
+        if link:
+            return link
+        # a changed activity is a new file
+        key = f'{activity["id"]}-{activity_fingerprint(activity)}'
+        with self.files.pin(key):
+            filename = self.files.get(key, self.activity_ttl)
+            if filename:
+                digest = file_digest(filename)
+            else:
+                filename, digest = self._download(session, activity, key, progress_message)
+                if filename is None:
+                    return None
+            link = self._blob_link(digest, activity)
+            if link:
+                self._count('deduplicated')
+            else:
+                ref = self.storage.store(filename, digest, progress_message and ProgressReporter(
+                    progress_message, 'در حال بارگذاری فایل...'))
+                link = self.storage.url(ref, activity['name'] + os.path.splitext(ref)[1])
+                self.db.hset(self._key(f'blob:{digest}'), mapping={'ref': ref, 'checked_at': time.time()})
+                self._count('uploaded')
+        pipeline = self.db.pipeline()
+        pipeline.hset(self._key(f'activity:{activity["id"]}'),
+                      mapping={'sha256': digest, 'fingerprint': activity_fingerprint(activity)})
+        pipeline.expire(self._key(f'activity:{activity["id"]}'), int(self.activity_ttl))
+        pipeline.execute()
+        return link
+
+    def _download(self, session: requests.Session, activity: dict, key: str, progress_message=None):
+        """ Download activity file from lms into disk cache, returns its path and content hash """
+        lms_limiter.wait()
+        with session.get(activity['url'], stream=True, timeout=(CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+            if response.status_code != 200:
+                return None, None
+            if response.headers.get("Content-Disposition"):  # check activity is video or attachment file
+                return self._save(response, activity, key, progress_message)
+            activity_download_url = parse_video_source(response.content)
+        if not activity_download_url:
+            # activity has no file, e.g. a quiz or forum
+            return None, None
+        lms_limiter.wait()
+        with session.get(activity_download_url, stream=True,
+                         timeout=(CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+            if response.status_code != 200:
+                return None, None
+            return self._save(response, activity, key, progress_message)
+
+    def _save(self, response: requests.Response, activity: dict, key: str, progress_message=None):
+        """ Stream a file response into disk cache, returns its path and content hash """
+        digest = hashlib.sha256()
+        with self.files.write(key, get_filename(activity['name'],
+                                                response.headers.get("Content-Disposition"))) as temp_path:
+            stream_to_file(response, temp_path,
+                           progress_message and ProgressReporter(progress_message, 'در حال دریافت فایل از سامانه...'),
+                           digest)
+        self._count('downloaded')
+        return self.files.path(key), digest.hexdigest()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+
+    def stats(self):
+        """ Files downloaded from lms, stored, found in storage by content and checked in storage """
+        with self._lock:
+            return dict(self._counts)
+
+
+def get_filename(activity_name: str, content_description: str):
+    extension = content_description.split('.')[-1][:-1]
+    return f'{activity_name}.{extension}'
+
+
+def file_digest(filename: str):
+    """ sha256 of a file on disk, read in chunks """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
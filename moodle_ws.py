@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import time
+
+import requests
+from decouple import config
+
+import async_scraper
+from async_scraper import (engine, gather_activities, SessionExpiredError, LMSUnavailableError, UNAVAILABLE_MSG)
+from parsers import (BASE_URL, clear_text, event_status, format_deadline)
+
+logger = logging.getLogger(__name__)
+
+WS_SERVICE = config('LMS_WS_SERVICE', default='moodle_mobile_app')
+
+
+class WebServiceError(Exception):
+    """ Moodle returned an exception instead of the result of a web service function """
+
+
+async def call(session: requests.Session, function: str, **params):
+    """ Call a moodle web service function with token of user session """
+    data = {'wstoken': session.ws_token, 'wsfunction': function, 'moodlewsrestformat': 'json'}
+    data.update(params)
+    _, content = await engine.fetch(session, 'POST', f'{BASE_URL}webservice/rest/server.php', data=data)
+    result = json.loads(content)
+    if isinstance(result, dict) and 'exception' in result:
+        raise WebServiceError(result.get('errorcode', result['exception']))
+    return result
+
+
+def has_token(session: requests.Session):
+    return bool(getattr(session, 'ws_token', None))
+
+
+async def get_token(session: requests.Session, username: str, password: str):
+    """ Get web service token of user, None if web services are disabled """
+    _, content = await engine.fetch(session, 'POST', f'{BASE_URL}login/token.php',
+                                    data={'username': username, 'password': password, 'service': WS_SERVICE})
+    return json.loads(content).get('token')
+
+
+async def async_sign_in(username: str, password: str):
+    """ Sign in to lms, cookie session is still needed to download activity files """
+    session, msg = await async_scraper.async_sign_in(username, password)
+    if session:
+        try:
+            session.ws_token = await get_token(session, username, password)
+            if session.ws_token:
+                session.ws_userid = (await call(session, 'core_webservice_get_site_info'))['userid']
+        except (asyncio.TimeoutError, Exception):
+            session.ws_token = None
+    return session, msg
+
+
+async def async_session_is_connected(session: requests.Session):
+    """ Check user session is connected """
+    return await async_scraper.async_session_is_connected(session)
+
+
+async def async_get_student_courses(session: requests.Session):
+    """ Find all student courses """
+    if not has_token(session):
+        return await async_scraper.async_get_student_courses(session)
+    try:
+        courses = await call(session, 'core_enrol_get_users_courses', userid=session.ws_userid)
+        return [{'id': str(course['id']), 'name': clear_text(course['fullname'])} for course in courses], ''
+    except WebServiceError:
+        return await async_scraper.async_get_student_courses(session)
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('courses could not be read from web service')
+        return None, 'لطفا دوباره تلاش کنید!'
+
+
+async def async_get_course_activities(session: requests.Session, course_id: str):
+    """ Find all activities of a course """
+    if not has_token(session):
+        return await async_scraper.async_get_course_activities(session, course_id)
+    try:
+        sections = await call(session, 'core_course_get_contents', courseid=course_id)
+        activities = []
+        for section in sections:
+            for module in section['modules']:
+                # course page only has a completion form for manual completion
+                if module.get('completion') != 1:
+                    continue
+                completed = module.get('completiondata', {}).get('state', 0) != 0
+                activities.append({
+                    'id': str(module['id']),
+                    'name': clear_text(module['name']),
+                    'status': '0' if completed else '1',
+                    'url': f'{BASE_URL}/mod/resource/view.php?id={module["id"]}',
+                    # a replaced file has a new modification time and usually a new size, prefixed with its
+                    # source since the course page shows revisions in another format
+                    'revision': 'ws:' + ','.join(f'{content.get("timemodified")}:{content.get("filesize")}'
+                                                 for content in module['contents'])
+                    if module.get('contents') else ''
+                })
+        return activities, ''
+    except WebServiceError:
+        return await async_scraper.async_get_course_activities(session, course_id)
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('activities of course %s could not be read from web service', course_id)
+        return None, 'لطفا دوباره تلاش کنید!'
+
+
+async def async_get_changed_activities(session: requests.Session, course_id: str, page_hash: str = None):
+    """ Find activities of a course, web service results have no page hash so they are always compared """
+    if not has_token(session):
+        return await async_scraper.async_get_changed_activities(session, course_id, page_hash)
+    activities, msg = await async_get_course_activities(session, course_id)
+    return ((None, activities), msg) if activities is not None else (None, msg)
+
+
+async def async_get_many_activities(requests_list: list, return_exceptions: bool = False):
+    """ Fetch activities of many (session, course_id) pairs concurrently """
+    return await gather_activities(async_get_course_activities, requests_list, return_exceptions)
+
+
+async def async_get_events(session: requests.Session):
+    """ Find upcoming events """
+    if not session:
+        return None, UNAVAILABLE_MSG
+    if not has_token(session):
+        return await async_scraper.async_get_events(session)
+    try:
+        result = await call(session, 'core_calendar_get_action_events_by_timesort', timesortfrom=int(time.time()))
+        events_list = []
+        for event in result['events']:
+            action = event.get('action')
+            # calendar page shows "go to activity" link when there is nothing left to do
+            status_text = [] if not action else ['افزودن تحویلی' if action.get('actionable') else 'رفتن به فعالیت']
+            events_list.append({
+                'id': str(event['id']),
+                'name': clear_text(event['name']),
+                'lesson': clear_text(event.get('course', {}).get('fullname', '')),
+                'deadline': format_deadline(event['timesort']),
+                'timestamp': event['timesort'],
+                'status': event_status(event['name'], status_text, str)
+            })
+        return events_list, ''
+    except WebServiceError:
+        return await async_scraper.async_get_events(session)
+    except SessionExpiredError:
+        raise
+    except LMSUnavailableError:
+        return None, UNAVAILABLE_MSG
+    except Exception:
+        logger.exception('events could not be read from web service')
+        return None, 'لطفا دوباره تلاش کنید!'
+
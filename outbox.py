@@ -0,0 +1,277 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+
+from telegram import Bot
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import (RetryAfter, TimedOut, NetworkError, BadRequest)
+
+from metrics import REGISTRY
+from ratelimit import TokenBucket
+
+TELEGRAM_SECONDS = REGISTRY.histogram('telegram_seconds', 'Time of telegram bot api requests')
+DELIVERY_SECONDS = REGISTRY.histogram('delivery_seconds', 'Time from queueing a telegram request to its end')
+
+logger = logging.getLogger(__name__)
+
+
+def _utf16_length(text: str):
+    """ Telegram counts message length in utf-16 code units, e.g. an emoji is two units """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH):
+    """ Split text into messages of at most limit length, cut at the end of a paragraph, a line or a word
+    so an event or activity is not split between two messages """
+    chunks = []
+    while _utf16_length(text) > limit:
+        size = limit
+        while _utf16_length(text[:size]) > limit:
+            size -= _utf16_length(text[:size]) - limit
+        for separator in ('\n\n', '\n', ' '):
+            cut = text.rfind(separator, 0, size)
+            if cut > 0:
+                break
+        else:
+            cut = size
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class _Item:
+    def __init__(self, call):
+        self.call = call
+        self.future = Future()
+        self.created_at = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    """ Single delivery path of all outgoing telegram requests, one request per chat is in flight at a time so
+    messages keep their order, requests are limited globally and per chat and retried on flood waits and
+    network errors """
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, workers: int = 8,
+                 max_retries: int = 5):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.limiter = TokenBucket(rate)
+        # functions called with chat_id after each request that was sent
+        self.sent_listeners = []
+        self._cond = threading.Condition()
+        # heap of (ready time, sequence, chat_id) of chats with pending requests and none in flight
+        self._ready = []
+        self._sequence = itertools.count()
+        # chat_id -> pending requests in order
+        self._chats = {}
+        # chat_id -> token bucket, dropped when idle long enough to be full again
+        self._buckets = {}
+        self._pending = 0
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._total_latency = 0
+        self._max_latency = 0
+        for idx in range(workers):
+            threading.Thread(target=self._work, name=f'outbox_{idx}', daemon=True).start()
+
+    def submit(self, chat_id, call):
+        """ Queue call(), a request to chat_id, and return a future of its result """
+        item = _Item(call)
+        with self._cond:
+            self._pending += 1
+            pending = self._chats.get(chat_id)
+            if pending is None:
+                self._chats[chat_id] = deque([item])
+                self._push(chat_id, self._bucket(chat_id).reserve())
+            else:
+                pending.append(item)
+        return item.future
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune_buckets()
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        idle = self.chat_burst / self.chat_rate
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._chats and now - bucket._updated > idle]:
+            del self._buckets[chat_id]
+
+    def _push(self, chat_id, delay: float):
+        heapq.heappush(self._ready, (time.monotonic() + delay, next(self._sequence), chat_id))
+        self._cond.notify()
+
+    def _next(self):
+        """ Pop next ready chat and its first request, wait until there is one """
+        while True:
+            if self._ready:
+                ready_at, _, chat_id = self._ready[0]
+                delay = ready_at - time.monotonic()
+                if delay <= 0:
+                    heapq.heappop(self._ready)
+                    return chat_id, self._chats[chat_id][0]
+                self._cond.wait(delay)
+            else:
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                chat_id, item = self._next()
+            self.limiter.wait()
+            retry_after = None
+            try:
+                with TELEGRAM_SECONDS.time():
+                    result = item.call()
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                error = e
+            except BadRequest as e:
+                error = e
+            except (TimedOut, NetworkError) as e:
+                # exponential backoff, 1, 2, 4, ... seconds
+                retry_after = 2 ** item.attempts
+                error = e
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            with self._cond:
+                pending = self._chats[chat_id]
+                if error is not None and retry_after is not None and item.attempts < self.max_retries:
+                    # retried request stays first so later messages of the chat are not sent before it
+                    item.attempts += 1
+                    self._retried += 1
+                    self._push(chat_id, retry_after)
+                    continue
+                pending.popleft()
+                self._pending -= 1
+                latency = time.monotonic() - item.created_at
+                self._total_latency += latency
+                self._max_latency = max(self._max_latency, latency)
+                DELIVERY_SECONDS.observe(latency)
+                if error is None:
+                    self._sent += 1
+                else:
+                    self._failed += 1
+                if pending:
+                    self._push(chat_id, self._bucket(chat_id).reserve())
+                else:
+                    del self._chats[chat_id]
+            if error is None:
+                for listener in self.sent_listeners:
+                    listener(chat_id)
+                item.future.set_result(result)
+            else:
+                item.future.set_exception(error)
+
+    def stats(self):
+        """ Queue depth, delivery counts and latency from queueing to delivery in seconds """
+        with self._cond:
+            done = self._sent + self._failed
+            return {
+                'depth': self._pending,
+                'chats': len(self._chats),
+                'sent': self._sent,
+                'failed': self._failed,
+                'retried': self._retried,
+                'avg_latency': self._total_latency / done if done else 0,
+                'max_latency': self._max_latency,
+                'rate_limited': self.limiter.waited,
+            }
+
+
+class PendingMessage:
+    """ Result of a request queued in outbox, the sender does not wait for delivery, reading an attribute waits for
+    the sent message, e.g. message_id of a progress message, a failure nobody waited for is logged """
+
+    def __init__(self, future: Future):
+        self._future = future
+        self._waited = False
+
+    def result(self, timeout: float = None):
+        """ Wait for delivery and return the sent message, raises the error of a failed request """
+        self._waited = True
+        return self._future.result(timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.result(), name)
+
+    def __del__(self):
+        if not self._waited:
+            self._future.add_done_callback(_log_failure)
+
+
+def _log_failure(future: Future):
+    error = future.exception()
+    if error is not None:
+        logger.error('telegram request failed', exc_info=error)
+
+
+def delivered(message):
+    """ Wait for a message sent by QueuedBot, for callers that handle its errors, e.g. a blocked user """
+    return message.result() if isinstance(message, PendingMessage) else message
+
+
+def _chain(futures: list):
+    """ Future of the last message of a split text, or of the first error, requests of a chat end in order """
+    chained = Future()
+
+    def finish(_):
+        for future in futures:
+            if future.exception() is not None:
+                chained.set_exception(future.exception())
+                return
+        chained.set_result(futures[-1].result())
+
+    futures[-1].add_done_callback(finish)
+    return chained
+
+
+class QueuedBot(Bot):
+    """ Bot that sends messages through an outbox without waiting for them, long texts are split into several
+    messages, reply markup is attached to the last one and the last message is returned as a PendingMessage """
+
+    def __init__(self, *args, outbox: Outbox, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox
+
+    def send_message(self, chat_id, text: str, *args, **kwargs):
+        if kwargs.get('entities') or len(args) >= 5:
+            # entities or positional reply markup can not be split, send as is
+            return PendingMessage(self.outbox.submit(chat_id, partial(super().send_message, chat_id, text,
+                                                                      *args, **kwargs)))
+        reply_markup = kwargs.pop('reply_markup', None)
+        chunks = split_text(text)
+        futures = []
+        for idx, chunk in enumerate(chunks):
+            if idx == len(chunks) - 1:
+                kwargs['reply_markup'] = reply_markup
+            futures.append(self.outbox.submit(chat_id, partial(super().send_message, chat_id, chunk, *args, **kwargs)))
+        return PendingMessage(_chain(futures))
+
+    def edit_message_text(self, text: str, chat_id=None, message_id=None, *args, **kwargs):
+        return PendingMessage(self.outbox.submit(chat_id, partial(super().edit_message_text, text, chat_id, message_id,
+                                                                  *args, **kwargs)))
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return PendingMessage(self.outbox.submit(chat_id, partial(super().send_photo, chat_id, *args, **kwargs)))
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return PendingMessage(self.outbox.submit(chat_id, partial(super().send_document, chat_id, *args, **kwargs)))
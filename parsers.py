@@ -0,0 +1,271 @@
+import datetime
+import hashlib
+import re
+
+import jdatetime
+import pytz
+from bs4 import BeautifulSoup
+from decouple import config
+
+from metrics import (REGISTRY, timed)
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+BASE_URL = config('LMS_BASE_URL', default='https://vlms.ub.ac.ir/')
+TIMEZONE = pytz.timezone(config('LMS_TIMEZONE', default='Asia/Tehran'))
+
+# sesskey of a session in links and forms
+_SESSKEY = re.compile(rb'sesskey(?:=|" value=")[0-9A-Za-z]+')
+# Persian and Arabic digits to latin digits
+_DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+# XPath of elements having a css class, same as BeautifulSoup class matching
+_CLASS = 'contains(concat(" ", normalize-space(@class), " "), " {} ")'
+
+
+def _document(content: bytes):
+    """ Parse html with lxml, None for an empty page """
+    return etree.HTML(content, etree.HTMLParser(encoding='utf-8', remove_comments=True, remove_pis=True))
+
+
+def _text(element):
+    return ''.join(element.itertext())
+
+
+def lxml_parse_login_token(content: bytes):
+    """ Find logintoken of login page """
+    document = _document(content)
+    return document.xpath('//*[@name="logintoken"]/@value')[0]
+
+
+def lxml_parse_student_courses(content: bytes):
+    """ Find all student courses in dashboard page """
+    courses = []
+    document = _document(content)
+    if document is None:
+        return courses
+    for a_tag in document.xpath(f'//a[{_CLASS.format("dropdown-item")}]'):
+        if f'{BASE_URL}course/view.php' in a_tag.get('href'):
+            courses.append({
+                'id': a_tag.get('href').split('=')[-1],
+                'name': clear_text(_text(a_tag))
+            })
+    return courses
+
+
+def lxml_parse_course_activities(content: bytes):
+    """ Find all activities in course page """
+    document = _document(content)
+    if document is None:
+        return []
+    activities_id = document.xpath('//input[@name="id"]/@value')
+    activities_name = document.xpath('//input[@name="modulename"]/@value')
+    activities_status = document.xpath('//input[@name="completionstate"]/@value')
+    # size, type and upload or modified date of files, only shown when course settings show resource details,
+    # prefixed with its source since the web service shows revisions in another format
+    details = {}
+    for span in document.xpath(f'//li[starts-with(@id, "module-")]//span[{_CLASS.format("resourcelinkdetails")}]'):
+        details.setdefault(span.xpath('ancestor::li[starts-with(@id, "module-")][1]/@id')[0][7:],
+                           f'html:{clear_text(_text(span))}')
+    activities = []
+    for idx in range(len(activities_id)):
+        activities.append(
+            {
+                'id': activities_id[idx],
+                'name': clear_text(activities_name[idx]),
+                'status': activities_status[idx],
+                'url': f'{BASE_URL}/mod/resource/view.php?id={activities_id[idx]}',
+                'revision': details.get(activities_id[idx], '')
+            }
+        )
+    return activities
+
+
+def lxml_parse_events(content: bytes):
+    """ Find upcoming events in calendar page """
+    events_list = []
+    document = _document(content)
+    if document is None:
+        return events_list
+    for event in document.xpath(f'//div[{_CLASS.format("event")}]'):
+        event_name = clear_text(
+            _text(event.xpath(f'.//div[{_CLASS.format("card")}]//h3[{_CLASS.format("name")}]')[0]))
+        event_description_divs = event.xpath(f'(.//div[{_CLASS.format("description")}])[1]//div')
+        event_lesson_name = clear_text(_text(event_description_divs[-1]))
+        event_deadline = clear_text(_text(event_description_divs[0]))
+        day_urls = event_description_divs[0].xpath('.//a/@href')
+        events_list.append({
+            'id': event.get('data-event-id') or event_key(event_name, event_lesson_name),
+            'name': event_name,
+            'lesson': event_lesson_name,
+            'deadline': event_deadline,
+            'timestamp': deadline_timestamp(day_urls[0] if day_urls else '', event_deadline),
+            'status': event_status(event_name, event.xpath(f'(.//a[{_CLASS.format("card-link")}])[1]'),
+                                   _text)
+        })
+    return events_list
+
+
+def lxml_parse_video_source(content: bytes):
+    """ Find video url of a video activity page, None for an activity without video, e.g. a quiz or forum """
+    document = _document(content)
+    sources = document.xpath('//source/@src') if document is not None else []
+    return sources[0] if sources else None
+
+
+def soup_parse_login_token(content: bytes):
+    """ Find logintoken of login page """
+    login_page = BeautifulSoup(content, 'html.parser')
+    return login_page.find(attrs={"name": "logintoken"})['value']
+
+
+def soup_parse_student_courses(content: bytes):
+    """ Find all student courses in dashboard page """
+    courses = []
+    dashboard_page = BeautifulSoup(content, 'html.parser')
+    for a_tag in dashboard_page.find_all('a', {'class': 'dropdown-item'}):
+        if f'{BASE_URL}course/view.php' in a_tag['href']:
+            courses.append({
+                'id': str(a_tag['href']).split('=')[-1],
+                'name': clear_text(a_tag.text)
+            })
+    return courses
+
+
+def soup_parse_course_activities(content: bytes):
+    """ Find all activities in course page """
+    course_page = BeautifulSoup(content, 'html.parser')
+    activities_id = list(course_page.find_all('input', {'name': 'id'}))
+    activities_name = course_page.find_all('input', {'name': 'modulename'})
+    activities_status = course_page.find_all('input', {'name': 'completionstate'})
+    details = {}
+    for span in course_page.find_all('span', {'class': 'resourcelinkdetails'}):
+        module = span.find_parent('li', id=re.compile('^module-'))
+        if module:
+            details.setdefault(module['id'][7:], f'html:{clear_text(span.text)}')
+    activities = []
+    for idx in range(len(activities_id)):
+        activity_id = activities_id[idx]['value']
+        activity_name = clear_text(activities_name[idx]['value'])
+        activity_status = activities_status[idx]['value']
+        activity_url = f'{BASE_URL}/mod/resource/view.php?id={activity_id}'
+        activities.append(
+            {
+                'id': activity_id,
+                'name': activity_name,
+                'status': activity_status,
+                'url': activity_url,
+                'revision': details.get(activity_id, '')
+            }
+        )
+    return activities
+
+
+def soup_parse_events(content: bytes):
+    """ Find upcoming events in calendar page """
+    events_list = []
+    events_page = BeautifulSoup(content, 'html.parser')
+    events = events_page.find_all('div', {'class': 'event'})
+    for event in events:
+        event_name = clear_text(
+            str(event.find('div', {'class': 'card'}).find('h3', {'class': 'name'}).text))
+        event_description = event.find('div', {'class': 'description'})
+        event_lesson_name = clear_text(str(event_description.find_all('div')[-1].text))
+        event_deadline = clear_text(str(event_description.find_all('div')[0].text))
+        day_link = event_description.find_all('div')[0].find('a')
+        event_status_tag = event.find('a', {'class': 'card-link'})
+        events_list.append({
+            'id': event.get('data-event-id') or event_key(event_name, event_lesson_name),
+            'name': event_name,
+            'lesson': event_lesson_name,
+            'deadline': event_deadline,
+            'timestamp': deadline_timestamp(day_link.get('href', '') if day_link else '', event_deadline),
+            'status': event_status(event_name, [event_status_tag] if event_status_tag else [],
+                                   lambda tag: tag.text)
+        })
+    return events_list
+
+
+def soup_parse_video_source(content: bytes):
+    """ Find video url of a video activity page, None for an activity without video, e.g. a quiz or forum """
+    source = BeautifulSoup(content, 'html.parser').find('source')
+    return source.get('src') if source else None
+
+
+def event_status(event_name: str, status_tags: list, text):
+    """ Find submission status of an event """
+    if 'closes' in event_name or 'opens' in event_name:
+        return 'انجام نشده است. \U0000274C'
+    if status_tags:
+        return 'تحویل داده شده است. \U00002705' if 'رفتن به فعالیت' in text(status_tags[0]) else 'تحویل داده نشده است. \U0000274C'
+    return 'مشخص نیست'
+
+
+def course_page_hash(content: bytes):
+    """ Hash of the course content part of a course page without parsing it, sesskey of the session is left out
+    so the same page of another session has the same hash """
+    start = content.find(b'class="course-content"')
+    if start != -1:
+        content = content[start:]
+    return hashlib.md5(_SESSKEY.sub(b'', content)).hexdigest()
+
+
+def event_key(event_name: str, lesson_name: str):
+    """ Stable id of an event without data-event-id """
+    return hashlib.md5(f'{lesson_name}/{event_name}'.encode()).hexdigest()[:12]
+
+
+def deadline_timestamp(day_url: str, deadline: str):
+    """ Unix time of a deadline from the day link of calendar page and the clock after it,
+    e.g. '.../calendar/view.php?view=day&time=1640000000' and 'امروز, 23:59', None if they are not found """
+    day = re.search(r'[?&]time=(\d+)', day_url)
+    clock = re.search(r'(\d{1,2}):(\d{2})\s*$', deadline.translate(_DIGITS))
+    if not day or not clock:
+        return None
+    date = datetime.datetime.fromtimestamp(int(day.group(1)), TIMEZONE).date()
+    moment = TIMEZONE.localize(datetime.datetime(date.year, date.month, date.day, int(clock.group(1)),
+                                                 int(clock.group(2))))
+    return int(moment.timestamp())
+
+
+def format_deadline(timestamp: int):
+    """ Format deadline like calendar page of lms, e.g. 'فردا, 23:59' """
+    deadline = jdatetime.datetime.fromtimestamp(timestamp, TIMEZONE)
+    today = jdatetime.datetime.now(TIMEZONE).date()
+    clock = deadline.strftime('%H:%M')
+    if deadline.date() == today:
+        return f'امروز, {clock}'
+    if deadline.date() == today + jdatetime.timedelta(days=1):
+        return f'فردا, {clock}'
+    return f'{jdatetime.date.j_weekdays_fa[deadline.weekday()]}, {deadline.day} ' \
+           f'{jdatetime.date.j_months_fa[deadline.month - 1]}, {clock}'
+
+
+def clear_text(text: str):
+    """ Clear text """
+    return ' '.join(text.split())
+
+
+# lxml parses only with C code and XPath, BeautifulSoup is kept as fallback when lxml is not installed
+if etree is not None:
+    parse_login_token = lxml_parse_login_token
+    parse_student_courses = lxml_parse_student_courses
+    parse_course_activities = lxml_parse_course_activities
+    parse_events = lxml_parse_events
+    parse_video_source = lxml_parse_video_source
+else:
+    parse_login_token = soup_parse_login_token
+    parse_student_courses = soup_parse_student_courses
+    parse_course_activities = soup_parse_course_activities
+    parse_events = soup_parse_events
+    parse_video_source = soup_parse_video_source
+
+# parse time is measured apart from lms request time
+PARSE_SECONDS = REGISTRY.histogram('parse_seconds', 'Time of parsing lms pages', ('parser',))
+parse_login_token = timed(PARSE_SECONDS, parser='login_token')(parse_login_token)
+parse_student_courses = timed(PARSE_SECONDS, parser='student_courses')(parse_student_courses)
+parse_course_activities = timed(PARSE_SECONDS, parser='course_activities')(parse_course_activities)
+parse_events = timed(PARSE_SECONDS, parser='events')(parse_events)
+parse_video_source = timed(PARSE_SECONDS, parser='video_source')(parse_video_source)
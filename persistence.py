@@ -0,0 +1,124 @@
+import hashlib
+import json
+import logging
+import pickle
+import zlib
+from collections import defaultdict
+
+import redis
+from telegram import Update
+from telegram.ext import (BasePersistence, ConversationHandler, Dispatcher)
+
+logger = logging.getLogger(__name__)
+
+
+class RedisPersistence(BasePersistence):
+    """ Keep user data and conversation states in redis so they survive restarts,
+    each user is stored in one hash field and only written when it changed """
+
+    def __init__(self, db: redis.Redis, prefix: str = 'lms',
+                 excluded_keys: tuple = ('username', 'password', 'session')):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.db = db
+        self.prefix = prefix
+        # login information is never stored, sessions are stored encrypted by session_manager
+        self.excluded_keys = excluded_keys
+        self._digests = {}
+
+    @classmethod
+    def replace_bot(cls, obj):
+        # bot instances are never put in user data, skip the deep copy of every user
+        return obj
+
+    def insert_bot(self, obj):
+        return obj
+
+    def _key(self, name: str):
+        return f'{self.prefix}:{name}'
+
+    def get_user_data(self):
+        user_data = defaultdict(dict)
+        for user_id, blob in self.db.hscan_iter(self._key('user_data'), count=500):
+            try:
+                user_data[int(user_id)] = pickle.loads(zlib.decompress(blob))
+                self._digests[int(user_id)] = hashlib.md5(blob).digest()
+            except Exception:
+                logger.exception('user data of %s could not be loaded', user_id)
+        return user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str):
+        conversations = self.db.hgetall(self._key(f'conversations:{name}'))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in conversations.items()}
+
+    def update_conversation(self, name: str, key: tuple, new_state):
+        conversations_key = self._key(f'conversations:{name}')
+        if new_state is None:
+            self.db.hdel(conversations_key, json.dumps(key))
+        else:
+            self.db.hset(conversations_key, json.dumps(key), json.dumps(new_state))
+
+    def update_user_data(self, user_id: int, data: dict):
+        if not data:
+            if self._digests.pop(user_id, None) is not None:
+                self.db.hdel(self._key('user_data'), user_id)
+            return
+        stored = {key: value for key, value in dict(data).items() if key not in self.excluded_keys}
+        blob = zlib.compress(pickle.dumps(stored, protocol=pickle.HIGHEST_PROTOCOL))
+        digest = hashlib.md5(blob).digest()
+        if self._digests.get(user_id) != digest:
+            self.db.hset(self._key('user_data'), user_id, blob)
+            self._digests[user_id] = digest
+
+    def refresh_user_data(self, user_id: int, data: dict):
+        """ Reload user data in place if another process changed it, login information of this process is kept """
+        blob = self.db.hget(self._key('user_data'), user_id)
+        digest = hashlib.md5(blob).digest() if blob else None
+        if digest == self._digests.get(user_id):
+            return
+        kept = {key: data[key] for key in self.excluded_keys if key in data}
+        data.clear()
+        if blob:
+            data.update(pickle.loads(zlib.decompress(blob)))
+            data.update(kept)
+            self._digests[user_id] = digest
+        else:
+            self._digests.pop(user_id, None)
+
+    def get_conversation(self, name: str, key: tuple):
+        state = self.db.hget(self._key(f'conversations:{name}'), json.dumps(key))
+        return json.loads(state) if state is not None else None
+
+    def refresh_update(self, dispatcher: Dispatcher, update: Update):
+        """ Load user data and conversation states of an update, they may be changed by another process """
+        if update.effective_user:
+            self.refresh_user_data(update.effective_user.id, dispatcher.user_data[update.effective_user.id])
+        for handlers in dispatcher.handlers.values():
+            for handler in handlers:
+                if not isinstance(handler, ConversationHandler) or not handler.persistent:
+                    continue
+                try:
+                    key = handler._get_key(update)
+                except AttributeError:
+                    # update has no chat or user, e.g. a poll update
+                    continue
+                state = self.get_conversation(handler.name, key)
+                with handler._conversations_lock:
+                    if state is None:
+                        handler.conversations.pop(key, None)
+                    else:
+                        handler.conversations[key] = state
+
+    def update_chat_data(self, chat_id: int, data: dict):
+        pass
+
+    def update_bot_data(self, data: dict):
+        pass
+
+    def flush(self):
+        pass
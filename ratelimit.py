@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """ Thread safe token bucket, rate tokens per second with bursts up to capacity """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0
+        self.acquired = 0
+
+    def reserve(self, tokens: float = 1):
+        """ Take tokens and return seconds to wait before using them """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            self.acquired += 1
+            delay = 0 if self._tokens >= 0 else -self._tokens / self.rate
+            if delay:
+                self.waited += 1
+            return delay
+
+    def wait(self, tokens: float = 1):
+        """ Block current thread until tokens are available """
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def async_wait(self, tokens: float = 1):
+        """ Wait in event loop until tokens are available """
+        delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        """ Rate, number of acquired tokens and how many of them had to wait """
+        return {'rate': self.rate, 'acquired': self.acquired, 'waited': self.waited}
@@ -0,0 +1,127 @@
+import heapq
+import logging
+import random
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class SpreadScheduler:
+    """ Run periodic work of many keys from a few threads, keys are spread evenly over the interval with jitter
+    so work added in the same minute does not keep running in the same minute """
+
+    def __init__(self, name: str, interval: float, callback, workers: int = 1, jitter: float = 0.05):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.workers = workers
+        self.jitter = jitter
+        # function returning seconds to hold off work, e.g. while lms is down, runs are moved after it
+        self.paused = None
+        self._cond = threading.Condition()
+        # heap of (due time, key), keys removed or rescheduled are skipped by checking _due
+        self._heap = []
+        self._due = {}
+        self._running = 0
+        self._last_lag = 0
+        self._max_lag = 0
+        self._runs = 0
+        self._postponed = 0
+        self._threads = []
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'{self.name}_{idx}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def offset(self, key):
+        """ Stable position of key in the interval """
+        return zlib.crc32(str(key).encode()) / 2 ** 32 * self.interval
+
+    def add(self, key, first: float = None):
+        """ Schedule key, first run is after first seconds or at its spread position in the interval """
+        with self._cond:
+            if key in self._due:
+                return
+            due = time.monotonic() + (self.offset(key) if first is None else first)
+            self._push(key, due)
+
+    def remove(self, key):
+        with self._cond:
+            self._due.pop(key, None)
+
+    def keys(self):
+        """ Scheduled keys """
+        with self._cond:
+            return list(self._due)
+
+    def __contains__(self, key):
+        with self._cond:
+            return key in self._due
+
+    def _push(self, key, due: float):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, str(key), key))
+        self._cond.notify()
+
+    def _next_due(self):
+        """ Pop next due key or return seconds to wait for it """
+        while self._heap:
+            due, _, key = self._heap[0]
+            if self._due.get(key) != due:
+                heapq.heappop(self._heap)
+                continue
+            now = time.monotonic()
+            if due > now:
+                return None, due - now
+            heapq.heappop(self._heap)
+            self._last_lag = now - due
+            self._max_lag = max(self._max_lag, self._last_lag)
+            return key, 0
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                key, timeout = self._next_due()
+                while key is None:
+                    self._cond.wait(timeout)
+                    key, timeout = self._next_due()
+                due = self._due[key]
+                delay = self.paused() if self.paused else 0
+                if delay:
+                    # keys postponed together are spread again so they do not all run when the pause ends
+                    self._push(key, time.monotonic() + delay + random.uniform(0, self.jitter) * self.interval)
+                    self._postponed += 1
+                    continue
+                # next run keeps the spread position, delayed runs do not pile up
+                next_due = max(due + self.interval, time.monotonic() + self.interval / 2)
+                self._push(key, next_due + random.uniform(-self.jitter, self.jitter) * self.interval)
+                self._running += 1
+            try:
+                self.callback(key)
+            except Exception:
+                logger.exception('job %s failed', key)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._runs += 1
+
+    def stats(self):
+        """ Scheduled keys, keys waiting past their due time (backlog) and lag in seconds """
+        with self._cond:
+            now = time.monotonic()
+            overdue = [due for key, due in self._due.items() if due <= now]
+            return {
+                'keys': len(self._due),
+                'backlog': len(overdue),
+                'lag': now - min(overdue) if overdue else 0,
+                'last_lag': self._last_lag,
+                'max_lag': self._max_lag,
+                'running': self._running,
+                'runs': self._runs,
+                'postponed': self._postponed,
+            }
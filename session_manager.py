@@ -0,0 +1,136 @@
+import threading
+import time
+import weakref
+
+from decouple import config
+
+from scraper import (sign_in, session_is_connected, SessionExpiredError, LMSUnavailableError, UNAVAILABLE_MSG)
+
+# Seconds a session is trusted without checking it after a response proved it is connected
+VERIFIED_TTL = int(config('LMS_SESSION_VERIFIED_TTL', default=5 * 60))
+# Functions called with user_data after its session is renewed, e.g. to save it
+renew_listeners = []
+# Encrypted cookies of each chat to restore sessions after a restart, set by the bot
+cookie_store = None
+
+
+class _UserLock:
+    """ Lock of one user, kept while a job holds or waits for it """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+
+    def __exit__(self, *_):
+        self._lock.release()
+
+
+_locks_lock = threading.Lock()
+_locks = weakref.WeakValueDictionary()
+
+
+def _user_lock(user_data: dict):
+    key = user_data.get('chat_id') or id(user_data)
+    with _locks_lock:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = _UserLock()
+        return lock
+
+
+def recently_verified(session):
+    """ Check a response proved session is connected in last VERIFIED_TTL seconds """
+    return time.monotonic() - getattr(session, 'verified_at', 0) < VERIFIED_TTL
+
+
+def user_session(user_data: dict):
+    """ Session of user, restored from saved cookies after a restart """
+    session = user_data.get('session')
+    if session is None and cookie_store and user_data.get('chat_id'):
+        with _user_lock(user_data):
+            session = user_data.get('session')
+            if session is None:
+                session = cookie_store.load(user_data['chat_id'])
+                if session:
+                    user_data['session'] = session
+    return session
+
+
+def set_session(user_data: dict, session):
+    """ Keep a signed in session of user and save its cookies """
+    user_data['session'] = session
+    if cookie_store and user_data.get('chat_id'):
+        cookie_store.save(user_data['chat_id'], session)
+
+
+def forget_session(chat_id: int):
+    """ Remove saved cookies of a user who logged out """
+    if cookie_store:
+        cookie_store.forget(chat_id)
+
+
+def _seen(user_data: dict, session):
+    if cookie_store and user_data.get('chat_id'):
+        cookie_store.seen(user_data['chat_id'], session)
+
+
+def renew_session(user_data: dict, expired=None):
+    """ Sign in again with user login information, parallel jobs of a user sign in once, a job that waited gets the
+    session of the job before it """
+    with _user_lock(user_data):
+        session = user_data.get('session')
+        if session is not None and session is not expired:
+            return session, ''
+        if expired is not None:
+            user_data.pop('session', None)
+            if cookie_store and user_data.get('chat_id'):
+                cookie_store.forget(user_data['chat_id'], expired=True)
+        if 'password' not in user_data:
+            # login information is not saved, it is lost after a restart
+            return None, 'لطفا دوباره با ارسال /start شروع کنید.'
+        session, msg = sign_in(user_data['username'], user_data['password'])
+        if session:
+            set_session(user_data, session)
+            for listener in renew_listeners:
+                listener(user_data)
+        return session, msg
+
+
+def call_with_session(user_data: dict, func, *args):
+    """ Call a scraper function with session of user, if lms answers with login page sign in and retry once,
+    func must return a (result, msg) tuple like scraper functions """
+    session = user_session(user_data)
+    if session:
+        try:
+            result = func(session, *args)
+            if result[0] is not None:
+                _seen(user_data, session)
+            return result
+        except SessionExpiredError:
+            pass
+    session, msg = renew_session(user_data, session)
+    if not session:
+        return None, msg
+    try:
+        return func(session, *args)
+    except SessionExpiredError:
+        return None, 'لطفا دوباره وارد شوید.'
+
+
+def connected_session(user_data: dict):
+    """ Session of user for requests that are not made by scraper, e.g. file downloads, parallel jobs of a user
+    check it once """
+    session = user_session(user_data)
+    if session and recently_verified(session):
+        return session, ''
+    with _user_lock(user_data):
+        session = user_session(user_data)
+        try:
+            if session and (recently_verified(session) or session_is_connected(session)):
+                _seen(user_data, session)
+                return session, ''
+        except LMSUnavailableError:
+            return None, UNAVAILABLE_MSG
+        return renew_session(user_data, session)
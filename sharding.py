@@ -0,0 +1,154 @@
+import bisect
+import json
+import logging
+import threading
+import time
+import zlib
+
+import redis
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from webhook import (UpdateWorkers, update_chat_id)
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """ Consistent hashing of chat ids to workers, adding or removing a worker only moves the chats of its part
+    of the ring """
+
+    def __init__(self, nodes=(), replicas: int = 100):
+        self.replicas = replicas
+        self.nodes = sorted(nodes)
+        self._ring = sorted((zlib.crc32(f'{node}#{idx}'.encode()), node) for node in self.nodes
+                            for idx in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        if not self._ring:
+            return None
+        idx = bisect.bisect(self._hashes, zlib.crc32(str(key).encode())) % len(self._ring)
+        return self._ring[idx][1]
+
+
+class ShardMembers:
+    """ Live workers from their heartbeats in redis, the ring is rebuilt when a worker joins or leaves """
+
+    def __init__(self, db: redis.Redis, prefix: str = 'lms:shard', ttl: float = 15):
+        self.db = db
+        self.prefix = prefix
+        self.ttl = ttl
+        self.ring = HashRing()
+        # functions called with (old ring, new ring) after membership changed
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def queue_key(self, worker_id: str):
+        return f'{self.prefix}:queue:{worker_id}'
+
+    def heartbeat(self, worker_id: str):
+        self.db.zadd(f'{self.prefix}:workers', {worker_id: time.time()})
+
+    def leave(self, worker_id: str):
+        self.db.zrem(f'{self.prefix}:workers', worker_id)
+
+    def refresh(self):
+        """ Load live workers and rebuild ring if they changed, returns workers that left """
+        workers = [worker.decode() for worker in
+                   self.db.zrangebyscore(f'{self.prefix}:workers', time.time() - self.ttl, '+inf')]
+        with self._lock:
+            old_ring = self.ring
+            if sorted(workers) == old_ring.nodes:
+                return []
+            self.ring = HashRing(workers)
+        for listener in self.listeners:
+            listener(old_ring, self.ring)
+        return [worker for worker in old_ring.nodes if worker not in workers]
+
+    def run(self, worker_id: str = None, interval: float = 5):
+        """ Keep membership fresh in a background thread, send heartbeats of worker_id if it is set """
+
+        def loop():
+            while True:
+                try:
+                    if worker_id:
+                        self.heartbeat(worker_id)
+                    self.refresh()
+                except redis.RedisError:
+                    logger.exception('shard members could not be refreshed')
+                time.sleep(interval)
+
+        if worker_id:
+            self.heartbeat(worker_id)
+        self.refresh()
+        threading.Thread(target=loop, name='shard_members', daemon=True).start()
+
+
+class ShardRouter:
+    """ Front side, route each update to the worker that owns its chat through a redis list """
+
+    def __init__(self, members: ShardMembers):
+        self.members = members
+        self.routed = 0
+        members.listeners.append(self._on_change)
+
+    def submit(self, update: Update):
+        self.route(update_chat_id(update), json.dumps(update.to_dict()))
+
+    def route(self, chat_id: int, data: str):
+        worker_id = self.members.ring.node_for(chat_id)
+        if worker_id is None:
+            # no worker is alive yet, keep update until one joins
+            worker_id = 'pending'
+        self.members.db.rpush(self.members.queue_key(worker_id), data)
+        self.routed += 1
+
+    def _on_change(self, old_ring: HashRing, new_ring: HashRing):
+        """ Move waiting updates of workers that left, and updates kept while no worker was alive """
+        for worker_id in [worker for worker in old_ring.nodes if worker not in new_ring.nodes] + ['pending']:
+            while new_ring.nodes:
+                data = self.members.db.lpop(self.members.queue_key(worker_id))
+                if data is None:
+                    break
+                self.route(update_chat_id(Update.de_json(json.loads(data), None)), data)
+
+    def stats(self):
+        db = self.members.db
+        return {'workers': len(self.members.ring.nodes), 'routed': self.routed,
+                **{f'queue_{worker}': db.llen(self.members.queue_key(worker)) for worker in self.members.ring.nodes}}
+
+
+class ShardWorker:
+    """ Worker side, take updates of owned chats from redis and process them in order per chat,
+    state of the chat is loaded from redis before each update because another worker may have owned it """
+
+    def __init__(self, members: ShardMembers, worker_id: str, dispatcher: Dispatcher, workers: int = 8,
+                 load_state=None):
+        self.members = members
+        self.worker_id = worker_id
+        self.dispatcher = dispatcher
+        self.update_workers = UpdateWorkers(dispatcher, workers, before_update=load_state)
+
+    def owns(self, chat_id: int):
+        return self.members.ring.node_for(chat_id) in (self.worker_id, None)
+
+    def run(self):
+        """ Join the ring and process updates until the process stops """
+        self.members.run(self.worker_id)
+        queue_key = self.members.queue_key(self.worker_id)
+        try:
+            while True:
+                item = self.members.db.blpop(queue_key, timeout=5)
+                if item is None:
+                    continue
+                update = Update.de_json(json.loads(item[1]), self.dispatcher.bot)
+                if update:
+                    self.update_workers.submit(update)
+        finally:
+            self.members.leave(self.worker_id)
+
+    def stats(self):
+        return {'worker': self.worker_id, 'workers': len(self.members.ring.nodes),
+                'queue': self.members.db.llen(self.members.queue_key(self.worker_id)),
+                **self.update_workers.stats()}
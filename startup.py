@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """ Readiness of external clients of the bot, each one is connected in a background thread so updates that do
+    not need it are answered right away, and seconds from start to the first message sent to a user """
+
+    def __init__(self, retry_interval: float = 5, max_retry_interval: float = 5 * 60):
+        self.started_at = time.monotonic()
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._lock = threading.Lock()
+        # name -> event set when it is ready
+        self._ready = {}
+        # name -> seconds from start until it was ready
+        self._seconds = {}
+        self._failures = {}
+        self.first_response = None
+
+    def connect(self, name: str, func):
+        """ Call func in background until it succeeds, retries wait longer after each failure """
+        with self._lock:
+            if name in self._ready:
+                return
+            self._ready[name] = threading.Event()
+            self._failures[name] = 0
+        threading.Thread(target=self._connect, args=(name, func), name=f'startup_{name}', daemon=True).start()
+
+    def _connect(self, name: str, func):
+        delay = self.retry_interval
+        while True:
+            try:
+                func()
+                break
+            except Exception:
+                logger.exception('%s could not be connected, retrying in %s seconds', name, delay)
+                with self._lock:
+                    self._failures[name] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+        with self._lock:
+            self._seconds[name] = time.monotonic() - self.started_at
+        self._ready[name].set()
+
+    def ready(self, name: str):
+        """ Check client is connected, a client that is not tracked is always ready """
+        event = self._ready.get(name)
+        return event is None or event.is_set()
+
+    def wait(self, name: str, timeout: float = None):
+        """ Wait until client is connected, returns False on timeout """
+        event = self._ready.get(name)
+        return event is None or event.wait(timeout)
+
+    def responded(self, *_):
+        """ Outbox listener, the first sent message marks time to first response """
+        if self.first_response is None:
+            self.first_response = time.monotonic() - self.started_at
+
+    def stats(self):
+        """ Seconds until each client was ready, 0 while it is connecting, and its failed attempts """
+        with self._lock:
+            values = {'uptime': time.monotonic() - self.started_at, 'first_response': self.first_response or 0}
+            for name in self._ready:
+                values[f'{name}_ready'] = self._seconds.get(name, 0)
+                values[f'{name}_failures'] = self._failures[name]
+            return values
@@ -0,0 +1,104 @@
+import hashlib
+import hmac
+import os
+import shutil
+import threading
+import time
+from urllib.parse import (quote, urlencode)
+
+from gdrive import GDrive
+
+
+class DriveStorage:
+    """ Files uploaded to google drive and shared with anyone who has the link, ref of a file is its drive id,
+    drive is logged into on first use so a slow drive does not delay start of the bot """
+    name = 'drive'
+
+    def __init__(self, drive: GDrive, folder_name: str, chunk_size: int):
+        self.drive = drive
+        self.folder_name = folder_name
+        self.folder = None
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """ Login and find the host folder, once, later calls return right away """
+        with self._lock:
+            if self.folder is None:
+                self.drive.login()
+                self.folder = self.drive.get_folder(self.folder_name)
+        if self.drive.auth.access_token_expired:
+            self.drive.login()
+
+    def store(self, filename: str, digest: str, progress=None):
+        """ Upload file, returns its ref """
+        self.connect()
+        file = self.drive.upload_new_file_resumable(filename, self.folder, self.chunk_size, progress)
+        file.InsertPermission({
+            'type': 'anyone',
+            'value': 'anyone',
+            'role': 'reader'})
+        return file['id']
+
+    def exists(self, ref: str):
+        self.connect()
+        return self.drive.file_exists(ref)
+
+    def url(self, ref: str, name: str = None):
+        """ Download link of file, the same as webContentLink of drive """
+        return f'https://drive.google.com/uc?id={ref}&export=download'
+
+
+class LocalStorage:
+    """ Files kept on local disk under the hash of their content and served by FileServer, links are signed and
+    expire, so a link shared out of telegram stops working """
+    name = 'local'
+
+    def __init__(self, root: str, base_url: str, secret: str, link_ttl: float = 24 * 60 * 60):
+        self.root = root
+        self.base_url = base_url.rstrip('/')
+        self.secret = secret.encode()
+        self.link_ttl = link_ttl
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, ref: str):
+        # first characters of the hash spread files over directories
+        return os.path.join(self.root, ref[:2], ref)
+
+    def store(self, filename: str, digest: str, progress=None):
+        """ Add downloaded file to storage, returns its ref, the hash of content with the file extension """
+        ref = digest + os.path.splitext(filename)[1]
+        path = self.path(ref)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            try:
+                # a second name of the same file on disk, nothing is copied and the disk cache can drop its name
+                os.link(filename, path)
+            except OSError:
+                # storage is on another disk, copied to a temporary name so a partial file is never served
+                shutil.copyfile(filename, f'{path}.tmp')
+                os.replace(f'{path}.tmp', path)
+        if progress:
+            size = os.path.getsize(path)
+            progress(size, size)
+        return ref
+
+    def exists(self, ref: str):
+        return os.path.exists(self.path(ref))
+
+    def sign(self, ref: str, name: str, expires: int):
+        message = f'{ref}\n{name}\n{expires}'.encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, ref: str, name: str, expires: str, signature: str):
+        """ Check a link is signed by this storage and not expired """
+        if not expires.isdigit() or int(expires) < time.time():
+            return False
+        return hmac.compare_digest(self.sign(ref, name, int(expires)), signature)
+
+    def url(self, ref: str, name: str = None):
+        """ Signed download link of file, name is the file name the browser saves it as """
+        name = (name or ref).replace('/', ' ')
+        expires = int(time.time() + self.link_ttl)
+        query = urlencode({'name': name, 'expires': expires, 'signature': self.sign(ref, name, expires)})
+        return f'{self.base_url}/files/{quote(ref)}?{query}'
@@ -0,0 +1,245 @@
+import logging
+import threading
+
+import redis
+
+from fingerprint import (course_fingerprint, diff_fingerprints, keep_revisions)
+from scheduler import SpreadScheduler
+from scraper import get_changed_activities
+from session_manager import call_with_session
+
+logger = logging.getLogger(__name__)
+
+
+class CourseWatcher:
+    """ Watch each subscribed course once per interval and notify all of its subscribers about added and modified
+    activities, a course is compared by the fingerprints of its activities and not parsed if its page did not change """
+
+    def __init__(self, db: redis.Redis = None, prefix: str = 'lms:watcher', interval: float = 60 * 60,
+                 workers: int = 4):
+        # subscriptions and fingerprints are written through to redis to survive restarts
+        self.db = db
+        self.prefix = prefix
+        self.bot = None
+        # chats of other processes are skipped when users are sharded, set to a function of chat_id
+        self.owns = None
+        # functions called with (course_id, fetcher chat_id, all activities, added and modified activities)
+        # when activities changed
+        self.change_listeners = []
+        # each course is checked at its own time in the interval
+        self.scheduler = SpreadScheduler('course_watcher', interval, self.watch_course, workers)
+        self._lock = threading.Lock()
+        # course_id -> {chat_id: user_data}
+        self._subscribers = {}
+        # course_id -> {activity_id: fingerprint}
+        self._fingerprints = {}
+        # course_id -> hash of the last fetched course page
+        self._page_hashes = {}
+        # course_id -> course name
+        self._course_names = {}
+
+    def start(self, bot):
+        """ Start checking courses and send notifications with bot """
+        self.bot = bot
+        self.scheduler.start()
+
+    def is_subscribed(self, chat_id: int):
+        """ Check chat is subscribed to any course """
+        with self._lock:
+            return any(chat_id in subscribers for subscribers in self._subscribers.values())
+
+    def is_watched(self, course_id: str):
+        """ Check course already has a baseline of activities """
+        with self._lock:
+            return course_id in self._fingerprints
+
+    def subscribe(self, chat_id: int, user_data: dict, course: dict, activities: list = None):
+        """ Subscribe chat to new activities of a course, activities is the baseline if course is not watched yet """
+        with self._lock:
+            self._subscribers.setdefault(course['id'], {})[chat_id] = user_data
+            self._course_names[course['id']] = course['name']
+            new_baseline = course['id'] not in self._fingerprints and activities is not None
+            if new_baseline:
+                self._fingerprints[course['id']] = course_fingerprint(activities)
+        self.scheduler.add(course['id'])
+        if self.db:
+            pipeline = self.db.pipeline(transaction=False)
+            pipeline.hset(f'{self.prefix}:courses', course['id'], course['name'])
+            pipeline.sadd(f'{self.prefix}:subscribers:{course["id"]}', chat_id)
+            if new_baseline and activities:
+                pipeline.hset(f'{self.prefix}:fingerprint:{course["id"]}', mapping=course_fingerprint(activities))
+            pipeline.execute()
+
+    def unsubscribe(self, chat_id: int):
+        """ Unsubscribe chat from all courses """
+        left_courses = []
+        with self._lock:
+            for course_id in list(self._subscribers):
+                if self._subscribers[course_id].pop(chat_id, None) is None:
+                    continue
+                left_courses.append(course_id)
+                # other processes may still watch the course for their chats, only local state is dropped here
+                if not self._subscribers[course_id]:
+                    self._forget(course_id)
+        if self.db:
+            for course_id in left_courses:
+                self._remove_subscriber(course_id, chat_id)
+
+    def _remove_subscriber(self, course_id: str, chat_id: int):
+        """ Remove chat from subscribers of course in redis, keys of the course are deleted when no chat of any
+        process is left, a chat subscribing at the same time restarts the check """
+        subscribers_key = f'{self.prefix}:subscribers:{course_id}'
+        self.db.srem(subscribers_key, chat_id)
+        with self.db.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(subscribers_key)
+                    if pipeline.scard(subscribers_key):
+                        return
+                    pipeline.multi()
+                    pipeline.hdel(f'{self.prefix}:courses', course_id)
+                    pipeline.hdel(f'{self.prefix}:page_hashes', course_id)
+                    pipeline.delete(subscribers_key, f'{self.prefix}:fingerprint:{course_id}',
+                                    f'{self.prefix}:known:{course_id}')
+                    pipeline.execute()
+                    return
+                except redis.WatchError:
+                    continue
+
+    def _forget(self, course_id: str):
+        self.scheduler.remove(course_id)
+        del self._subscribers[course_id]
+        self._fingerprints.pop(course_id, None)
+        self._page_hashes.pop(course_id, None)
+        self._course_names.pop(course_id, None)
+
+    def restore_batch(self, user_data_of, cursor: int = 0, count: int = 100):
+        """ Load a batch of watched courses from redis, user_data_of maps chat_id to its user_data,
+        returns the cursor of next batch, 0 when all courses are loaded """
+        cursor, courses = self.db.hscan(f'{self.prefix}:courses', cursor, count=count)
+        for course_id, course_name in courses.items():
+            course_id = course_id.decode()
+            pipeline = self.db.pipeline(transaction=False)
+            pipeline.smembers(f'{self.prefix}:subscribers:{course_id}')
+            pipeline.hgetall(f'{self.prefix}:fingerprint:{course_id}')
+            # ids known before fingerprints were kept, they get their fingerprint in next check
+            pipeline.smembers(f'{self.prefix}:known:{course_id}')
+            pipeline.hget(f'{self.prefix}:page_hashes', course_id)
+            chat_ids, fingerprint, known_activities, page_hash = pipeline.execute()
+            fingerprint = {activity_id.decode(): value.decode() for activity_id, value in fingerprint.items()} or \
+                {activity_id.decode(): '' for activity_id in known_activities}
+            with self._lock:
+                subscribers = self._subscribers.setdefault(course_id, {})
+                for chat_id in chat_ids:
+                    if not self.owns or self.owns(int(chat_id)):
+                        subscribers.setdefault(int(chat_id), user_data_of(int(chat_id)))
+                self._course_names[course_id] = course_name.decode()
+                # a course without fingerprint gets its baseline in next check
+                if fingerprint and course_id not in self._fingerprints:
+                    self._fingerprints[course_id] = fingerprint
+                    if page_hash:
+                        self._page_hashes[course_id] = page_hash.decode()
+            self.scheduler.add(course_id)
+        return cursor
+
+    def fetch_course(self, course_id: str, subscribers: dict, page_hash: str = None):
+        """ Fetch course activities with the first subscriber session that works,
+        returns fetcher chat_id, page hash and activities, activities is None if page hash did not change """
+        for chat_id, user_data in subscribers.items():
+            result, _ = call_with_session(user_data, get_changed_activities, course_id, page_hash)
+            if result is not None:
+                return chat_id, result[0], result[1]
+        return None, page_hash, None
+
+    def check_course(self, course_id: str, subscribers: dict):
+        """ Find changes of a course, returns fetcher chat_id, added activities and modified activities """
+        with self._lock:
+            page_hash = self._page_hashes.get(course_id)
+        fetcher_chat_id, page_hash, activities = self.fetch_course(course_id, subscribers, page_hash)
+        if activities is None:
+            # lms is not available or page is the same as last check
+            return fetcher_chat_id, [], []
+        fingerprint = course_fingerprint(activities)
+        with self._lock:
+            if course_id not in self._subscribers:
+                return fetcher_chat_id, [], []
+            old_fingerprint = self._fingerprints.get(course_id)
+            if old_fingerprint:
+                fingerprint = keep_revisions(old_fingerprint, fingerprint)
+            self._fingerprints[course_id] = fingerprint
+            if page_hash:
+                self._page_hashes[course_id] = page_hash
+        if old_fingerprint is None:
+            # first successful fetch of this course becomes its baseline
+            added, removed, modified = list(fingerprint), [], []
+        else:
+            added, removed, modified = diff_fingerprints(old_fingerprint, fingerprint)
+        if self.db:
+            pipeline = self.db.pipeline(transaction=False)
+            # also activities known before fingerprints or revisions were kept and revisions seen the first time
+            changed = {activity_id: value for activity_id, value in fingerprint.items()
+                       if not old_fingerprint or old_fingerprint.get(activity_id) != value}
+            if changed:
+                pipeline.hset(f'{self.prefix}:fingerprint:{course_id}', mapping=changed)
+            if removed:
+                pipeline.hdel(f'{self.prefix}:fingerprint:{course_id}', *removed)
+            if page_hash:
+                pipeline.hset(f'{self.prefix}:page_hashes', course_id, page_hash)
+            pipeline.delete(f'{self.prefix}:known:{course_id}')
+            pipeline.execute()
+        if old_fingerprint is None:
+            return fetcher_chat_id, [], []
+        added, modified = set(added), set(modified)
+        added_activities = [activity for activity in activities if activity['id'] in added]
+        modified_activities = [activity for activity in activities if activity['id'] in modified]
+        if added or removed or modified:
+            for listener in self.change_listeners:
+                try:
+                    listener(course_id, fetcher_chat_id, activities, added_activities + modified_activities)
+                except Exception:
+                    logger.exception('change listener of course %s failed', course_id)
+        return fetcher_chat_id, added_activities, modified_activities
+
+    def watch_course(self, course_id: str):
+        """ Scheduler callback, check a course and send its added and modified activities to subscribers """
+        with self._lock:
+            subscribers = dict(self._subscribers.get(course_id, {}))
+        if not subscribers:
+            return
+        fetcher_chat_id, new_activities, modified_activities = self.check_course(course_id, subscribers)
+        if not new_activities and not modified_activities:
+            return
+        course_name = self._course_names.get(course_id, '')
+        for chat_id in subscribers:
+            if self.owns and not self.owns(chat_id):
+                continue
+            # completion status on the course page belongs to the fetcher,
+            # a just added activity is not viewed by others yet
+            reply_msg = ''
+            if new_activities:
+                reply_msg += new_activities_message(course_name, new_activities, chat_id == fetcher_chat_id)
+            if modified_activities:
+                reply_msg += modified_activities_message(course_name, modified_activities)
+            try:
+                self.bot.send_message(chat_id, reply_msg)
+            except Exception:
+                logger.exception('changes of course %s could not be sent to chat %s', course_id, chat_id)
+
+
+def new_activities_message(course_name: str, activities: list, own_status: bool = True):
+    """ Build new activities notification """
+    reply_msg = '\n\U0001F514  فعالیت های جدیدی اضافه شد \U0001F514\n\n'
+    for activity in activities:
+        reply_msg += f'نام درس:  {course_name}\nفعالیت های جدید:   '
+        viewed = own_status and activity['status'] == '0'
+        status = 'مشاهده شده است. \U00002705' if viewed else 'مشاهده نشده است. \U0000274C'
+        reply_msg += f'\n        عنوان فعالیت:   {activity["name"]}\n        وضعیت:   {status}\n\n'
+    return reply_msg
+
+
+def modified_activities_message(course_name: str, activities: list):
+    """ Build modified activities notification, e.g. a renamed activity or a replaced file """
+    reply_msg = '\n\U0001F514  فعالیت های زیر تغییر کرد \U0001F514\n\n'
+    for activity in activities:
+        reply_msg += f'نام درس:  {course_name}\n        عنوان فعالیت:   {activity["name"]}\n\n'
+    return reply_msg
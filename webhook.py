@@ -0,0 +1,92 @@
+import logging
+import queue
+import threading
+import time
+
+from flask import Flask, request
+from telegram import Update
+from telegram.ext import (Updater, Dispatcher)
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: Update):
+    """ Chat of an update, updates without a chat are grouped by user """
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+class UpdateWorkers:
+    """ Pool of threads processing updates, updates of a chat always go to the same thread so they are handled
+    in order and conversation states do not race, updates of different chats are handled in parallel """
+
+    def __init__(self, dispatcher: Dispatcher, workers: int = 8, before_update=None):
+        self.dispatcher = dispatcher
+        # called with each update before it is processed, e.g. to load state of its chat
+        self.before_update = before_update
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._processed = 0
+        self._total_time = 0
+        self._lock = threading.Lock()
+        for idx, updates in enumerate(self._queues):
+            threading.Thread(target=self._work, args=(updates,), name=f'update_worker_{idx}', daemon=True).start()
+
+    def submit(self, update: Update):
+        self._queues[update_chat_id(update) % len(self._queues)].put((time.monotonic(), update))
+
+    def _work(self, updates: queue.Queue):
+        while True:
+            received_at, update = updates.get()
+            try:
+                if self.before_update:
+                    self.before_update(update)
+                self.dispatcher.process_update(update)
+            except Exception:
+                logger.exception('update could not be processed')
+            with self._lock:
+                self._processed += 1
+                self._total_time += time.monotonic() - received_at
+
+    def stats(self):
+        """ Updates waiting in queues, processed updates and average seconds from receiving to handled """
+        with self._lock:
+            return {
+                'waiting': sum(updates.qsize() for updates in self._queues),
+                'processed': self._processed,
+                'avg_time': self._total_time / self._processed if self._processed else 0,
+            }
+
+
+def create_app(updater: Updater, update_workers: UpdateWorkers, url_path: str):
+    """ Flask app receiving updates, each update is queued and acknowledged right away """
+    app = Flask(__name__)
+
+    @app.route(f'/{url_path}', methods=['POST'])
+    def receive_update():
+        data = request.get_json(force=True, silent=True)
+        if not data:
+            return '', 400
+        update = Update.de_json(data, updater.bot)
+        if update:
+            update_workers.submit(update)
+        return '', 200
+
+    @app.route('/health')
+    def health():
+        return 'ok'
+
+    return app
+
+
+def run_webhook(updater: Updater, update_workers: UpdateWorkers, url: str, url_path: str, host: str = '0.0.0.0',
+                port: int = 8443):
+    """ Set webhook of bot to url and serve updates until the process stops, the secret url path keeps others
+    from sending fake updates and must be the same on all instances behind a load balancer """
+    updater.job_queue.start()
+    updater.bot.set_webhook(url=f'{url.rstrip("/")}/{url_path}')
+    app = create_app(updater, update_workers, url_path)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.run(host, port, threaded=True)